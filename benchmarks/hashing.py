@@ -0,0 +1,246 @@
+"""
+Throughput benchmarks for hashing local files (the ingest hot path).
+
+Measures each way of hashing a file (see FUNCTIONS) across buffer sizes,
+file sizes, a hot or cold page cache, and thread counts, and writes the
+results as JSON.  A run can then be compared against an earlier one, to
+catch regressions.
+
+    python -m benchmarks.hashing run [--out results.json] [--sizes 1 64] ...
+    python -m benchmarks.hashing compare before.json after.json [--tolerance 0.1]
+
+`compare` exits with status 1 if any case slowed down by more than the
+tolerance (as a fraction of its earlier throughput).
+
+A cold cache is simulated by evicting each file from the page cache (with
+`posix_fadvise`, so Linux only) before every read.  Multi-threaded cases
+hash one file per thread through `hashpool`, as `has` and `put` do.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from mediaman.core import hashing
+from mediaman.core import hashpool
+from mediaman.core import merkle
+
+MiB = 1024**2
+RESULTS_VERSION = 1
+
+DEFAULT_SIZES = [1, 64]  # MiB
+DEFAULT_BUFFERS = [64 * 1024, MiB, 8 * MiB]
+DEFAULT_THREADS = [1, 4]
+DEFAULT_CACHES = ["hot", "cold"]
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.1
+
+
+def read_tee(path, buffer):
+    """Reads a file as an upload does, through `HashingFile`."""
+    with hashing.HashingFile(path, [hashing.PREFERRED_HASH]) as infile:
+        data = bytearray(buffer)
+        while infile.readinto(data):
+            pass
+
+
+# name: (function(path, buffer), whether the buffer size applies)
+FUNCTIONS = {
+    "sha256": (lambda path, buffer: hashing.sha256(path, buffer=buffer), True),
+    "xxh64": (lambda path, buffer: hashing.xxh64(path, buffer=buffer), True),
+    "xxh3_128": (lambda path, buffer: hashing.xxh3_128(path, buffer=buffer), True),
+    "hash_many": (lambda path, buffer: hashing.hash_many(path, [hashing.Hash.XXH64, hashing.Hash.SHA256], buffer=buffer), True),
+    "tee": (read_tee, True),
+    "fingerprint": (lambda path, buffer: hashing.fingerprint(path), False),
+    "merkle": (lambda path, buffer: merkle.block_digests(path), False),
+}
+
+
+class BenchmarkRequest:
+    """Just enough of a `models.Request` for `hashpool` (no hash cache, no config)."""
+
+    is_hashed = False
+
+    def __init__(self, path, function, buffer):
+        self.path = path
+        self.function = function
+        self.buffer = buffer
+
+    @property
+    def hashes(self):
+        return [self.function(self.path, self.buffer)]
+
+
+def create_file(path, size):
+    with open(path, "wb") as outfile:
+        for _ in range(size // MiB):
+            outfile.write(os.urandom(MiB))
+        outfile.write(os.urandom(size % MiB))
+
+
+def evict(path):
+    with open(path, "rb") as infile:
+        os.fsync(infile.fileno())
+        os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def warm(path):
+    with open(path, "rb", buffering=0) as infile:
+        for _ in hashing.read_chunks(infile, 8 * MiB):
+            pass
+
+
+def run_case(function, paths, buffer, cache, repeat):
+    """Returns the median seconds to hash all the given files (one per thread)."""
+    times = []
+    for _ in range(repeat):
+        for path in paths:
+            (evict if cache == "cold" else warm)(path)
+
+        start = time.perf_counter()
+        if len(paths) == 1:
+            function(paths[0], buffer)
+        else:
+            requests = [BenchmarkRequest(path, function, buffer) for path in paths]
+            for _ in hashpool.hash_requests(requests, workers=len(paths), per_device=len(paths)):
+                pass
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def case_key(result):
+    return (result["function"], result["size"], result["buffer"], result["cache"], result["threads"])
+
+
+def describe(key):
+    (function, size, buffer, cache, threads) = key
+    buffer = "-" if buffer is None else f"{buffer // 1024}K"
+    return f"{function:<12} {size // MiB:>6}M {buffer:>7} {cache:<4} {threads:>2}t"
+
+
+def machine():
+    import xxhash
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "xxhash": xxhash.VERSION,
+    }
+
+
+def run(args):
+    caches = list(args.caches)
+    if "cold" in caches and not hasattr(os, "posix_fadvise"):
+        print("[!] posix_fadvise is unavailable here; skipping cold-cache cases", file=sys.stderr)
+        caches.remove("cold")
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for size in (size_mib * MiB for size_mib in args.sizes):
+            files = [os.path.join(directory, f"{size}.{i}") for i in range(max(args.threads))]
+            for path in files:
+                create_file(path, size)
+
+            for (name, (function, buffered)) in FUNCTIONS.items():
+                if args.functions and name not in args.functions:
+                    continue
+                for buffer in (args.buffers if buffered else [None]):
+                    for cache in caches:
+                        for threads in args.threads:
+                            seconds = run_case(function, files[:threads], buffer, cache, args.repeat)
+                            result = {
+                                "function": name,
+                                "size": size,
+                                "buffer": buffer,
+                                "cache": cache,
+                                "threads": threads,
+                                "seconds": seconds,
+                                "mb_per_s": threads * size / seconds / 1e6,
+                            }
+                            print(f"{describe(case_key(result))} {result['mb_per_s']:10.1f} MB/s")
+                            results.append(result)
+
+            for path in files:
+                os.remove(path)
+
+    with open(args.out, "w") as outfile:
+        json.dump({
+            "version": RESULTS_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "machine": machine(),
+            "repeat": args.repeat,
+            "results": results,
+        }, outfile, indent=2)
+    print(f"Wrote {len(results)} results to {args.out}")
+
+
+def load_results(path):
+    with open(path) as infile:
+        data = json.load(infile)
+    if data["version"] != RESULTS_VERSION:
+        raise RuntimeError(f"Unsupported results version in {path}: {data['version']}")
+    return data
+
+
+def compare(args):
+    before = load_results(args.before)
+    after = load_results(args.after)
+    if before["machine"] != after["machine"]:
+        print("[!] These results are from different machines (or software); expect noise", file=sys.stderr)
+
+    before_results = {case_key(result): result for result in before["results"]}
+    regressions = 0
+    for result in after["results"]:
+        key = case_key(result)
+        if key not in before_results:
+            continue
+
+        (old, new) = (before_results[key]["mb_per_s"], result["mb_per_s"])
+        change = new / old - 1
+        regressed = change < -args.tolerance
+        regressions += regressed
+        print(f"{describe(key)} {old:10.1f} -> {new:10.1f} MB/s {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+
+    print(f"{regressions} regressions (tolerance {args.tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.hashing", description="Hashing throughput benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_run = subparsers.add_parser("run", help="Run the benchmarks, writing the results as JSON")
+    p_run.add_argument("--out", default="hashing-results.json")
+    p_run.add_argument("--dir", default=None, help="Where to create the test files (default: the temp dir)")
+    p_run.add_argument("--functions", nargs="+", choices=list(FUNCTIONS), default=None)
+    p_run.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="File sizes, in MiB")
+    p_run.add_argument("--buffers", nargs="+", type=int, default=DEFAULT_BUFFERS, help="Buffer sizes, in bytes")
+    p_run.add_argument("--threads", nargs="+", type=int, default=DEFAULT_THREADS)
+    p_run.add_argument("--caches", nargs="+", choices=DEFAULT_CACHES, default=DEFAULT_CACHES)
+    p_run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+
+    p_compare = subparsers.add_parser("compare", help="Compare two runs, failing on regressions")
+    p_compare.add_argument("before")
+    p_compare.add_argument("after")
+    p_compare.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark for name lookups on the JSON Index.
+
+Compares the inverted name map (`search_by_name` / `has_name`) against
+the linear scan it replaced.
+
+    python -m benchmarks.index_names [entries] [lookups]
+"""
+
+import sys
+import time
+import uuid
+
+from mediaman.core.index import base
+from mediaman.core.index import index
+
+
+def build_index(entries):
+    files = {
+        str(i): base.create_file(
+            id=str(uuid.uuid4()),
+            name=f"file-{i}.mkv",
+            sid=f"sid-{i}",
+            size=i,
+            hashes=[f"xxh64:{i:016x}"],
+            merged_hashes=[],
+            fingerprint=None,
+            merkle_root=None,
+            merkle_sid=None,
+            crypt=None,
+        )
+        for i in range(entries)
+    }
+
+    idx = index.Index(service=None)
+    idx.index_id = "benchmark"  # skip remote init
+    idx.metadata = index.create_metadata(files=files)
+    idx.build_maps()
+    return idx
+
+
+def linear_search_by_name(idx, file_name):
+    return [f for f in idx.files().values() if f["name"] == file_name]
+
+
+def timed(func, names):
+    start = time.perf_counter()
+    for name in names:
+        func(name)
+    return (time.perf_counter() - start) / len(names)
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    idx = build_index(entries)
+    step = max(1, entries // lookups)
+    names = [f"file-{i}.mkv" for i in range(0, entries, step)][:lookups]
+
+    linear = timed(lambda name: linear_search_by_name(idx, name), names)
+    mapped = timed(idx.search_by_name, names)
+    has_name = timed(idx.has_name, names)
+
+    print(f"entries:              {entries}")
+    print(f"linear search_by_name: {linear * 1e6:10.2f} us/lookup")
+    print(f"mapped search_by_name: {mapped * 1e6:10.2f} us/lookup")
+    print(f"mapped has_name:       {has_name * 1e6:10.2f} us/lookup")
+    print(f"speedup:               {linear / mapped:10.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ __all__ = [
     "run_has",
     "run_get",
     "run_stream",
+    "run_scrub",
     "run_put",
     "run_search",
     "run_fuzzy",
@@ -44,6 +45,10 @@ def run_stream_range(root, file_name, offset, length, service_selector=None):
     return policy.load_client(service_selector=service_selector).stream_range(root, file_name, offset, length)
 
 
+def run_scrub(file_name, offset, length, service_selector=None):
+    return policy.load_client(service_selector=service_selector).scrub(file_name, offset, length)
+
+
 def run_put(root, *file_names, service_selector=None):
     return policy.load_client(service_selector=service_selector).upload(root, *file_names)
 
@@ -52,8 +57,8 @@ def run_search(*file_names, service_selector=None):
     return policy.load_client(service_selector=service_selector).search_by_name(*file_names)
 
 
-def run_fuzzy(*file_names, service_selector=None):
-    return policy.load_client(service_selector=service_selector).fuzzy_search_by_name(*file_names)
+def run_fuzzy(*file_names, limit=None, service_selector=None):
+    return policy.load_client(service_selector=service_selector).fuzzy_search_by_name(*file_names, limit=limit)
 
 
 def run_cap(service_selector=None):
@@ -24,14 +24,18 @@ class AbstractClient(abc.ABC):
         """Return whether a file with that ID exists."""
         raise NotImplementedError()
 
+    def might_have(self, request) -> bool:
+        """Quick prefilter: False only if the file certainly isn't stored yet."""
+        return True
+
     @abc.abstractmethod
     def search_by_name(self, file_name) -> models.AbstractResultFileList:
         """List all files with the given name."""
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def fuzzy_search_by_name(self, file_name) -> models.AbstractResultFileList:
-        """List all files with a name similar to the given name."""
+    def fuzzy_search_by_name(self, file_name, limit=None) -> models.AbstractResultFileList:
+        """List the (best `limit`) files with a name similar to the given name."""
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -54,6 +58,10 @@ class AbstractClient(abc.ABC):
         """Stream the file described by the given request, within range."""
         raise NotImplementedError()
 
+    def scrub(self, identifier, offset, length):
+        """Verify the file described by the given request, within range."""
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def stats(self) -> models.AbstractResultQuota:
         """Return the stats of the service."""
@@ -77,3 +85,8 @@ class AbstractClient(abc.ABC):
     @abc.abstractmethod
     def refresh_global_hashes(self, request):
         raise NotImplementedError()
+
+    @abc.abstractmethod
+    def batch(self):
+        """Return a context manager grouping metadata writes into one commit."""
+        raise NotImplementedError()
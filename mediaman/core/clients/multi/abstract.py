@@ -1,4 +1,6 @@
 
+import contextlib
+
 from mediaman.core.clients.multi import methods
 from mediaman.core.clients.abstract import abstract
 
@@ -12,6 +14,15 @@ class AbstractMulticlient(abstract.AbstractClient):
     def force_init(self):
         return methods.force_init(self.clients)
 
+    @contextlib.contextmanager
+    def batch(self):
+        # NOTE: each client commits independently -- a failure while
+        #       committing one client can't undo another's commit.
+        with contextlib.ExitStack() as stack:
+            for client in self.clients:
+                stack.enter_context(client.batch())
+            yield self
+
     def name(self):
         return f"{self.__class__.__name__}({'/'.join(c.name() for c in self.clients)})"
 
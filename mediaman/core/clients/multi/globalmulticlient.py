@@ -12,6 +12,7 @@ from mediaman.core import validation
 from mediaman.core.clients.multi import abstract
 from mediaman.core.clients.multi import methods
 from mediaman.core.models import MultiResultQuota
+from mediaman.core.utils import trigrams
 
 logger = logtools.new_logger("mediaman.core.clients.multi.globalmulticlient")
 
@@ -93,10 +94,16 @@ class GlobalMulticlient(abstract.AbstractMulticlient):
                 deduped_results.update(hashes)
 
     def has(self, request):
+        if not self.might_have(request):
+            return False
         hash = request.hash
         result = list(gen_first_valid(methods.has_hash(self.clients, hash)))
         return result[0] if result else False
 
+    def might_have(self, request):
+        # NOTE: a client that fails to answer might have it
+        return any(result.response is not False for result in gen_all(methods.might_have(self.clients, request)))
+
     def search_by_name(self, file_name):
         results = gen_all(methods.search_by_name(self.clients, file_name))
         deduped_results = set()  # (name, hash)
@@ -107,21 +114,30 @@ class GlobalMulticlient(abstract.AbstractMulticlient):
                     yield each
                 deduped_results.update(keys)
 
-    def fuzzy_search_by_name(self, file_name):
-        results = gen_all(methods.fuzzy_search_by_name(self.clients, file_name))
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        results = gen_all(methods.fuzzy_search_by_name(self.clients, file_name, limit=limit))
         deduped_results = set()  # (name, hash)
+        matches = []
         for result in results:
             for each in result.response:
                 keys = set((each["name"], hash) for hash in each["hashes"])
                 if not keys & deduped_results:
-                    yield each
+                    matches.append(each)
                 deduped_results.update(keys)
 
+        # each service returns its own best matches; re-rank across services
+        yield from trigrams.top(file_name, matches, key=lambda each: each["name"], limit=limit)
+
     def upload(self, request):
         # TODO: make this better...
         # DO: check policy for storage/redundancy
         # MAYBE: check capacity? (is that a client/index concern?)
 
+        if not self.might_have(request):
+            # NOTE: the file is hashed while it's uploaded
+            logger.info(f"No service can have this file yet ('{request.path}').")
+            return self.clients[0].upload(request)
+
         hash = request.hash
         candidates = set()
         for (client, result) in zip(self.clients, gen_all(methods.has_hash(self.clients, hash))):
@@ -192,6 +208,24 @@ class GlobalMulticlient(abstract.AbstractMulticlient):
         logger.error(f"MediaMan doesn't have '{identifier}'.")
         return None
 
+    def scrub(self, identifier, offset, length):
+        # TODO: make some sort of identifier Enum
+        # (hash, uuid, name, row #, ...)
+        if validation.is_valid_hash(identifier):
+            func = methods.has_hash
+        elif validation.is_valid_uuid(identifier):
+            func = methods.has_uuid
+        else:
+            # BUG: when checking by name, need to see if duplicates exist!
+            func = methods.has_name
+
+        for (client, result) in zip(self.clients, gen_all(func(self.clients, identifier))):
+            if result.response:
+                return client.scrub(identifier, offset, length)
+
+        logger.error(f"MediaMan doesn't have '{identifier}'.")
+        return None
+
     def stats(self):
         results = gen_all(methods.stats(self.clients))
         grand_file_count = 0
@@ -290,21 +324,22 @@ class GlobalMulticlient(abstract.AbstractMulticlient):
             logger.info("Nothing to add.")
             return
 
-        for hash in add:
-            with make_temp_directory() as temp_dir:
-                root = pathlib.Path(temp_dir)
-                logger.info(f"Downloading '{hash}' to '{root}' ...")
-                download_receipt = self.download(root, hash)
-                logger.debug(f"Download receipt: {download_receipt}")
+        with client.batch():
+            for hash in add:
+                with make_temp_directory() as temp_dir:
+                    root = pathlib.Path(temp_dir)
+                    logger.info(f"Downloading '{hash}' to '{root}' ...")
+                    download_receipt = self.download(root, hash)
+                    logger.debug(f"Download receipt: {download_receipt}")
 
-                upload_request = models.Request(
-                    id=None,
-                    path=download_receipt.path(),
-                    hash=hash)
-                logger.debug(f"Upload request: {upload_request}")
+                    upload_request = models.Request(
+                        id=None,
+                        path=download_receipt.path(),
+                        hash=hash)
+                    logger.debug(f"Upload request: {upload_request}")
 
-                upload = client.upload(upload_request)
-                logger.info(f"Uploaded: {upload}")
+                    upload = client.upload(upload_request)
+                    logger.info(f"Uploaded: {upload}")
 
     def refresh(self):
         return self.refresh_global_hashes()
@@ -328,11 +363,21 @@ class GlobalMulticlient(abstract.AbstractMulticlient):
         raise NotImplementedError()  # `mm remove` is not allowed
 
     def search_by_hash(self, hash):
-        results = gen_all(methods.search_by_hash(self.clients, hash))
-        deduped_results = set()  # (name, hash)
+        return self.search_by_hashes([hash])[hash]
+
+    def search_by_hashes(self, hashes):
+        hashes = list(hashes)
+        results = gen_all(methods.search_by_hashes(self.clients, hashes))
+        found = {hash: [] for hash in hashes}
+        deduped_results = {hash: set() for hash in hashes}  # (name, hash)
         for result in results:
-            for each in result.response:
-                keys = set((each["name"], hash) for hash in each["hashes"])
-                if not keys & deduped_results:
-                    yield each
-                deduped_results.update(keys)
+            if result.response is None:
+                continue
+
+            for (hash, files) in result.response.items():
+                for each in files:
+                    keys = set((each["name"], h) for h in each["hashes"])
+                    if not keys & deduped_results[hash]:
+                        found[hash].append(each)
+                    deduped_results[hash].update(keys)
+        return found
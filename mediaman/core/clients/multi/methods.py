@@ -88,6 +88,10 @@ def has_hash(clients, hash) -> Iterable[models.Response]:
     return apply_consecutive(clients, "has_hash", hash)
 
 
+def might_have(clients, request) -> Iterable[models.Response]:
+    return apply_consecutive(clients, "might_have", request)
+
+
 def has_uuid(clients, uuid) -> Iterable[models.Response]:
     return apply_consecutive(clients, "has_uuid", uuid)
 
@@ -100,14 +104,18 @@ def search_by_name(clients, file_name) -> Iterable[models.Response]:
     return apply_consecutive(clients, "search_by_name", file_name)
 
 
-def fuzzy_search_by_name(clients, file_name) -> Iterable[models.Response]:
-    return apply_consecutive(clients, "fuzzy_search_by_name", file_name)
+def fuzzy_search_by_name(clients, file_name, limit=None) -> Iterable[models.Response]:
+    return apply_consecutive(clients, "fuzzy_search_by_name", file_name, limit=limit)
 
 
 def search_by_hash(clients, hash) -> Iterable[models.Response]:
     return apply_consecutive(clients, "search_by_hash", hash)
 
 
+def search_by_hashes(clients, hashes) -> Iterable[models.Response]:
+    return apply_consecutive(clients, "search_by_hashes", hashes)
+
+
 def upload(clients, file_path) -> Iterable[models.Response]:
     return apply_consecutive(clients, "upload", file_path)
 
@@ -1,4 +1,5 @@
 
+from mediaman.core import models
 from mediaman.core.clients.multi import abstract
 from mediaman.core.clients.multi import methods
 
@@ -20,14 +21,17 @@ class Multiclient(abstract.AbstractMulticlient):
         return gen_all(methods.list_files(self.clients))
 
     def has(self, request):
-        hash = request.hash
-        return gen_all(methods.has_hash(self.clients, hash))
+        return gen_all(methods.has(self.clients, request))
+
+    def might_have(self, request):
+        # NOTE: a client that fails to answer might have it
+        return any(result.response is not False for result in gen_all(methods.might_have(self.clients, request)))
 
     def search_by_name(self, file_name):
         return gen_all(methods.search_by_name(self.clients, file_name))
 
-    def fuzzy_search_by_name(self, file_name):
-        return gen_all(methods.fuzzy_search_by_name(self.clients, file_name))
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        return gen_all(methods.fuzzy_search_by_name(self.clients, file_name, limit=limit))
 
     def upload(self, request):
         path = request.path
@@ -42,6 +46,9 @@ class Multiclient(abstract.AbstractMulticlient):
     def stream_range(self, root, file_path, offset, length):
         raise RuntimeError()  # `mm all streamrange` isn't allowed
 
+    def scrub(self, file_path, offset, length):
+        raise RuntimeError()  # `mm all scrub` isn't allowed
+
     def stats(self):
         return gen_all(methods.stats(self.clients))
 
@@ -59,3 +66,16 @@ class Multiclient(abstract.AbstractMulticlient):
 
     def search_by_hash(self, hash):
         return gen_all(methods.search_by_hash(self.clients, hash))
+
+    def search_by_hashes(self, hashes):
+        hashes = list(hashes)
+        results = list(gen_all(methods.search_by_hashes(self.clients, hashes)))
+        return {
+            hash: [
+                models.Response(
+                    result.client,
+                    None if result.response is None else result.response[hash],
+                    result.exception)
+                for result in results]
+            for hash in hashes
+        }
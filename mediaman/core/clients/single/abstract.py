@@ -11,6 +11,9 @@ class AbstractSingleClient(abstract.AbstractClient):
     def force_init(self):
         self.index.force_init()
 
+    def batch(self):
+        return self.index.batch()
+
     def name(self):
         return self.index.name()
 
@@ -9,9 +9,15 @@ class SingleClient(abstract.AbstractSingleClient):
         return list(self.index.list_files())
 
     def has(self, request):
+        # NOTE: a definite miss is rejected without hashing the file
+        if not self.index.might_have(request):
+            return False
         hash = request.hash
         return self.index.has_hash(hash)
 
+    def might_have(self, request):
+        return self.index.might_have(request)
+
     def has_hash(self, hash):
         # TODO: validate valid hash?
         return self.index.has_hash(hash)
@@ -27,12 +33,15 @@ class SingleClient(abstract.AbstractSingleClient):
     def search_by_name(self, file_name):
         return list(self.index.search_by_name(file_name))
 
-    def fuzzy_search_by_name(self, file_name):
-        return list(self.index.fuzzy_search_by_name(file_name))
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        return list(self.index.fuzzy_search_by_name(file_name, limit=limit))
 
     def search_by_hash(self, hash):
         return list(self.index.search_by_hash(hash))
 
+    def search_by_hashes(self, hashes):
+        return self.index.search_by_hashes(hashes)
+
     def upload(self, request):
         return self.index.upload(request)
 
@@ -45,6 +54,9 @@ class SingleClient(abstract.AbstractSingleClient):
     def stream_range(self, root, file_id, offset, length):
         return self.index.stream_range(root, file_id, offset, length)
 
+    def scrub(self, file_id, offset, length):
+        return self.index.scrub(file_id, offset, length)
+
     def stats(self):
         files = self.list_files()
         return {"file_count": len(files)}
@@ -13,8 +13,8 @@ class SimpleSingleClient(abstract.AbstractSingleClient):
     def search_by_name(self, file_name):
         return list(self.index.search_by_name(file_name))
 
-    def fuzzy_search_by_name(self, file_name):
-        return list(self.index.fuzzy_search_by_name(file_name))
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        return list(self.index.fuzzy_search_by_name(file_name, limit=limit))
 
     def upload(self, file_path):
         return self.index.upload(file_path)
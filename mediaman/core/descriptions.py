@@ -31,6 +31,11 @@ AWS_GLACIER_DESCRIPTION = f"""\
 It is recommended that you set "cost: true" in the config for any AWS service.
 Configurable in the config.yaml file."""
 
+CHUNK_STORE_DESCRIPTION = f"""\
+[{ServiceType.CHUNK_STORE.value}] -- Backs up files to a folder or Google Drive (its "backing"), split into
+chunks so that near-identical files (re-muxed videos, edited photo libraries) share storage.
+Configurable in the config.yaml file."""
+
 
 SERVICE_TYPE_TO_DESCRIPTION = {
     ServiceType.FOLDER: LOCAL_DESCRIPTION,
@@ -38,4 +43,5 @@ SERVICE_TYPE_TO_DESCRIPTION = {
     ServiceType.DROPBOX: DROPBOX_DESCRIPTION,
     ServiceType.AWS_S3: AWS_S3_DESCRIPTION,
     ServiceType.AWS_GLACIER: AWS_GLACIER_DESCRIPTION,
+    ServiceType.CHUNK_STORE: CHUNK_STORE_DESCRIPTION,
 }
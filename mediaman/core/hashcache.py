@@ -0,0 +1,164 @@
+"""
+Persistent cache of local file hashes, consulted by `hashing.hashes`.
+
+Entries are keyed by the file's stat identity (device and inode) and the
+hash type, and are only used while the file's size and mtime are unchanged.
+The least recently used entries are evicted beyond the configured size.
+
+Setting MM_HASH_CACHE to an empty path disables the cache.
+"""
+
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from mediaman.core import logtools
+
+logger = logtools.new_logger("mediaman.core.hashcache")
+
+
+HASH_CACHE_ENV_VAR = "MM_HASH_CACHE"
+DEFAULT_HASH_CACHE_PATH = os.path.expanduser("~/.mediaman/hashes.sqlite")
+HASH_CACHE_ENTRIES_KEY = "hash-cache-entries"
+DEFAULT_HASH_CACHE_ENTRIES = 1_000_000
+
+# Eviction runs on the first insert, then once every this many inserts.
+EVICTION_INTERVAL = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hash_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (device, inode, hash_type)
+);
+CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used);
+"""
+
+CACHE = None
+DISABLED = object()
+
+
+def identity(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class HashCache:
+
+    def __init__(self, path, max_entries):
+        self.path = pathlib.Path(path).expanduser()
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.inserts = 0
+
+    def connection(self):
+        # NOTE: sqlite3 connections can't be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def get(self, stat, hash_type):
+        (device, inode, size, mtime_ns) = identity(stat)
+        with self.connection() as connection:
+            row = connection.execute(
+                "SELECT hash FROM hashes WHERE device = ? AND inode = ? AND hash_type = ? AND size = ? AND mtime_ns = ?",
+                (device, inode, hash_type, size, mtime_ns)).fetchone()
+            if row is None:
+                return None
+
+            connection.execute(
+                "UPDATE hashes SET used = ? WHERE device = ? AND inode = ? AND hash_type = ?",
+                (time.time_ns(), device, inode, hash_type))
+        return row[0]
+
+    def put(self, stat, hash_type, hash):
+        (device, inode, size, mtime_ns) = identity(stat)
+        with self.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (device, inode, hash_type, size, mtime_ns, hash, time.time_ns()))
+
+        with self.lock:
+            evict = (self.inserts % EVICTION_INTERVAL == 0)
+            self.inserts += 1
+        if evict:
+            self.evict()
+
+    def evict(self):
+        with self.connection() as connection:
+            (count,) = connection.execute("SELECT COUNT(*) FROM hashes").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                logger.debug(f"Evicting {excess} hash cache entries")
+                connection.execute(
+                    "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY used LIMIT ?)",
+                    (excess,))
+
+
+def load_cache():
+    global CACHE
+    if CACHE is None:
+        from mediaman import config
+        path = config.load(HASH_CACHE_ENV_VAR, default=DEFAULT_HASH_CACHE_PATH)
+        if not path:
+            CACHE = DISABLED
+        else:
+            CACHE = HashCache(path, int(config.load(HASH_CACHE_ENTRIES_KEY, default=DEFAULT_HASH_CACHE_ENTRIES)))
+    return None if CACHE is DISABLED else CACHE
+
+
+def store_hashes(path, stat, preferences, hashes):
+    """Caches hashes computed elsewhere, if the file is still as it was when `stat` was taken."""
+    cache = load_cache()
+    if cache is None or identity(os.stat(path)) != identity(stat):
+        return
+
+    try:
+        for (preference, hash) in zip(preferences, hashes):
+            cache.put(stat, preference.value, hash)
+    except sqlite3.Error as e:
+        logger.warning(f"Couldn't update hash cache ({e})")
+
+
+def cached_hashes(path, preferences, func):
+    """
+    Returns the hashes of the file at `path` for the given hash types,
+    as `func(path, preferences)` would.  Cached hashes are used while the
+    file hasn't changed since it was hashed; only the missing hash types
+    are passed on to `func`.
+    """
+    cache = load_cache()
+    if cache is None:
+        return func(path, preferences)
+
+    stat = os.stat(path)
+
+    try:
+        found = {preference: cache.get(stat, preference.value) for preference in preferences}
+    except sqlite3.Error as e:
+        logger.warning(f"Hash cache unavailable ({e}), hashing '{path}'")
+        return func(path, preferences)
+
+    missing = [preference for (preference, hash) in found.items() if hash is None]
+    if not missing:
+        logger.debug(f"Hash cache hit for '{path}': {found}")
+    else:
+        hashed = dict(zip(missing, func(path, missing)))
+        found.update(hashed)
+
+        # NOTE: don't cache the hash of a file that changed while being read
+        store_hashes(path, stat, list(hashed), list(hashed.values()))
+
+    return [found[preference] for preference in preferences]
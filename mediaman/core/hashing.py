@@ -1,5 +1,9 @@
 
 import enum
+import io
+import os
+
+from mediaman.core import merkle
 
 
 DELIMITER = ":"
@@ -17,6 +21,10 @@ def to_xxh64(unlabeled_hash):
     return join(Hash.XXH64.value, unlabeled_hash)
 
 
+def to_xxh3_128(unlabeled_hash):
+    return join(Hash.XXH3_128.value, unlabeled_hash)
+
+
 # def is_sha256(labeled_hash):
 #     return labeled_hash.startswith(label) and labeled_hash
 
@@ -24,63 +32,288 @@ def to_xxh64(unlabeled_hash):
 class Hash(enum.Enum):
     SHA256 = "sha256"
     XXH64 = "xxh64"
+    XXH3_128 = "xxh3_128"
 
 
-def sha256(path, buffer=8192):
+def read_chunks(infile, buffer=1024**2):
     """
-    Hashes the contents of the given filepath in chunks.
-    Returns a hex digest (0-9a-f) of the SHA256 hash.
-    Performance on a Macbook Pro is about 384 MB/s.
+    Yields the contents of a binary file as chunks, read with `readinto`
+    into a single reusable buffer (no allocation per chunk).
+
+    NOTE: each chunk is a view of that buffer, valid only until the next
+          chunk is read.
     """
-    import hashlib
+    data = bytearray(buffer)
+    view = memoryview(data)
+    while True:
+        count = infile.readinto(data)
+        if not count:
+            return
+        yield view[:count]
 
-    sha = hashlib.sha256()
 
-    with open(path, "rb") as infile:
-        data = infile.read(buffer)
-        while data:
-            sha.update(data)
-            data = infile.read(buffer)
+def hash_file(path, hasher, buffer):
+    with open(path, "rb", buffering=0) as infile:
+        for chunk in read_chunks(infile, buffer):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
-    return to_sha256(sha.hexdigest())
+
+def sha256(path, buffer=1024**2):
+    """
+    Hashes the contents of the given filepath in chunks.
+    Returns a hex digest (0-9a-f) of the SHA256 hash.
+    Performance on a Macbook Pro is about 384 MB/s (see `benchmarks.hashing`).
+    """
+    return to_sha256(hash_file(path, new_sha256(), buffer))
 
 
 def xxh64(path, buffer=1024**2):
     """
     Hashes the contents of the given filepath in chunks.
     Returns a hex digest (0-9a-f) of the xxh64 hash.
-    Performance on a Macbook Pro is about 4.20 GB/s.
+    Performance on a Macbook Pro is about 4.20 GB/s (see `benchmarks.hashing`).
     """
-    import xxhash
-    import sys
+    return to_xxh64(hash_file(path, new_xxh64(), buffer))
+
+
+def xxh3_128(path, buffer=1024**2):
+    """
+    Hashes the contents of the given filepath in chunks.
+    Returns a hex digest (0-9a-f) of the 128-bit XXH3 hash,
+    which is faster than xxh64 on modern CPUs (requires xxhash >= 2.0).
+    """
+    return to_xxh3_128(hash_file(path, new_xxh3_128(), buffer))
 
-    xxh64 = xxhash.xxh64(seed=0)
-    read = 0
 
-    with open(path, "rb") as infile:
-        data = infile.read(buffer)
-        read += buffer
-        while data:
-            # sys.stdout.write(f"\rHashed {read / 1024**3:.2f} GiB...")
-            # sys.stdout.flush()
-            xxh64.update(data)
-            data = infile.read(buffer)
-            read += buffer
+def new_sha256():
+    import hashlib
+    return hashlib.sha256()
 
-    return to_xxh64(xxh64.hexdigest())
+
+def new_xxh64():
+    import xxhash
+    return xxhash.xxh64(seed=0)
+
+
+def new_xxh3_128():
+    import xxhash
+    return xxhash.xxh3_128(seed=0)
 
 
 PREFERRED_HASH = Hash.XXH64
 
+# Additional hash types recorded for every uploaded file, e.g. [sha256]
+RECORDED_HASHES_KEY = "recorded-hashes"
+
 HASH_FUNCTIONS = {
     Hash.SHA256: sha256,
     Hash.XXH64: xxh64,
+    Hash.XXH3_128: xxh3_128,
+}
+
+HASHER_FACTORIES = {
+    Hash.SHA256: new_sha256,
+    Hash.XXH64: new_xxh64,
+    Hash.XXH3_128: new_xxh3_128,
 }
 
 
+def recorded_hashes():
+    """The hash types recorded for each file; the preferred hash comes first."""
+    from mediaman import config
+    labels = config.load(RECORDED_HASHES_KEY, default=[])
+    if isinstance(labels, str):
+        labels = labels.split(",")
+    return list(dict.fromkeys([PREFERRED_HASH] + [Hash(label.strip()) for label in labels]))
+
+
+def hash_many(path, preferences, buffer=1024**2):
+    """
+    Hashes the contents of the given filepath with each of the given hash
+    types, reading the file only once.
+    Returns the labeled hashes, in the given order.
+    """
+    with open(path, "rb", buffering=0) as infile:
+        return hash_stream_many(read_chunks(infile, buffer), preferences)
+
+
 def hash(path, preference=None):
-    func = HASH_FUNCTIONS[preference or PREFERRED_HASH]
-    return func(path)
+    return hashes(path, [preference or PREFERRED_HASH])[0]
+
+
+def hashes(path, preferences=None):
+    """
+    Returns the labeled hashes of the given filepath for each of the given
+    hash types (default: the recorded hashes), from a single read.
+    """
+    from mediaman.core import hashcache
+    return hashcache.cached_hashes(path, preferences or recorded_hashes(), hash_many)
+
+
+def hash_stream(chunks, preference=None):
+    """
+    Hashes an iterable of byte chunks (e.g. from `service.stream`),
+    so that remote files can be hashed without a local copy.
+    """
+    return hash_stream_many(chunks, [preference or PREFERRED_HASH])[0]
+
+
+def hash_stream_many(chunks, preferences):
+    hashers = [HASHER_FACTORIES[preference]() for preference in preferences]
+    for chunk in chunks:
+        for hasher in hashers:
+            hasher.update(chunk)
+    return [join(preference.value, hasher.hexdigest()) for (preference, hasher) in zip(preferences, hashers)]
+
+
+class HashingFile(io.RawIOBase):
+    """
+    A read-only binary file that hashes its contents as they're read, so a
+    file can be hashed while it's being uploaded rather than in a separate
+    pass.
+
+    Bytes are hashed in file order; reads that revisit already-hashed bytes
+    (e.g. retried upload chunks) are ignored.  If a read skips ahead, the
+    hashes can't be completed, and `hashes()` returns None.
+    """
+
+    def __init__(self, path, preferences, block_digests=True):
+        super().__init__()
+        self.path = path
+        self.infile = open(path, "rb", buffering=0)
+        self.stat = os.fstat(self.infile.fileno())
+        self.preferences = preferences
+        self.hashers = [HASHER_FACTORIES[preference]() for preference in preferences]
+        self.fingerprint_ranges = fingerprint_ranges(self.stat.st_size)
+        self.fingerprinter = new_xxh64()
+        self.block_hasher = merkle.BlockHasher() if block_digests else None
+        self.hashed = 0
+        self.skipped = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.infile.seek(offset, whence)
+
+    def tell(self):
+        return self.infile.tell()
+
+    def readinto(self, buffer):
+        position = self.infile.tell()
+        count = self.infile.readinto(buffer)
+        if count:
+            self.update(position, memoryview(buffer)[:count])
+        return count
+
+    def update(self, position, data):
+        if position > self.hashed:
+            self.skipped = True
+        if self.skipped or position + len(data) <= self.hashed:
+            return
+
+        data = data[self.hashed - position:]
+        for hasher in self.hashers:
+            hasher.update(data)
+        for (offset, length) in self.fingerprint_ranges:
+            start = max(offset, self.hashed)
+            end = min(offset + length, self.hashed + len(data))
+            if start < end:
+                self.fingerprinter.update(data[start - self.hashed:end - self.hashed])
+        if self.block_hasher is not None:
+            self.block_hasher.update(data)
+        self.hashed += len(data)
+
+    def close(self):
+        self.infile.close()
+        super().close()
+
+    def complete(self):
+        return not self.skipped and self.hashed == self.stat.st_size
+
+    def fingerprint(self):
+        """The file's fingerprint, if every byte of the file was read (else None)."""
+        if not self.complete():
+            return None
+        return join(str(self.stat.st_size), self.fingerprinter.hexdigest())
+
+    def block_digests(self):
+        """The file's Merkle leaves (see `merkle`), if every byte of the file was read (else None)."""
+        if not self.complete() or self.block_hasher is None:
+            return None
+        return self.block_hasher.digests()
+
+    def hashes(self):
+        """The labeled hashes, if every byte of the file was read (else None)."""
+        if not self.complete():
+            return None
+
+        from mediaman.core import hashcache
+        hashes = [join(preference.value, hasher.hexdigest()) for (preference, hasher) in zip(self.preferences, self.hashers)]
+        hashcache.store_hashes(self.path, self.stat, self.preferences, hashes)
+        return hashes
+
+
+# Fingerprints sample this much from the start, middle and end of a file.
+FINGERPRINT_SAMPLE = 1024**2
+
+
+def fingerprint_ranges(size, sample=FINGERPRINT_SAMPLE):
+    """The (offset, length) ranges of a file of this size covered by its fingerprint."""
+    if size <= 3 * sample:
+        return [(0, size)]
+    return [(0, sample), ((size - sample) // 2, sample), (size - sample, sample)]
+
+
+def fingerprint_chunks(size, chunks):
+    """
+    Returns the fingerprint of a file of the given size, from an iterable
+    of the byte chunks in its `fingerprint_ranges` (in order).
+    """
+    hasher = new_xxh64()
+    for chunk in chunks:
+        hasher.update(chunk)
+    return join(str(size), hasher.hexdigest())
+
+
+def fingerprint(path):
+    """
+    A cheap secondary key for the given filepath: its size, plus the xxh64
+    of its first, middle and last FINGERPRINT_SAMPLE bytes.
+
+    Files with different fingerprints are certainly different, so a
+    fingerprint miss rules out a file without hashing all of it.
+    """
+    with open(path, "rb", buffering=0) as infile:
+        size = os.fstat(infile.fileno()).st_size
+        data = bytearray(FINGERPRINT_SAMPLE)
+        view = memoryview(data)
+
+        def chunks():
+            for (offset, length) in fingerprint_ranges(size):
+                infile.seek(offset)
+                remaining = length
+                while remaining:
+                    count = infile.readinto(view[:min(remaining, len(data))])
+                    if not count:
+                        return
+                    yield view[:count]
+                    remaining -= count
+
+        return fingerprint_chunks(size, chunks())
+
+
+def fingerprint_size(fingerprint):
+    return int(fingerprint.split(DELIMITER)[0])
+
+
+def has_hash_type(labeled_hashes, preference=None):
+    label = (preference or PREFERRED_HASH).value
+    return any(hash.split(DELIMITER)[0] == label for hash in labeled_hashes)
 
 
 def is_preferred_hash(labeled_hash):
@@ -0,0 +1,133 @@
+"""
+Parallel hashing of local files, ahead of `has` / `upload`.
+
+Files are hashed on a thread pool; hashlib and xxhash release the GIL while
+hashing, so this scales across cores without the cost of a process pool.
+"""
+
+import collections
+import concurrent.futures
+import os
+
+from mediaman.core import logtools
+
+logger = logtools.new_logger("mediaman.core.hashpool")
+
+
+HASH_WORKERS_KEY = "hash-workers"
+HASH_WORKERS_PER_DEVICE_KEY = "hash-workers-per-device"
+
+# Concurrent readers on a single spinning disk mostly cause seeks.
+DEFAULT_HASH_WORKERS_PER_DEVICE = 2
+
+
+def device_of(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+# Requests read ahead of the results being consumed, per worker
+WINDOW_PER_WORKER = 2
+
+# What a scheduled request is waiting on
+FINGERPRINT = "fingerprint"
+HASH = "hash"
+
+
+def compute_fingerprint(request):
+    return request.fingerprint
+
+
+def compute_hash(request):
+    return request.hashes
+
+
+def hash_requests(requests, workers=None, per_device=None, skip=None):
+    """
+    Hashes the given requests' files, yielding each request as soon as its
+    hash is ready (i.e. in completion order, not in the given order).
+    Requests for which `skip(request)` is true are yielded unhashed.
+
+    At most `workers` files are read at once, and at most `per_device` of
+    those from the same device.  Requests are only taken from `requests` as
+    results are consumed, so no more than `WINDOW_PER_WORKER * workers` are
+    ever waiting.
+
+    NOTE: `skip` usually asks an index about the request's fingerprint, so
+          the fingerprint is read on the pool (under the same limits), and
+          `skip` itself is called from this thread, as indexes aren't
+          thread-safe (e.g. a SQLite connection).
+    """
+    from mediaman import config
+    workers = workers or int(config.load(HASH_WORKERS_KEY, default=os.cpu_count() or 1))
+    per_device = per_device or int(config.load(HASH_WORKERS_PER_DEVICE_KEY, default=DEFAULT_HASH_WORKERS_PER_DEVICE))
+    window = WINDOW_PER_WORKER * workers
+
+    requests = iter(requests)
+    exhausted = False
+    waiting = 0  # requests taken, but not yet yielded
+    queues = collections.OrderedDict()  # device: deque((stage, request))
+    active = collections.Counter()  # device: reads in flight
+    futures = {}  # future: (device, stage, request)
+
+    def enqueue(device, stage, request, first=False):
+        queue = queues.setdefault(device, collections.deque())
+        if first:
+            queue.appendleft((stage, request))
+        else:
+            queue.append((stage, request))
+
+    def schedule(executor):
+        # round-robin over the devices with spare capacity
+        scheduled = True
+        while scheduled and len(futures) < workers:
+            scheduled = False
+            for device in list(queues):
+                if len(futures) >= workers:
+                    break
+                if active[device] >= per_device:
+                    continue
+
+                (stage, request) = queues[device].popleft()
+                if not queues[device]:
+                    del queues[device]
+
+                job = compute_fingerprint if stage == FINGERPRINT else compute_hash
+                futures[executor.submit(job, request)] = (device, stage, request)
+                active[device] += 1
+                scheduled = True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while not exhausted and waiting < window:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                elif request.is_hashed:
+                    yield request
+                else:
+                    enqueue(device_of(request.path), HASH if skip is None else FINGERPRINT, request)
+                    waiting += 1
+
+            if not (queues or futures):
+                break
+            schedule(executor)
+
+            (done, _) = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (device, stage, request) = futures.pop(future)
+                active[device] -= 1
+
+                exception = future.exception()
+                if exception is not None:
+                    # NOTE: the request is read (and fails) again downstream
+                    logger.debug(f"Failed to {stage} {request}: {exception}")
+                elif stage == FINGERPRINT and not skip(request):
+                    # NOTE: ahead of newer requests, to finish what's started
+                    enqueue(device, HASH, request, first=True)
+                    continue
+
+                waiting -= 1
+                yield request
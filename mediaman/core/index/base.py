@@ -1,11 +1,644 @@
+import concurrent.futures
+import json
+import os
+import pathlib
+import tempfile
 
+from mediaman.core import hashing
+from mediaman.core import logtools
+from mediaman.core import merkle
+from mediaman.core import models
+from mediaman.core import settings
 from mediaman.core.index import abstract
 
+logger = logtools.new_logger("mediaman.core.index.base")
+
+
+REFRESH_WORKERS_KEY = "refresh-workers"
+DEFAULT_REFRESH_WORKERS = 4
+
+# Storing each file's Merkle sidecar as it's put costs a sha256 of every
+# block, and one more object (and upload) per file; without it, `refresh`
+# stores the sidecars instead, and range reads are unverified until then.
+MERKLE_ON_PUT_KEY = "merkle-on-put"
+DEFAULT_MERKLE_ON_PUT = True
+
+# Hashes found by `refresh_hashes` are committed in batches of this many files.
+REFRESH_COMMIT_INTERVAL = 100
+
+
+MERKLE_SUFFIX = ".merkle"
+
+ERROR_MULTIPLE_REMOTE_JOURNALS = "\
+[!] Multiple index journal files named '{}' found for service ({})!  \
+This must be resolved manually.  Exiting..."
+
+# The journal is folded into a new snapshot once it holds this many records.
+JOURNAL_COMPACTION_THRESHOLD = 1000
+
+# ... or once it's spread over this many segments (one per flush), since a
+# cold load downloads each segment separately.  Unbatched writes flush one
+# record each, so this is what usually triggers compaction: at ~300 bytes a
+# record, 100 single-record segments cost ~30 KB of uploads in total, where
+# rewriting the whole journal on every flush would cost ~1.5 MB.
+JOURNAL_SEGMENT_LIMIT = 100
+
+
+def create_file(id, name, sid, size, hashes, merged_hashes, fingerprint, merkle_root, merkle_sid, crypt):
+    assert isinstance(hashes, list)
+    assert isinstance(merged_hashes, list)
+    return {
+        "id": id,
+        "name": name,
+        "sid": sid,
+        "size": size,
+        "hashes": hashes,
+        "merged_hashes": merged_hashes,
+        "fingerprint": fingerprint,
+        "merkle_root": merkle_root,
+        "merkle_sid": merkle_sid,
+        "crypt": crypt,
+    }
+
+
+def create_journal_header(sequence):
+    return {
+        "version": settings.VERSION,
+        "sequence": sequence,
+    }
+
+
+def create_journal_record(sequence, op, key, **fields):
+    return {
+        "seq": sequence,
+        "op": op,
+        "key": key,
+        **fields,
+    }
+
+
+def segment_number(name, journal_name):
+    """
+    The last sequence number held by the named journal segment, 0 for the
+    (pre-segment) single journal file, or None if it's not a journal at all.
+    """
+    if name == journal_name:
+        return 0
+
+    (prefix, _, number) = name.rpartition(".")
+    if prefix != journal_name or not number.isdigit():
+        return None
+    return int(number)
+
 
 class BaseIndex(abstract.AbstractIndex):
+    """
+    Index behaviour shared by every storage backend.
+
+    Subclasses provide the lookups (`has_hash`, `get_metadata_by_hash`,
+    `has_uuid`, `get_metadata_by_uuid`, `search_by_name`), `new_id`,
+    `track_file`, `add_file_hashes`, `add_file_fingerprint`,
+    `add_file_merkle` and `add_file_crypt`.
+
+    Backends storing their metadata as text files with the service use
+    `upload_text` and `download_text`, which go through `self.cache`.
+    Backends journaling their mutations between snapshots store the
+    journal as append-only segments ("<journal>.<last seq>", see
+    `upload_segment` and `read_journal`).
+
+    Each file's Merkle leaves (see `merkle`) are stored with the service as
+    a sidecar ("<id>.merkle"), and its root in the index, so that ranges
+    can be verified as they're streamed (see `stream_range` and `scrub`).
+    Sidecars are stored as files are put, unless MERKLE_ON_PUT_KEY is off,
+    in which case `refresh` stores them.
+
+    Each file's cipher params (see `middleware.crypto`) are recorded as its
+    "crypt" field, and passed back down with every request for it.
+    """
 
     def stats(self):
         return self.stats.capacity()
 
     def capacity(self):
         return self.service.capacity()
+
+    def upload_text(self, name, text):
+        with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
+            tempfile_ref.write(text)
+            tempfile_ref.seek(0)
+
+            request = models.Request(
+                id=name,
+                path=tempfile_ref.name,
+            )
+            receipt = self.service.upload(request)
+
+            # NOTE: the remote copy now matches ours, so cache it as-is
+            validator = self.service.list_file(receipt.id()).validator()
+            self.cache.store(name, validator, tempfile_ref.name)
+
+        return receipt
+
+    def upload_bytes(self, name, data):
+        with tempfile.NamedTemporaryFile("wb", delete=True) as tempfile_ref:
+            tempfile_ref.write(data)
+            tempfile_ref.flush()
+
+            request = models.Request(
+                id=name,
+                path=tempfile_ref.name,
+            )
+            return self.service.upload(request)
+
+    def cache_bytes(self, name, validator, data):
+        with tempfile.NamedTemporaryFile("wb", delete=True) as tempfile_ref:
+            tempfile_ref.write(data)
+            tempfile_ref.flush()
+            self.cache.store(name, validator, tempfile_ref.name)
+
+    def download_text(self, file, name):
+        """
+        Returns the contents of the given remote metadata file, from the
+        local cache when the remote copy hasn't changed since.
+        """
+        validator = file.validator()
+        cached_path = self.cache.load(name, validator)
+        if cached_path is not None:
+            return cached_path.read_text()
+
+        with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
+            request = models.Request(
+                id=file.id(),
+                path=tempfile_ref.name,
+            )
+
+            self.service.download(request)
+            self.cache.store(name, validator, tempfile_ref.name)
+
+            # NOTE: downloads may replace the file, rather than write to it
+            with open(tempfile_ref.name) as infile:
+                return infile.read()
+
+    def find_segments(self, journal_name):
+        """Returns the remote journal segments, in replay order."""
+        segments = {}
+        for file in self.service.search_by_prefix(journal_name).results():
+            name = file.name()
+            if segment_number(name, journal_name) is None:
+                continue
+            if name in segments:
+                raise RuntimeError(ERROR_MULTIPLE_REMOTE_JOURNALS.format(name, self.service))
+            segments[name] = file
+
+        logger.debug(f"remote journal segments: {list(segments)}")
+        return [segments[name] for name in sorted(segments, key=lambda name: segment_number(name, journal_name))]
+
+    def read_journal(self, segments, journal_name, sequence):
+        """
+        Yields the (journal version, record) of every journal record after
+        `sequence`, in order.  Stops at the first segment that can't be read
+        (e.g. a partial write) or that doesn't continue the sequence (e.g. a
+        lost segment), setting `self.journal_damaged`, so that the next
+        write compacts the journal.
+        """
+        self.journal_damaged = False
+        for segment in segments:
+            name = segment.name()
+
+            # NOTE: segments up to the snapshot's sequence were already folded
+            #       in (e.g. compaction was interrupted before deleting them)
+            number = segment_number(name, journal_name)
+            if 0 < number <= sequence:
+                continue
+
+            try:
+                (header, *lines) = self.download_text(segment, name).splitlines()
+                version = json.loads(header)["version"]
+                records = [json.loads(line) for line in lines]
+            except (RuntimeError, ValueError, KeyError) as e:
+                logger.warning(f"Index journal segment '{name}' is unreadable ({e}), ignoring the rest of the journal")
+                self.journal_damaged = True
+                return
+
+            for record in records:
+                if record["seq"] <= sequence:
+                    continue
+                if record["seq"] != sequence + 1:
+                    logger.warning(f"Index journal skips from record {sequence} to {record['seq']} in '{name}', ignoring the rest of the journal")
+                    self.journal_damaged = True
+                    return
+                yield (version, record)
+                sequence = record["seq"]
+
+    def upload_segment(self, journal_name, snapshot_sequence, sequence, lines):
+        """Uploads journal records (up to `sequence`) as a new segment, returning its (name, id)."""
+        name = f"{journal_name}.{sequence}"
+        header = json.dumps(create_journal_header(snapshot_sequence))
+        receipt = self.upload_text(name, "\n".join([header] + lines))
+
+        logger.debug(f"upload_segment receipt: {receipt}")
+        return (name, receipt.id())
+
+    def remove_segments(self, segments):
+        """Deletes the given (name, id) journal segments, once a snapshot holds their records."""
+        # NOTE: if this is interrupted, the snapshot's sequence number marks
+        #       the remaining segments as already folded in
+        for (name, sid) in segments:
+            self.service.remove(sid)
+            self.cache.discard(name)
+
+    def has_size(self, size):
+        """Whether any indexed file might have this size (True if unknown)."""
+        return True
+
+    def has_fingerprint(self, fingerprint):
+        """
+        Whether any indexed file might have this fingerprint (True if
+        unknown), i.e. a file with this fingerprint, or a file of the same
+        size that hasn't been fingerprinted yet.
+        """
+        return True
+
+    def might_have(self, request):
+        """
+        Quick prefilter before hashing: False only if the request's file
+        can't be indexed yet (no indexed file has the same size, or the
+        same fingerprint).
+        """
+        if request.is_hashed or request.path is None:
+            return True
+        if not self.has_size(os.stat(request.path).st_size):
+            return False
+        return self.has_fingerprint(request.fingerprint)
+
+    def upload(self, request):
+        name = pathlib.Path(request.path).name
+        size = os.stat(request.path).st_size
+
+        # NOTE: a file that can't be indexed yet is uploaded optimistically,
+        #       hashing it as it's uploaded instead of reading it twice
+        optimistic = not self.might_have(request)
+        if not optimistic:
+            hashes = list(dict.fromkeys([request.hash] + request.hashes))
+            for known_hash in hashes:
+                if self.has_hash(known_hash):
+                    logger.info(f"[-] (File already indexed: {request.path})")
+                    return self.get_metadata_by_hash(known_hash)
+
+        from mediaman import config
+        merkle_on_put = config.load(MERKLE_ON_PUT_KEY, default=DEFAULT_MERKLE_ON_PUT)
+
+        # NOTE: the Merkle leaves (and any unknown hashes) come from the upload's read
+        upload_request = models.Request(
+            id=self.new_id(),
+            path=request.path,
+            tee_hashes=True,
+            tee_block_digests=merkle_on_put,
+        )
+        if not optimistic:
+            upload_request.hashes = hashes
+
+        logger.info(f"Uploading '{request}' as '{upload_request}' ...")
+        receipt = self.service.upload(upload_request)
+
+        if optimistic:
+            request.hashes = upload_request.hashes
+            hashes = request.hashes
+            fingerprint = upload_request.fingerprint
+        else:
+            fingerprint = request.fingerprint
+
+        (merkle_root, merkle_sid) = (None, None)
+        if merkle_on_put:
+            (merkle_root, merkle_sid) = self.store_merkle(upload_request.id, size, upload_request.block_digests)
+
+        hash = hashes[0]
+        merged_hashes = []
+
+        self.track_file(create_file(
+            upload_request.id,
+            name,
+            receipt.id(),
+            size,
+            hashes,
+            merged_hashes,
+            fingerprint,
+            merkle_root,
+            merkle_sid,
+            upload_request.crypt,
+        ))
+
+        return self.get_metadata_by_hash(hash)
+
+    def store_merkle(self, id, size, leaves):
+        """Stores the Merkle sidecar of a file, returning its (root, sid)."""
+        root = merkle.root(leaves)
+        data = merkle.encode(size, leaves)
+        receipt = self.upload_bytes(f"{id}{MERKLE_SUFFIX}", data)
+
+        # NOTE: sidecars never change, so the root is their validator
+        self.cache_bytes(f"{id}{MERKLE_SUFFIX}", root, data)
+
+        return (root, receipt.id())
+
+    def load_merkle(self, file):
+        """Returns the (block size, leaves) of a file, checked against its root."""
+        name = f"{file['id']}{MERKLE_SUFFIX}"
+        cached_path = self.cache.load(name, file["merkle_root"])
+        if cached_path is not None:
+            data = cached_path.read_bytes()
+        else:
+            data = b"".join(self.service.stream(models.Request(id=file["merkle_sid"])))
+
+        (block_size, size, leaves) = merkle.decode(data, file["merkle_root"])
+        if size != file["size"]:
+            logger.critical(f"Merkle sidecar of {file['id']} is for a different file!")
+            raise RuntimeError("Corrupt Merkle sidecar")
+
+        if cached_path is None:
+            self.cache_bytes(name, file["merkle_root"], data)
+
+        return (block_size, leaves)
+
+    def remove_merkle(self, file):
+        if file.get("merkle_sid") is None:
+            return
+        self.service.remove(file["merkle_sid"])
+        self.cache.discard(f"{file['id']}{MERKLE_SUFFIX}")
+
+    def stream_hashes(self, pending_file, block_hasher=None):
+        """Returns the missing hashes of a file, and its (plaintext) size, from a single read."""
+        (file, preferences) = pending_file
+        size = 0
+
+        def chunks():
+            nonlocal size
+            for chunk in self.service.stream(models.Request(id=file["sid"], crypt=file.get("crypt"))):
+                size += len(chunk)
+                if block_hasher is not None:
+                    block_hasher.update(chunk)
+                yield chunk
+
+        hashes = hashing.hash_stream_many(chunks(), preferences)
+        return (hashes, size)
+
+    def stream_fingerprint(self, file, size):
+        """
+        Returns the fingerprint of a file of the given (plaintext) size, or
+        None if the file doesn't end there.
+        """
+        request = models.Request(id=file["sid"], crypt=file.get("crypt"))
+        samples = []
+        for (offset, length) in hashing.fingerprint_ranges(size):
+            # NOTE: one byte past the end, to check the file really ends there
+            extra = 1 if offset + length == size else 0
+            sample = b"".join(self.service.stream_range(request, offset, length + extra))
+            if len(sample) != length:
+                return None
+            samples.append(sample)
+        return hashing.fingerprint_chunks(size, samples)
+
+    def stream_digests(self, pending_file):
+        """
+        Returns the missing (hashes, fingerprint, Merkle leaves) of a file,
+        and its size as streamed.  Fingerprints and leaves are only ever
+        built from that size: if it isn't the recorded one (None if unknown),
+        the file is streamed in full, and both are rebuilt.
+        """
+        (file, preferences) = pending_file
+        size = file["size"]
+        fingerprint = file.get("fingerprint")
+        if fingerprint is None and size is not None:
+            fingerprint = self.stream_fingerprint(file, size)
+
+        hashes = []
+        leaves = None
+        if file.get("merkle_root") is None or preferences or fingerprint is None:
+            block_hasher = merkle.BlockHasher()
+            (hashes, size) = self.stream_hashes(pending_file, block_hasher)
+            if file.get("merkle_root") is None or size != file["size"]:
+                leaves = block_hasher.digests()
+            if fingerprint is None or size != file["size"]:
+                fingerprint = self.stream_fingerprint(file, size)
+
+        return (hashes, fingerprint, leaves, size)
+
+    def listed_sizes(self):
+        """The size of each of the service's (raw) files, by sid."""
+        return {listed.id(): listed.size() for listed in self.service.list_files().results()}
+
+    def refresh_hashes(self):
+        """
+        Adds the recorded hashes (see `hashing.recorded_hashes`), the
+        fingerprint and the Merkle sidecar to every file missing any of them.
+
+        Files are hashed straight from `service.stream` (never written to
+        disk), once for all missing hash types and Merkle leaves, several at
+        a time on a bounded thread pool; fingerprints only need
+        `service.stream_range`.
+        Results are committed every REFRESH_COMMIT_INTERVAL files, and
+        complete files are skipped, so an interrupted refresh resumes where
+        it stopped.
+
+        NOTE: an encrypted file recorded with its ciphertext's size (as an
+              older `refresh_file_list` did) has the wrong fingerprint and
+              sidecar too, so it's rehashed in full, and all three rebuilt.
+        """
+        from mediaman import config
+        workers = int(config.load(REFRESH_WORKERS_KEY, default=DEFAULT_REFRESH_WORKERS))
+        recorded_hashes = hashing.recorded_hashes()
+        listed_sizes = self.listed_sizes()
+
+        pending = []  # [(file, [missing hash type])]
+        for file in self.list_files():
+            missing = [preference for preference in recorded_hashes if not hashing.has_hash_type(file["hashes"], preference)]
+            if file.get("crypt") and listed_sizes.get(file["sid"]) == file["size"]:
+                logger.warning(f"Recorded size of {file['id']} is its ciphertext's, rebuilding its fingerprint and sidecar")
+                file = {**file, "size": None, "fingerprint": None, "merkle_root": None}
+            elif not missing and file.get("fingerprint") is not None and file.get("merkle_root") is not None:
+                logger.debug(f"Recorded hashes already present for: {file}")
+                continue
+            pending.append((file, missing))
+
+        logger.info(f"Refreshing hashes of {len(pending)} files ({workers} at a time)...")
+
+        # NOTE: on an exception, the pending (not yet started) hashes of the
+        #       current chunk are cancelled when `executor.map` is closed.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(pending), REFRESH_COMMIT_INTERVAL):
+                chunk = pending[start:start + REFRESH_COMMIT_INTERVAL]
+                with self.batch():
+                    for ((file, _), (hashes, fingerprint, leaves, size)) in zip(chunk, executor.map(self.stream_digests, chunk)):
+                        logger.debug(f"Hashes of {file}: {hashes} (fingerprint: {fingerprint}, size: {size})")
+                        if size != file["size"]:
+                            logger.warning(f"Size of {file['id']} was recorded as {file['size']}, but is {size}")
+                            self.add_file_size(file, size)
+                        if hashes:
+                            self.add_file_hashes(file, hashes)
+                        if fingerprint != file.get("fingerprint"):
+                            self.add_file_fingerprint(file, fingerprint)
+                        if leaves is not None:
+                            # NOTE: replacing a sidecar built from the wrong size, if any
+                            self.remove_merkle(file)
+                            (merkle_root, merkle_sid) = self.store_merkle(file["id"], size, leaves)
+                            self.add_file_merkle(file, merkle_root, merkle_sid)
+
+                logger.info(f"Updated hashes for {start + len(chunk)}/{len(pending)} files")
+
+    def refresh_ciphers(self):
+        """
+        Records the cipher params of every file missing them, from the
+        service's old "crypt" file (see `crypto.legacy_ciphers`); files it
+        doesn't list aren't encrypted.  The crypt file is deleted once the
+        index holds them all, so this only reads it once.
+        """
+        files = [file for file in self.list_files() if file.get("crypt") is None]
+        if not files:
+            return
+
+        ciphers = self.service.legacy_ciphers({file["sid"] for file in files})
+
+        with self.batch():
+            for file in files:
+                self.add_file_crypt(file, ciphers.get(file["sid"], {}))
+
+        self.service.remove_legacy_ciphers()
+
+    def resolve(self, identifier):
+        """
+        Returns the metadata for the given uuid, hash or name.
+        Returns None if nothing matches, or False if the name is ambiguous.
+        """
+        if self.has_uuid(identifier):
+            return self.get_metadata_by_uuid(identifier)
+        elif self.has_hash(identifier):
+            return self.get_metadata_by_hash(identifier)
+
+        metadatas = self.search_by_name(identifier)
+        if not metadatas:
+            logger.error("[-] No such file found!")
+            return None
+        elif len(metadatas) > 1:
+            logger.error("[-] Multiple files exist with that name!  Pass the hash or ID instead.")
+            return False
+        return metadatas[0]
+
+    def download(self, root, identifier):
+        logger.debug(f"Download request for: '{identifier}' to '{root}'...")
+
+        metadata = self.resolve(identifier)
+        if not metadata:
+            return metadata
+
+        request = models.Request(
+            id=metadata["sid"],
+            path=root / metadata["name"],
+            crypt=metadata.get("crypt"),
+        )
+        return self.service.download(request)
+
+    def stream(self, root, identifier):
+        logger.debug(f"Stream request for: '{identifier}' to '{root}'...")
+
+        metadata = self.resolve(identifier)
+        if not metadata:
+            return metadata
+
+        request = models.Request(
+            id=metadata["sid"],
+            path=root / metadata["name"],
+            crypt=metadata.get("crypt"),
+        )
+        return self.service.stream(request)
+
+    def stream_range(self, root, identifier, offset, length):
+        """
+        Streams `length` bytes (or to the end, if negative) from `offset` of
+        the file, verifying each block they cover against the file's Merkle
+        sidecar before any of its bytes are returned.
+        """
+        logger.debug(f"Stream request for: '{identifier}' to '{root}'...")
+
+        metadata = self.resolve(identifier)
+        if not metadata:
+            return metadata
+
+        # NOTE: normalized once, so both paths agree on where the range ends
+        if length < 0:
+            length = max(metadata["size"] - offset, 0)
+
+        if metadata.get("merkle_root") is None:
+            logger.warning(f"No Merkle sidecar for {metadata['id']} (run `refresh`), streaming unverified")
+            request = models.Request(
+                id=metadata["sid"],
+                path=root / metadata["name"],
+                crypt=metadata.get("crypt"),
+            )
+            return self.service.stream_range(request, offset, length)
+
+        return self.stream_verified_range(metadata, offset, length)
+
+    def stream_blocks(self, file, offset, length):
+        """
+        Yields the (offset, bytes, verified) blocks of the file covering the
+        given range, each checked against the file's Merkle sidecar.
+        """
+        (block_size, leaves) = self.load_merkle(file)
+        (first, last) = merkle.block_span(file["size"], offset, length, block_size)
+        last = min(last, len(leaves))
+
+        request = models.Request(id=file["sid"], crypt=file.get("crypt"))
+        number = first
+        while number < last:
+            blocks = merkle.blocks(self.service.stream_range(request, number * block_size, (last - number) * block_size), block_size)
+            try:
+                for number in range(number, last):
+                    # NOTE: blocks missing from a truncated file can't verify either
+                    block = next(blocks, b"")
+                    yield (number * block_size, block, merkle.verify_block(leaves, number, block))
+                return
+            except RuntimeError:
+                # NOTE: authenticated ciphertext (see `middleware.gcm`) fails to
+                #       decrypt where it's corrupt, so that block can't verify,
+                #       and the rest are read again after it
+                logger.warning(f"Block at {number * block_size} of {file['id']} couldn't be read")
+                yield (number * block_size, b"", False)
+                number += 1
+
+    def stream_verified_range(self, file, offset, length):
+        end = offset + length
+        for (start, block, verified) in self.stream_blocks(file, offset, length):
+            if not verified:
+                logger.critical(f"Block at {start} of {file['id']} doesn't match its Merkle leaf!")
+                raise RuntimeError("Corrupt file")
+            yield block[max(offset - start, 0):end - start]
+
+    def scrub(self, identifier, offset=0, length=-1):
+        """
+        Verifies `length` bytes (or to the end, if negative) from `offset` of
+        the file against its Merkle sidecar, reading only the blocks they
+        cover.  Returns the offsets of any corrupt blocks.
+        """
+        logger.debug(f"Scrub request for: '{identifier}'...")
+
+        metadata = self.resolve(identifier)
+        if not metadata:
+            return metadata
+
+        if metadata.get("merkle_root") is None:
+            logger.error(f"[-] No Merkle sidecar for {metadata['id']}!  Run `refresh` to add one.")
+            return None
+
+        if length < 0:
+            length = max(metadata["size"] - offset, 0)
+
+        corrupt = [start for (start, _block, verified) in self.stream_blocks(metadata, offset, length) if not verified]
+        if corrupt:
+            logger.error(f"[-] Corrupt blocks in {metadata['id']} at: {corrupt}")
+
+        return {
+            "id": metadata["id"],
+            "offset": offset,
+            "length": length,
+            "corrupt": corrupt,
+        }
@@ -0,0 +1,240 @@
+"""
+Compact binary encoding of the index, readable through `mmap`.
+
+Layout (little-endian):
+
+    header      magic, format version, metadata version, sequence,
+                record count, digest table count
+    directory   one entry per digest table: hash label, digest width,
+                merged flag, entry count, offset
+    records     per record: (offset, length) of its name and of its
+                JSON-encoded key and file, both in the string table
+    names       record numbers, sorted by name
+    digests     per table: (digest, record number) entries, sorted by digest
+    strings     UTF-8 string table
+
+Digest and name tables are sorted so that lookups are binary searches over
+the mapped file; only the records actually returned get decoded.
+
+Besides a table per hash type, there are summary tables of every file's
+size, of the sizes of files without a fingerprint, and of every
+fingerprint, so that `has_size` and `has_fingerprint` (the `might_have`
+prefilter) are answered from the mapped file too.
+"""
+
+import json
+import mmap
+import struct
+
+from mediaman.core import hashing
+
+MAGIC = b"MMIX"
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct("<4sHHQII")
+TABLE = struct.Struct("<16sHBxIQ")
+RECORD = struct.Struct("<QIQI")
+RECORD_NUMBER = struct.Struct("<I")
+SIZE = struct.Struct(">Q")
+
+# Summary tables are stored as digest tables with these labels
+SUMMARY = 2  # in place of the merged flag
+SIZE_TABLE = "size"
+UNFINGERPRINTED_TABLE = "unfingerprinted"
+FINGERPRINT_TABLE = "fingerprint"
+
+
+def split_hash(labeled_hash):
+    (label, _, digest) = labeled_hash.partition(hashing.DELIMITER)
+    try:
+        return (label, bytes.fromhex(digest))
+    except ValueError:
+        return (label, None)
+
+
+def encode_fingerprint(fingerprint):
+    """A fingerprint as a digest (its size, then its hash), or None if it's malformed."""
+    (size, _, digest) = fingerprint.partition(hashing.DELIMITER)
+    try:
+        return SIZE.pack(int(size)) + bytes.fromhex(digest)
+    except (ValueError, struct.error):
+        return None
+
+
+def summary_entries(file):
+    """The (table, digest) summary entries of a file."""
+    size = SIZE.pack(file["size"])
+    entries = [(SIZE_TABLE, size)]
+
+    # NOTE: a malformed fingerprint is as good as none (it might match anything)
+    fingerprint = None if file["fingerprint"] is None else encode_fingerprint(file["fingerprint"])
+    if fingerprint is None:
+        entries.append((UNFINGERPRINTED_TABLE, size))
+    else:
+        entries.append((FINGERPRINT_TABLE, fingerprint))
+    return entries
+
+
+def encode(metadata):
+    """Encode (current-version) index metadata as bytes."""
+    strings = bytearray()
+
+    def add_string(text):
+        data = text.encode("utf-8")
+        offset = len(strings)
+        strings.extend(data)
+        return (offset, len(data))
+
+    items = list(metadata["files"].items())
+    records = []
+    tables = {}  # (label, width, merged): [(digest, record number)]
+    for (number, (key, file)) in enumerate(items):
+        name = add_string(file["name"])
+        body = add_string(json.dumps([key, file], separators=(",", ":")))
+        records.append(name + body)
+
+        for (merged, field) in ((0, "hashes"), (1, "merged_hashes")):
+            for labeled_hash in file[field]:
+                (label, digest) = split_hash(labeled_hash)
+                if digest is not None:
+                    tables.setdefault((label, len(digest), merged), []).append((digest, number))
+
+        for (label, digest) in summary_entries(file):
+            tables.setdefault((label, len(digest), SUMMARY), []).append((digest, number))
+
+    names = sorted(range(len(items)), key=lambda number: items[number][1]["name"].encode("utf-8"))
+
+    directory_size = TABLE.size * len(tables)
+    records_offset = HEADER.size + directory_size
+    names_offset = records_offset + RECORD.size * len(records)
+    offset = names_offset + RECORD_NUMBER.size * len(names)
+
+    directory = bytearray()
+    digests = bytearray()
+    for ((label, width, merged), entries) in sorted(tables.items()):
+        entries.sort()
+        directory.extend(TABLE.pack(label.encode("ascii"), width, merged, len(entries), offset + len(digests)))
+        for (digest, number) in entries:
+            digests.extend(digest)
+            digests.extend(RECORD_NUMBER.pack(number))
+
+    strings_offset = offset + len(digests)
+
+    out = bytearray(HEADER.pack(
+        MAGIC, FORMAT_VERSION, metadata["version"], metadata.get("sequence", 0), len(records), len(tables)))
+    out.extend(directory)
+    for (name_offset, name_length, body_offset, body_length) in records:
+        out.extend(RECORD.pack(
+            strings_offset + name_offset, name_length,
+            strings_offset + body_offset, body_length))
+    for number in names:
+        out.extend(RECORD_NUMBER.pack(number))
+    out.extend(digests)
+    out.extend(strings)
+    return bytes(out)
+
+
+class BinaryIndex:
+    """Read-only view of an encoded index file, backed by `mmap`."""
+
+    def __init__(self, path):
+        with open(path, "rb") as infile:
+            self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, format_version, self.version, self.sequence, self.record_count, table_count) = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"Not a version {FORMAT_VERSION} binary index: {path}")
+
+        self.tables = {}  # (label, merged): (width, count, offset)
+        for i in range(table_count):
+            (label, width, merged, count, offset) = TABLE.unpack_from(self.map, HEADER.size + i * TABLE.size)
+            self.tables[(label.rstrip(b"\0").decode("ascii"), merged)] = (width, count, offset)
+
+        self.records_offset = HEADER.size + TABLE.size * table_count
+        self.names_offset = self.records_offset + RECORD.size * self.record_count
+
+    def close(self):
+        self.map.close()
+
+    def record_entry(self, number):
+        return RECORD.unpack_from(self.map, self.records_offset + number * RECORD.size)
+
+    def name(self, number):
+        (name_offset, name_length, _, _) = self.record_entry(number)
+        return self.map[name_offset:name_offset + name_length]
+
+    def record(self, number):
+        """Return the (key, file) pair stored as record `number`."""
+        (_, _, body_offset, body_length) = self.record_entry(number)
+        return tuple(json.loads(self.map[body_offset:body_offset + body_length]))
+
+    def find_digest(self, label, digest, merged):
+        try:
+            (width, count, offset) = self.tables[(label, merged)]
+        except KeyError:
+            return None
+
+        if len(digest) != width:
+            return None
+
+        stride = width + RECORD_NUMBER.size
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            start = offset + middle * stride
+            found = self.map[start:start + width]
+            if found < digest:
+                low = middle + 1
+            elif found > digest:
+                high = middle
+            else:
+                return RECORD_NUMBER.unpack_from(self.map, start + width)[0]
+        return None
+
+    def find_hash(self, labeled_hash):
+        """Return the record number holding the given (possibly merged) hash."""
+        (label, digest) = split_hash(labeled_hash)
+        if digest is None:
+            return None
+
+        number = self.find_digest(label, digest, 0)
+        if number is None:
+            number = self.find_digest(label, digest, 1)
+        return number
+
+    def has_size(self, size):
+        return self.find_digest(SIZE_TABLE, SIZE.pack(size), SUMMARY) is not None
+
+    def has_fingerprint(self, fingerprint):
+        """Whether any file has this fingerprint, or has its size but no fingerprint."""
+        digest = encode_fingerprint(fingerprint)
+        if digest is None or self.find_digest(FINGERPRINT_TABLE, digest, SUMMARY) is not None:
+            return True
+        return self.find_digest(UNFINGERPRINTED_TABLE, digest[:SIZE.size], SUMMARY) is not None
+
+    def find_name(self, name):
+        """Return the record numbers with exactly the given name."""
+        name = name.encode("utf-8")
+
+        def name_at(position):
+            number = RECORD_NUMBER.unpack_from(self.map, self.names_offset + position * RECORD_NUMBER.size)[0]
+            return (self.name(number), number)
+
+        (low, high) = (0, self.record_count)
+        while low < high:
+            middle = (low + high) // 2
+            if name_at(middle)[0] < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        numbers = []
+        while low < self.record_count:
+            (found, number) = name_at(low)
+            if found != name:
+                break
+            numbers.append(number)
+            low += 1
+        return sorted(numbers)
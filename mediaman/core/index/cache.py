@@ -0,0 +1,85 @@
+"""
+Local on-disk cache of a service's metadata files (e.g. the index).
+
+Each cached copy is stored with the validator of the remote file it was
+taken from (see `AbstractResultFile.validator`), and is only used while
+the remote file still reports the same validator.
+"""
+
+import json
+import os
+import pathlib
+import shutil
+
+from mediaman.core import logtools
+
+logger = logtools.new_logger("mediaman.core.index.cache")
+
+
+CACHE_DIR_ENV_VAR = "MM_CACHE_DIR"
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.mediaman/cache")
+VALIDATORS_FILENAME = "validators.json"
+
+
+def cache_root():
+    from mediaman import config
+    return pathlib.Path(config.load(CACHE_DIR_ENV_VAR, default=DEFAULT_CACHE_DIR))
+
+
+class IndexCache:
+
+    def __init__(self, service):
+        self.service = service
+        self._path = None
+        self._validators = None
+
+    def path(self):
+        if self._path is None:
+            self._path = cache_root() / self.service.nickname()
+            self._path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        return self._path
+
+    def validators(self):
+        if self._validators is None:
+            try:
+                with open(self.path() / VALIDATORS_FILENAME) as infile:
+                    self._validators = json.load(infile)
+            except (FileNotFoundError, ValueError):
+                self._validators = {}
+        return self._validators
+
+    def save_validators(self):
+        temp_path = self.path() / f"{VALIDATORS_FILENAME}.tmp"
+        with open(temp_path, "w") as outfile:
+            json.dump(self.validators(), outfile)
+        os.replace(temp_path, self.path() / VALIDATORS_FILENAME)
+
+    def load(self, name, validator):
+        """Return the path of the cached copy of `name`, if still valid."""
+        if validator is None or self.validators().get(name) != validator:
+            logger.debug(f"Cache miss for '{name}' ({validator})")
+            return None
+
+        path = self.path() / name
+        if not path.exists():
+            return None
+
+        logger.debug(f"Cache hit for '{name}' ({validator})")
+        return path
+
+    def store(self, name, validator, source_path):
+        """Cache a copy of the file at `source_path` as `name`."""
+        if validator is None:
+            self.discard(name)
+            return
+
+        temp_path = self.path() / f"{name}.tmp"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, self.path() / name)
+
+        self.validators()[name] = validator
+        self.save_validators()
+
+    def discard(self, name):
+        if self.validators().pop(name, None) is not None:
+            self.save_validators()
@@ -1,8 +1,8 @@
 
+import collections
 import contextlib
 import functools
 import json
-import os
 import pathlib
 import shutil
 import tempfile
@@ -10,10 +10,12 @@ import uuid
 
 from mediaman.core import hashing
 from mediaman.core import logtools
-from mediaman.core import models
 from mediaman.core import settings
 from mediaman.core.index import base
+from mediaman.core.index import binary
+from mediaman.core.index import cache
 from mediaman.core.index import migration
+from mediaman.core.utils import trigrams
 
 logger = logtools.new_logger("mediaman.core.index.index")
 
@@ -22,8 +24,30 @@ ERROR_MULTIPLE_REMOTE_INDICES = "\
 [!] Multiple index files found for service ({})!  \
 This must be resolved manually.  Exiting..."
 
+JOURNAL_ADD = "add"
+JOURNAL_MERGE = "merge"
+JOURNAL_REMOVE = "remove"
+JOURNAL_HASHES = "hashes"
+JOURNAL_FINGERPRINT = "fingerprint"
+JOURNAL_MERKLE = "merkle"
+JOURNAL_CRYPT = "crypt"
+JOURNAL_SIZE = "size"
+
 
 def init(func):
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        self.init_metadata()
+        self.materialize()
+        return func(self, *args, **kwargs)
+    return wrapped
+
+
+def lookup(func):
+    """
+    Like `init`, but leaves a memory-mapped binary index (if any) in place,
+    for read-only lookups that can be answered from it directly.
+    """
     @functools.wraps(func)
     def wrapped(self, *args, **kwargs):
         self.init_metadata()
@@ -40,19 +64,6 @@ def make_temp_directory():
         shutil.rmtree(temp_dir)
 
 
-def create_file(id, name, sid, size, hashes, merged_hashes):
-    assert isinstance(hashes, list)
-    assert isinstance(merged_hashes, list)
-    return {
-        "id": id,
-        "name": name,
-        "sid": sid,
-        "size": size,
-        "hashes": hashes,
-        "merged_hashes": merged_hashes,
-    }
-
-
 def create_metadata(files=None):
     if files is None:
         files = {}
@@ -64,77 +75,244 @@ def create_metadata(files=None):
 
 
 class Index(base.BaseIndex):
+    """
+    An index stored as a JSON snapshot (`index`) plus an append-only journal
+    of the mutations made since.  Each flush uploads the new records as one
+    more journal segment (`index.journal.<last seq>`), and the segments are
+    folded into a new snapshot (and deleted) once there are enough of them.
+    """
 
     INDEX_FILENAME = "index"
+    JOURNAL_FILENAME = "index.journal"
+    BINARY_FILENAME = "index.bin"
 
     def __init__(self, service):
         super().__init__(service)
         logger.debug(f"Index init for {service}")
 
         self.index_id = None
+        self.segments = []
         self.metadata = {}
+        self.journal = []
+        self.unflushed = []
+        self.journal_damaged = False
+        self.sequence = 0
+        self.next_key = 0
+        self.batching = False
+        self.cache = cache.IndexCache(service)
+        self.remote_files = None
+        self.reader = None
         self.id_to_metadata_map = {}
         self.hash_to_metadata_map = {}
         self.merged_hash_to_metadata_map = {}
+        self.name_to_metadata_map = {}
+        self.size_counts = collections.Counter()
+        self.fingerprint_counts = collections.Counter()
+        self.unfingerprinted_size_counts = collections.Counter()
+        self.trigram_index = trigrams.TrigramIndex()
 
     def files(self):
+        self.materialize()
         return self.metadata["files"]
 
     def force_init(self):
         self.init_metadata()
 
+    def reset(self):
+        """Discards all in-memory state, forcing a reload on next use."""
+        self.close_binary()
+        self.index_id = None
+        self.segments = []
+        self.metadata = {}
+        self.journal = []
+        self.unflushed = []
+        self.journal_damaged = False
+        self.sequence = 0
+        self.next_key = 0
+        self.id_to_metadata_map = {}
+        self.hash_to_metadata_map = {}
+        self.merged_hash_to_metadata_map = {}
+        self.name_to_metadata_map = {}
+        self.size_counts = collections.Counter()
+        self.fingerprint_counts = collections.Counter()
+        self.unfingerprinted_size_counts = collections.Counter()
+        self.trigram_index = trigrams.TrigramIndex()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups index mutations into a single transaction.
+
+        Inside the batch, mutations are applied in memory only.  On a clean
+        exit the journal (or a compacted snapshot) is written once; on an
+        exception the in-memory state is discarded, leaving the remote index
+        untouched.  (Any data files already uploaded become untracked.)
+
+        Nested batches are folded into the outermost one.
+        """
+        if self.batching:
+            yield self
+            return
+
+        self.batching = True
+        try:
+            with self.service.batch():
+                yield self
+            self.flush()
+        except BaseException:
+            logger.warning(f"Rolling back index batch for {self.service}")
+            self.reset()
+            raise
+        finally:
+            self.batching = False
+
+    def flush(self):
+        if self.index_id is None or not self.unflushed:
+            return
+
+        if self.journal_damaged:
+            # NOTE: later segments may reuse the damaged ones' names
+            logger.info(f"Compacting damaged index journal...")
+            self.update_metadata()
+        elif len(self.journal) >= base.JOURNAL_COMPACTION_THRESHOLD or len(self.segments) >= base.JOURNAL_SEGMENT_LIMIT:
+            logger.info(f"Compacting index journal ({len(self.journal)} records, {len(self.segments)} segments)...")
+            self.update_metadata()
+        else:
+            self.update_journal()
+
     def init_metadata(self):
         if self.index_id is not None:
             return
 
-        # TODO: implement
-        file_list = self.service.search_by_name(Index.INDEX_FILENAME)
-        files = file_list.results()
-
-        logger.debug(f"files = {files}")
-        logger.debug(f"file_list = {file_list}")
-        if len(files) > 1:
-            raise RuntimeError(ERROR_MULTIPLE_REMOTE_INDICES.format(self.service))
+        index = self.find_remote(Index.INDEX_FILENAME, ERROR_MULTIPLE_REMOTE_INDICES)
 
         # new index file
-        if not files:
+        if index is None:
             logger.debug(f"creating metadata")
             self.metadata = create_metadata()
             self.update_metadata()
-        else:
-            logger.debug(f"loading metadata")
-            self.load_metadata(files[0])
+            return
 
-    def update_metadata(self):
-        with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
-            tempfile_ref.write(json.dumps(self.metadata))
-            tempfile_ref.seek(0)
+        segments = self.find_segments(Index.JOURNAL_FILENAME)
+        self.remote_files = (index, segments)
+        if self.open_binary(index, segments):
+            logger.debug(f"opened binary index")
+            return
 
-            request = models.Request(
-                id=Index.INDEX_FILENAME,
-                path=tempfile_ref.name,
-            )
-            receipt = self.service.upload(request)
+        logger.debug(f"loading metadata")
+        self.load_metadata(index, segments)
+        self.store_binary(index, segments)
+
+    def find_remote(self, name, error):
+        files = self.service.search_by_name(name).results()
+        logger.debug(f"remote files for '{name}': {files}")
+
+        if len(files) > 1:
+            raise RuntimeError(error.format(self.service))
+        return files[0] if files else None
+
+    def binary_validator(self, index, segments):
+        """The binary index is only valid for the exact snapshot and journal it was built from."""
+        validators = [index.validator()] + [segment.validator() for segment in segments]
+        if None in validators:
+            return None
+        return "+".join(validators)
+
+    def open_binary(self, index, segments):
+        path = self.cache.load(Index.BINARY_FILENAME, self.binary_validator(index, segments))
+        if path is None:
+            return False
+
+        try:
+            reader = binary.BinaryIndex(path)
+        except ValueError as e:
+            logger.warning(f"Ignoring cached binary index: {e}")
+            return False
+
+        if reader.version != settings.VERSION:
+            reader.close()
+            return False
+
+        self.reader = reader
+        self.index_id = index.id()
+        self.segments = [(segment.name(), segment.id()) for segment in segments]
+        return True
+
+    def store_binary(self, index, segments):
+        validator = self.binary_validator(index, segments)
+        if validator is None:
+            return
+
+        data = migration.metadata_to_binary({**self.metadata, "sequence": self.sequence})
+        with tempfile.NamedTemporaryFile("wb", delete=True) as tempfile_ref:
+            tempfile_ref.write(data)
+            tempfile_ref.flush()
+            self.cache.store(Index.BINARY_FILENAME, validator, tempfile_ref.name)
+
+    def close_binary(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def materialize(self):
+        """Replaces the binary index (if open) with the full in-memory index."""
+        if self.reader is None:
+            return
+
+        logger.debug(f"materializing index from JSON")
+        self.close_binary()
+        self.load_metadata(*self.remote_files)
+
+    def binary_files(self, numbers):
+        return [self.reader.record(number)[1] for number in numbers]
+
+    def update_metadata(self):
+        """
+        Writes a full snapshot of the metadata, folding in (and then
+        deleting) the journal segments.
+        """
+        self.metadata["sequence"] = self.sequence
+        receipt = self.upload_text(Index.INDEX_FILENAME, json.dumps(self.metadata))
 
         logger.debug(f"update_metadata receipt: {receipt}")
         self.index_id = receipt.id()
 
+        self.remove_segments(self.segments)
+        self.segments = []
+        self.journal = []
+        self.unflushed = []
+        self.journal_damaged = False
+
+    def update_journal(self):
+        """Uploads the records made since the last flush as a new journal segment."""
+        self.segments.append(self.upload_segment(
+            Index.JOURNAL_FILENAME, self.metadata.get("sequence", 0), self.sequence, self.unflushed))
+        self.unflushed = []
+
+    def append_journal(self, op, key, **fields):
+        """
+        Applies a single mutation in memory and persists it as a journal
+        record, rather than re-uploading the whole index.  Once the journal
+        passes JOURNAL_COMPACTION_THRESHOLD records it is compacted into
+        a new snapshot.
+
+        Inside a batch, the journal is only written when the batch commits.
+        """
+        self.sequence += 1
+        record = base.create_journal_record(self.sequence, op, key, **fields)
+        self.apply_record(record)
+        self.journal.append(json.dumps(record))
+        self.unflushed.append(self.journal[-1])
+
+        if not self.batching:
+            self.flush()
+
     def load_metadata_json(self, index):
         logger.debug(f"load_metadata_json index: {index}")
         self.index_id = index.id()
+        return json.loads(self.download_text(index, Index.INDEX_FILENAME))
 
-        with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
-            request = models.Request(
-                id=self.index_id,
-                path=tempfile_ref.name,
-            )
-
-            self.service.download(request)
-            tempfile_ref.seek(0)
-
-            return json.loads(tempfile_ref.read())
-
-    def load_metadata(self, index):
+    def load_metadata(self, index, segments):
         metadata = self.load_metadata_json(index)
         logger.debug(f"Loaded metadata: {metadata}")
 
@@ -152,9 +330,143 @@ class Index(base.BaseIndex):
             raise RuntimeError("Outdated metadata")
 
         self.metadata = metadata
+        self.sequence = metadata.get("sequence", 0)
+        self.build_maps()
+        self.load_journal(segments)
+
+    def load_journal(self, segments):
+        """
+        Replays the journal segments on top of the snapshot (see
+        `read_journal`); if they're damaged, everything replayed up to there
+        is kept, and the next write compacts the journal.
+        """
+        self.segments = [(segment.name(), segment.id()) for segment in segments]
+        self.journal = []
+        self.unflushed = []
+
+        for (version, record) in self.read_journal(segments, Index.JOURNAL_FILENAME, self.sequence):
+            if version < settings.VERSION and record["op"] == JOURNAL_ADD:
+                # NOTE: only reachable from `refresh` (or an import), which compact the journal
+                record["file"] = migration.repair_file(record["file"], version)
+            self.apply_record(record)
+            self.journal.append(json.dumps(record))
+            self.sequence = record["seq"]
+
+        logger.debug(f"Replayed {len(self.journal)} journal records from {len(segments)} segments")
+
+    def build_maps(self):
         self.id_to_metadata_map = {v["id"]: k for (k, v) in self.files().items()}
         self.hash_to_metadata_map = {hash: k for (k, v) in self.files().items() for hash in v["hashes"]}
         self.merged_hash_to_metadata_map = {hash: k for (k, v) in self.files().items() for hash in v["merged_hashes"]}
+        self.name_to_metadata_map = {}
+        self.size_counts = collections.Counter()
+        self.fingerprint_counts = collections.Counter()
+        self.unfingerprinted_size_counts = collections.Counter()
+        self.trigram_index = trigrams.TrigramIndex()
+        for (k, v) in self.files().items():
+            self.index_name(k, v["name"])
+            self.count_file(v, 1)
+        self.next_key = max(map(int, self.files()), default=-1) + 1
+
+    def apply_record(self, record):
+        op = record["op"]
+        if op == JOURNAL_ADD:
+            self.apply_add(record["key"], record["file"])
+        elif op == JOURNAL_MERGE:
+            self.apply_merge(record["key"], record["name"], record["hash"])
+        elif op == JOURNAL_REMOVE:
+            self.apply_remove(record["key"])
+        elif op == JOURNAL_HASHES:
+            self.apply_hashes(record["key"], record["hashes"])
+        elif op == JOURNAL_FINGERPRINT:
+            self.apply_fingerprint(record["key"], record["fingerprint"])
+        elif op == JOURNAL_MERKLE:
+            self.apply_merkle(record["key"], record["merkle_root"], record["merkle_sid"])
+        elif op == JOURNAL_CRYPT:
+            self.apply_crypt(record["key"], record["crypt"])
+        elif op == JOURNAL_SIZE:
+            self.apply_size(record["key"], record["size"])
+        else:
+            raise RuntimeError(f"Unknown journal record: {record}")
+
+    def apply_add(self, key, file):
+        self.files()[key] = file
+        self.id_to_metadata_map[file["id"]] = key
+        for hash in file["hashes"]:
+            self.hash_to_metadata_map[hash] = key
+        for hash in file["merged_hashes"]:
+            self.merged_hash_to_metadata_map[hash] = key
+        self.index_name(key, file["name"])
+        self.count_file(file, 1)
+        self.next_key = max(self.next_key, int(key) + 1)
+
+    def apply_merge(self, key, name, hash):
+        file = self.files()[key]
+        self.unindex_name(key, file["name"])
+        file["name"] = name
+        file["merged_hashes"].append(hash)
+        self.merged_hash_to_metadata_map[hash] = key
+        self.index_name(key, name)
+
+    def apply_remove(self, key):
+        file = self.files().pop(key)
+        del self.id_to_metadata_map[file["id"]]
+        for hash in file["hashes"]:
+            self.hash_to_metadata_map.pop(hash, None)
+        for hash in file["merged_hashes"]:
+            self.merged_hash_to_metadata_map.pop(hash, None)
+        self.unindex_name(key, file["name"])
+        self.count_file(file, -1)
+
+    def apply_hashes(self, key, hashes):
+        self.files()[key]["hashes"].extend(hashes)
+        for hash in hashes:
+            self.hash_to_metadata_map[hash] = key
+
+    def apply_fingerprint(self, key, fingerprint):
+        file = self.files()[key]
+        self.count_file(file, -1)
+        file["fingerprint"] = fingerprint
+        self.count_file(file, 1)
+
+    def apply_merkle(self, key, merkle_root, merkle_sid):
+        file = self.files()[key]
+        file["merkle_root"] = merkle_root
+        file["merkle_sid"] = merkle_sid
+
+    def apply_crypt(self, key, crypt):
+        self.files()[key]["crypt"] = crypt
+
+    def apply_size(self, key, size):
+        file = self.files()[key]
+        self.count_file(file, -1)
+        file["size"] = size
+        self.count_file(file, 1)
+
+    def count_file(self, file, delta):
+        """Updates the size and fingerprint counts used by `might_have`."""
+        counts = [(self.size_counts, file["size"])]
+        if file["fingerprint"] is None:
+            counts.append((self.unfingerprinted_size_counts, file["size"]))
+        else:
+            counts.append((self.fingerprint_counts, file["fingerprint"]))
+
+        for (counter, value) in counts:
+            counter[value] += delta
+            if not counter[value]:
+                del counter[value]
+
+    def index_name(self, key, name):
+        # NOTE: dicts (not sets), to keep search results in insertion order
+        self.name_to_metadata_map.setdefault(name, {})[key] = None
+        self.trigram_index.add(key, name)
+
+    def unindex_name(self, key, name):
+        keys = self.name_to_metadata_map.get(name, {})
+        keys.pop(key, None)
+        if not keys:
+            self.name_to_metadata_map.pop(name, None)
+        self.trigram_index.remove(key)
 
     @init
     def new_id(self):
@@ -163,8 +475,14 @@ class Index(base.BaseIndex):
             id = str(uuid.uuid4())
         return id
 
-    @init
+    @lookup
     def get_metadata_by_hash(self, hash):
+        if self.reader is not None:
+            number = self.reader.find_hash(hash)
+            if number is None:
+                raise KeyError(hash)
+            return self.reader.record(number)[1]
+
         index = self.hash_to_metadata_map.get(hash, self.merged_hash_to_metadata_map.get(hash, None))
         return self.files()[index]
 
@@ -176,62 +494,65 @@ class Index(base.BaseIndex):
     def list_files(self):
         return iter(self.files().values())
 
-    @init
+    @lookup
     def search_by_name(self, file_name):
-        return [f for f in self.files().values() if f["name"] == file_name]
+        if self.reader is not None:
+            return self.binary_files(self.reader.find_name(file_name))
+        return [self.files()[k] for k in self.name_to_metadata_map.get(file_name, ())]
 
     @init
-    def fuzzy_search_by_name(self, file_name):
-        return [f for f in self.files().values() if file_name.lower() in f["name"].lower()]
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        return [self.files()[k] for k in self.trigram_index.search(file_name, limit=limit)]
 
-    @init
+    @lookup
     def search_by_hash(self, hash):
-        return [f for f in self.files().values() if hash in f["hashes"] or hash in f["merged_hashes"]]
-
-    @init
+        return self.search_by_hashes([hash])[hash]
+
+    @lookup
+    def search_by_hashes(self, hashes):
+        """Resolve many hashes at once, returning {hash: [file, ...]}."""
+        results = {}
+        if self.reader is not None:
+            for hash in hashes:
+                number = self.reader.find_hash(hash)
+                results[hash] = [] if number is None else self.binary_files([number])
+            return results
+
+        for hash in hashes:
+            key = self.hash_to_metadata_map.get(hash, self.merged_hash_to_metadata_map.get(hash))
+            results[hash] = [] if key is None else [self.files()[key]]
+        return results
+
+    @lookup
     def has_hash(self, hash):
+        if self.reader is not None:
+            return self.reader.find_hash(hash) is not None
         return hash in self.hash_to_metadata_map or hash in self.merged_hash_to_metadata_map
 
     @init
     def has_uuid(self, uuid):
         return uuid in self.id_to_metadata_map
 
-    @init
-    def has_name(self, name):
-        return self.search_by_name(name)
-
-    @init
-    def upload(self, request):
-        name = pathlib.Path(request.path).name
-        size = os.stat(request.path).st_size
-        hash = request.hash
-
-        if self.has_hash(hash):
-            logger.info(f"[-] (File already indexed: {request.path})")
-            return self.get_metadata_by_hash(hash)
-
-        upload_request = models.Request(
-            id=self.new_id(),
-            path=request.path,
-        )
+    @lookup
+    def has_size(self, size):
+        if self.reader is not None:
+            return self.reader.has_size(size)
+        return size in self.size_counts
 
-        logger.info(f"Uploading '{request}' as '{upload_request}' ...")
-        receipt = self.service.upload(upload_request)
+    @lookup
+    def has_fingerprint(self, fingerprint):
+        if self.reader is not None:
+            return self.reader.has_fingerprint(fingerprint)
+        return (fingerprint in self.fingerprint_counts
+                or hashing.fingerprint_size(fingerprint) in self.unfingerprinted_size_counts)
 
-        hashes = [hash]
-        merged_hashes = []
-
-        self.track_file(create_file(
-            upload_request.id,
-            name,
-            receipt.id(),
-            size,
-            hashes,
-            merged_hashes,
-        ))
-
-        return self.get_metadata_by_hash(hash)
+    @lookup
+    def has_name(self, name):
+        if self.reader is not None:
+            return bool(self.reader.find_name(name))
+        return name in self.name_to_metadata_map
 
+    @init
     def merge_into_existing_file(self, request, exiting_file):
         existing_hash = exiting_file["hashes"][-1]
         new_hash = request.hash
@@ -256,110 +577,62 @@ class Index(base.BaseIndex):
         info = self.get_metadata_by_hash(existing_hash)
         logger.info(f"Old info: {info}")
 
-        info["name"] = chosen_name
-        info["merged_hashes"].append(new_hash)
-        logger.info(f"New info: {self.get_metadata_by_hash(existing_hash)}")
-
         index = self.hash_to_metadata_map[existing_hash]
-        self.merged_hash_to_metadata_map[new_hash] = index
+        self.append_journal(JOURNAL_MERGE, index, name=chosen_name, hash=new_hash)
+        logger.info(f"New info: {self.get_metadata_by_hash(existing_hash)}")
 
         # inp = input("Look good? [Y/n] ")
         # if inp not in 'Yy':
         #     print("Cancelled.")
         #     exit(1)
 
-        self.update_metadata()
         return True
 
     @init
     def track_file(self, file):
-        new_index = str(max(map(int, self.files()), default=-1) + 1)
+        new_index = str(self.next_key)
         logger.debug(file)
-        self.files()[new_index] = file
-        self.id_to_metadata_map[file["id"]] = new_index
-        for hash in file["hashes"]:
-            self.hash_to_metadata_map[hash] = new_index
-        for hash in file["merged_hashes"]:
-            self.merged_hash_to_metadata_map[hash] = new_index
-
-        self.update_metadata()
+        self.append_journal(JOURNAL_ADD, new_index, file=file)
 
     @init
-    def download(self, root, identifier):
-        logger.debug(f"Download request for: '{identifier}' to '{root}'...")
+    def add_file_hashes(self, file, hashes):
+        self.append_journal(JOURNAL_HASHES, self.id_to_metadata_map[file["id"]], hashes=hashes)
 
-        if self.has_uuid(identifier):
-            metadata = self.get_metadata_by_uuid(identifier)
-        elif self.has_hash(identifier):
-            metadata = self.get_metadata_by_hash(identifier)
-        else:
-            metadatas = self.search_by_name(identifier)
-            if not metadatas:
-                logger.error("[-] No such file found!")
-                return None
-            elif len(metadatas) > 1:
-                logger.error("[-] Multiple files exist with that name!  Pass the hash or ID instead.")
-                return False
-            else:
-                metadata = metadatas[0]
-
-        request = models.Request(
-            id=metadata["sid"],
-            path=root / metadata["name"],
-        )
-        return self.service.download(request)
+    @init
+    def add_file_fingerprint(self, file, fingerprint):
+        self.append_journal(JOURNAL_FINGERPRINT, self.id_to_metadata_map[file["id"]], fingerprint=fingerprint)
 
     @init
-    def stream(self, root, identifier):
-        logger.debug(f"Stream request for: '{identifier}' to '{root}'...")
+    def add_file_merkle(self, file, merkle_root, merkle_sid):
+        self.append_journal(JOURNAL_MERKLE, self.id_to_metadata_map[file["id"]], merkle_root=merkle_root, merkle_sid=merkle_sid)
 
-        if self.has_uuid(identifier):
-            metadata = self.get_metadata_by_uuid(identifier)
-        elif self.has_hash(identifier):
-            metadata = self.get_metadata_by_hash(identifier)
-        else:
-            metadatas = self.search_by_name(identifier)
-            if not metadatas:
-                logger.error("[-] No such file found!")
-                return None
-            elif len(metadatas) > 1:
-                logger.error("[-] Multiple files exist with that name!  Pass the hash or ID instead.")
-                return False
-            else:
-                metadata = metadatas[0]
-
-        request = models.Request(
-            id=metadata["sid"],
-            path=root / metadata["name"],
-        )
-        return self.service.stream(request)
+    @init
+    def add_file_crypt(self, file, crypt):
+        self.append_journal(JOURNAL_CRYPT, self.id_to_metadata_map[file["id"]], crypt=crypt)
 
     @init
-    def stream_range(self, root, identifier, offset, length):
-        logger.debug(f"Stream request for: '{identifier}' to '{root}'...")
+    def add_file_size(self, file, size):
+        self.append_journal(JOURNAL_SIZE, self.id_to_metadata_map[file["id"]], size=size)
 
-        if self.has_uuid(identifier):
-            metadata = self.get_metadata_by_uuid(identifier)
-        elif self.has_hash(identifier):
-            metadata = self.get_metadata_by_hash(identifier)
-        else:
-            metadatas = self.search_by_name(identifier)
-            if not metadatas:
-                logger.error("[-] No such file found!")
-                return None
-            elif len(metadatas) > 1:
-                logger.error("[-] Multiple files exist with that name!  Pass the hash or ID instead.")
-                return False
-            else:
-                metadata = metadatas[0]
-
-        request = models.Request(
-            id=metadata["sid"],
-            path=root / metadata["name"],
-        )
-        return self.service.stream_range(request, offset, length)
+    def load_repaired_metadata(self, raw_metadata, metadata):
+        """Loads (repaired) metadata and its journal in place of the remote index, without writing it back."""
+        self.metadata = metadata
+        self.sequence = raw_metadata.get("sequence", 0)
+        self.build_maps()
+        self.load_journal(self.find_segments(Index.JOURNAL_FILENAME))
+
+    def import_files(self):
+        """
+        Returns the files of the remote index, repaired to the current
+        version (in memory only), e.g. when switching backends.
+        """
+        self.close_binary()
+        raw_metadata = self.load_metadata_json(self.find_remote(Index.INDEX_FILENAME, ERROR_MULTIPLE_REMOTE_INDICES))
+        self.load_repaired_metadata(raw_metadata, migration.repair_metadata(raw_metadata))
+        return self.metadata["files"]
 
     def refresh(self):
+        self.close_binary()
         raw_metadata = self.load_metadata_json(self.service.search_by_name(Index.INDEX_FILENAME).results()[0])
         metadata = migration.repair_metadata(raw_metadata)
 
@@ -369,8 +642,9 @@ class Index(base.BaseIndex):
             print("Cancelled.")
             return
 
-        self.metadata = metadata
+        self.load_repaired_metadata(raw_metadata, metadata)
         self.update_metadata()
+        self.refresh_ciphers()
 
         inp = input("Would you like to refresh the file list? [Y/n] ")
         if inp in 'yY':
@@ -393,7 +667,6 @@ class Index(base.BaseIndex):
             # NOTE: we're listing raw files!
             sid = current_file.id()
             id = current_file.name()
-            size = current_file.size()
             logger.debug(f"current_file: {current_file}")
 
             try:
@@ -405,17 +678,28 @@ class Index(base.BaseIndex):
                 logger.warn(f"Couldn't find metadata for sid '{sid}': {current_file}")
                 continue
 
+            # NOTE: not the listed size, which is the ciphertext's for an
+            #       encrypted file (and `might_have` relies on this one)
             name = file_metadata["name"]
+            size = file_metadata["size"]
             hashes = file_metadata["hashes"]
             merged_hashes = file_metadata["merged_hashes"]
+            fingerprint = file_metadata["fingerprint"]
+            merkle_root = file_metadata["merkle_root"]
+            merkle_sid = file_metadata["merkle_sid"]
+            crypt = file_metadata["crypt"]
 
-            new_file = create_file(
+            new_file = base.create_file(
                 id,
                 name,
                 sid,
                 size,
                 hashes,
                 merged_hashes,
+                fingerprint,
+                merkle_root,
+                merkle_sid,
+                crypt,
             )
             new_files.append(new_file)
             logger.debug(new_file)
@@ -430,41 +714,16 @@ class Index(base.BaseIndex):
             return
 
         self.metadata = new_metadata
+        self.build_maps()
         self.update_metadata()
 
-    def refresh_hashes(self):
-        preferred_hash = hashing.PREFERRED_HASH.value
-
-        for file in self.files().values():
-
-            # TODO: make a helper for this
-            hash_prefixes = set(hash.split(":")[0] for hash in file["hashes"])
-            if preferred_hash in hash_prefixes:
-                logger.info(f"Preferred hash already present for: {file}")
-                continue
-
-            with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
-                path = tempfile_ref.name
-                request = models.Request(
-                    id=file["sid"],
-                    path=path,
-                )
-
-                self.service.download(request)
-                tempfile_ref.seek(0)
-
-                hash = hashing.hash(path)
-                logger.debug(f"Hash of {file}: {hash}")
-
-                file["hashes"].append(hash)
-                self.update_metadata()
-                logger.info(f"Updated hash for: {file}")
-
+    @init
     def refresh_global_hashes(self, hashes_by_hash):
         for (hash, hashes) in hashes_by_hash.items():
             if self.has_hash(hash):
                 file = self.get_metadata_by_hash(hash)
                 file["hashes"] = sorted(set(file["hashes"]) | hashes)
+        self.build_maps()
 
         # TODO: there's no context here, user doesn't
         # know which service they're approving changes for...
@@ -486,19 +745,15 @@ class Index(base.BaseIndex):
         # NOTE: slightly lower-level than ideal...
         index = self.hash_to_metadata_map[hash]
         file = self.files()[index]
-        id = file["id"]
 
         result = self.service.remove(file["sid"])
         logger.info(result)
+        self.remove_merkle(file)
 
-        del self.hash_to_metadata_map[hash]
-        del self.id_to_metadata_map[id]
-        del self.files()[index]
+        self.append_journal(JOURNAL_REMOVE, index)
 
         logger.debug(self.hash_to_metadata_map.keys())
         logger.debug(self.id_to_metadata_map.keys())
         logger.debug(self.files().keys())
 
-        self.update_metadata()
-
         return result
@@ -1,6 +1,7 @@
 
 from mediaman.core import hashing
 from mediaman.core import settings
+from mediaman.core.index import binary
 
 
 VERSION_KEY = "version"
@@ -19,10 +20,29 @@ def repair_metadata(metadata_json):
     if metadata_json[VERSION_KEY] == 1:
         metadata_json = update_metadata_1_to_2(metadata_json)
 
+    if metadata_json[VERSION_KEY] == 2:
+        metadata_json = update_metadata_2_to_3(metadata_json)
+
+    if metadata_json[VERSION_KEY] == 3:
+        metadata_json = update_metadata_3_to_4(metadata_json)
+
+    if metadata_json[VERSION_KEY] == 4:
+        metadata_json = update_metadata_4_to_5(metadata_json)
+
     assert metadata_json[VERSION_KEY] == settings.VERSION
     return metadata_json
 
 
+def repair_file(file, version):
+    """Repairs a single file record (e.g. from an old journal) of the given version."""
+    return repair_metadata({VERSION_KEY: version, "files": {"": file}})["files"][""]
+
+
+def metadata_to_binary(metadata_json):
+    """Encodes the metadata, repaired to the current version, in the binary index format."""
+    return binary.encode(repair_metadata(metadata_json))
+
+
 def update_metadata_to_0(metadata_json):
     assert isinstance(metadata_json, dict)
     return {
@@ -58,3 +78,49 @@ def update_metadata_1_to_2(metadata_json):
         VERSION_KEY: 2,
         "files": files,
     }
+
+
+def update_metadata_2_to_3(metadata_json):
+    assert metadata_json[VERSION_KEY] == 2
+
+    # NOTE: fingerprints are filled in by `refresh_hashes`
+    files = metadata_json["files"]
+    for file in files.values():
+        assert "fingerprint" not in file
+        file["fingerprint"] = None
+
+    return {
+        VERSION_KEY: 3,
+        "files": files,
+    }
+
+
+def update_metadata_3_to_4(metadata_json):
+    assert metadata_json[VERSION_KEY] == 3
+
+    # NOTE: Merkle sidecars are stored by `refresh_hashes`
+    files = metadata_json["files"]
+    for file in files.values():
+        assert "merkle_root" not in file
+        file["merkle_root"] = None
+        file["merkle_sid"] = None
+
+    return {
+        VERSION_KEY: 4,
+        "files": files,
+    }
+
+
+def update_metadata_4_to_5(metadata_json):
+    assert metadata_json[VERSION_KEY] == 4
+
+    # NOTE: cipher params are folded in from the "crypt" file by `refresh_ciphers`
+    files = metadata_json["files"]
+    for file in files.values():
+        assert "crypt" not in file
+        file["crypt"] = None
+
+    return {
+        VERSION_KEY: 5,
+        "files": files,
+    }
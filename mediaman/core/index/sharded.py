@@ -0,0 +1,645 @@
+"""
+An Index split across many small shard files, for very large services.
+
+Files are stored in the shard named after the hex prefix of their first
+(primary) hash, i.e. "index.00" ... "index.ff".  A file's other hashes,
+and its uuid, are recorded as aliases in their own shards when those
+differ, so that every lookup by hash or uuid loads at most two shards.
+A small "index.manifest" lists the shards that exist.
+
+Lookups by name, size and fingerprint go through summaries, sharded the
+same way by a hash of their key ("index.names.00", "index.sizes.00", ...):
+name summaries map each name to the (id, primary hash) of its files, and
+size summaries count the files (and fingerprints) of each size.  So a name
+lookup loads one summary and the shards of the files it names, and the
+`might_have` prefilter loads one summary.
+
+Only the shards a lookup needs are downloaded, and only the shards a
+write touched are uploaded.  Listing (and fuzzy search, which only needs
+the name summaries) still load every shard.
+"""
+
+import contextlib
+import functools
+import hashlib
+import json
+import uuid
+
+from mediaman.core import hashing
+from mediaman.core import logtools
+from mediaman.core import settings
+from mediaman.core.index import base
+from mediaman.core.index import cache
+from mediaman.core.index import index as jsonindex
+from mediaman.core.index import migration
+from mediaman.core.utils import trigrams
+
+logger = logtools.new_logger("mediaman.core.index.sharded")
+
+
+ERROR_MULTIPLE_REMOTE_MANIFESTS = "\
+[!] Multiple index manifests found for service ({})!  \
+This must be resolved manually.  Exiting..."
+
+ERROR_MULTIPLE_REMOTE_SHARDS = "\
+[!] Multiple copies of index shard '{}' found for service ({})!  \
+This must be resolved manually.  Exiting..."
+
+SHARD_PREFIX_LENGTH = 2
+
+NAMES = "names"
+SIZES = "sizes"
+SUMMARY_KINDS = [NAMES, SIZES]
+
+
+def init(func):
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        self.init_metadata()
+        return func(self, *args, **kwargs)
+    return wrapped
+
+
+def create_manifest(prefix_length=SHARD_PREFIX_LENGTH, shards=None):
+    return {
+        "version": settings.VERSION,
+        "prefix_length": prefix_length,
+        "shards": sorted(shards or []),
+        "summaries": {kind: [] for kind in SUMMARY_KINDS},
+    }
+
+
+def shard_name(prefix):
+    return f"{ShardedIndex.SHARD_FILENAME}.{prefix}"
+
+
+def summary_name(kind, prefix):
+    return f"{ShardedIndex.SHARD_FILENAME}.{kind}.{prefix}"
+
+
+def summary_prefix(key, length):
+    return hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:length]
+
+
+def hash_prefix(hash, length):
+    digest = hash.partition(hashing.DELIMITER)[2]
+    return digest[:length].lower().ljust(length, "0")
+
+
+def id_prefix(id, length):
+    return id.replace("-", "")[:length].lower().ljust(length, "0")
+
+
+def check_version(version, what, repair=False):
+    if version > settings.VERSION:
+        logger.critical(f"{what} version ({version}) exceeds software version ({settings.VERSION}).  You need to update your software to parse this index.")
+        raise RuntimeError("Outdated software")
+
+    if version < settings.VERSION and not repair:
+        logger.critical(f"{what} version ({version}) is below software version ({settings.VERSION}).  You need to update it by running `mm <service> refresh`.")
+        raise RuntimeError("Outdated metadata")
+
+
+class Shard:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = {}  # id: file
+        self.hash_aliases = {}  # hash: primary hash (stored in another shard)
+        self.id_aliases = {}  # id: primary hash (stored in another shard)
+        self.hash_to_id_map = {}
+        self.dirty = False
+
+    @classmethod
+    def from_json(cls, prefix, shard_json, repair=False):
+        """With `repair`, an outdated shard is migrated (and marked dirty)."""
+        version = shard_json["version"]
+        check_version(version, f"Index shard '{prefix}'", repair=repair)
+
+        files = shard_json["files"]
+        if version < settings.VERSION:
+            files = migration.repair_metadata({"version": version, "files": files})["files"]
+
+        shard = cls(prefix)
+        shard.hash_aliases = shard_json["hash_aliases"]
+        shard.id_aliases = shard_json["id_aliases"]
+        for file in files.values():
+            shard.add_file(file)
+        shard.dirty = version < settings.VERSION
+        return shard
+
+    def to_json(self):
+        return {
+            "version": settings.VERSION,
+            "files": self.files,
+            "hash_aliases": self.hash_aliases,
+            "id_aliases": self.id_aliases,
+        }
+
+    def add_file(self, file):
+        self.files[file["id"]] = file
+        for hash in file["hashes"] + file["merged_hashes"]:
+            self.hash_to_id_map[hash] = file["id"]
+        self.dirty = True
+
+    def remove_file(self, id):
+        file = self.files.pop(id)
+        for hash in file["hashes"] + file["merged_hashes"]:
+            self.hash_to_id_map.pop(hash, None)
+        self.dirty = True
+        return file
+
+    def add_alias(self, aliases, alias, primary_hash):
+        aliases[alias] = primary_hash
+        self.dirty = True
+
+    def remove_alias(self, aliases, alias):
+        if aliases.pop(alias, None) is not None:
+            self.dirty = True
+
+
+class Summary:
+    """
+    A shard of the names ({name: {id: primary hash}}) or sizes ({size:
+    {"files": count, "unfingerprinted": count, "fingerprints": {fingerprint:
+    count}}}) summary.
+    """
+
+    def __init__(self, kind, prefix):
+        self.kind = kind
+        self.prefix = prefix
+        self.entries = {}
+        self.dirty = False
+
+    @classmethod
+    def from_json(cls, kind, prefix, summary_json):
+        check_version(summary_json["version"], f"Index summary '{kind}.{prefix}'")
+        summary = cls(kind, prefix)
+        summary.entries = summary_json["entries"]
+        return summary
+
+    def to_json(self):
+        return {
+            "version": settings.VERSION,
+            "entries": self.entries,
+        }
+
+    def count_name(self, file, delta):
+        ids = self.entries.setdefault(file["name"], {})
+        if delta > 0:
+            ids[file["id"]] = file["hashes"][0]
+        else:
+            ids.pop(file["id"], None)
+        if not ids:
+            del self.entries[file["name"]]
+        self.dirty = True
+
+    def count_size(self, file, delta):
+        entry = self.entries.setdefault(str(file["size"]), {"files": 0, "unfingerprinted": 0, "fingerprints": {}})
+        entry["files"] += delta
+        if file["fingerprint"] is None:
+            entry["unfingerprinted"] += delta
+        else:
+            fingerprints = entry["fingerprints"]
+            fingerprints[file["fingerprint"]] = fingerprints.get(file["fingerprint"], 0) + delta
+            if fingerprints[file["fingerprint"]] <= 0:
+                del fingerprints[file["fingerprint"]]
+        if entry["files"] <= 0:
+            del self.entries[str(file["size"])]
+        self.dirty = True
+
+
+class ShardedIndex(base.BaseIndex):
+
+    MANIFEST_FILENAME = "index.manifest"
+    SHARD_FILENAME = "index"
+
+    def __init__(self, service):
+        super().__init__(service)
+        logger.debug(f"ShardedIndex init for {service}")
+
+        self.manifest = None
+        self.manifest_dirty = False
+        self.shards = {}  # prefix: Shard
+        self.summaries = {}  # (kind, prefix): Summary
+        self.batching = False
+        self.repairing = False
+        self.cache = cache.IndexCache(service)
+
+    def force_init(self):
+        self.init_metadata()
+
+    def prefix_length(self):
+        return self.manifest["prefix_length"]
+
+    def init_metadata(self, repair=False):
+        if self.manifest is not None:
+            return
+
+        file_list = self.service.search_by_name(ShardedIndex.MANIFEST_FILENAME)
+        files = file_list.results()
+
+        if len(files) > 1:
+            raise RuntimeError(ERROR_MULTIPLE_REMOTE_MANIFESTS.format(self.service))
+
+        if not files:
+            logger.debug(f"creating manifest")
+            self.create_manifest()
+        else:
+            logger.debug(f"loading manifest")
+            self.manifest = json.loads(self.download_text(files[0], ShardedIndex.MANIFEST_FILENAME))
+            check_version(self.manifest["version"], "Index manifest", repair=repair)
+            if self.manifest["version"] < settings.VERSION:
+                self.repair_shards()
+            if "summaries" not in self.manifest:
+                self.build_summaries()
+
+    def repair_shards(self):
+        """Migrates every shard, then the manifest, to the current version."""
+        logger.info(f"Migrating index shards from version {self.manifest['version']} to {settings.VERSION}...")
+        self.repairing = True
+        try:
+            self.load_all_shards()
+        finally:
+            self.repairing = False
+
+        self.manifest["version"] = settings.VERSION
+        self.manifest_dirty = True
+        self.flush()
+
+    def build_summaries(self):
+        """Summarizes every file, for a manifest from before summaries were kept."""
+        logger.info(f"Building index summaries...")
+        self.manifest["summaries"] = {kind: [] for kind in SUMMARY_KINDS}
+        for shard in list(self.load_all_shards()):
+            for file in shard.files.values():
+                self.summarize(file, 1)
+
+        self.manifest_dirty = True
+        self.flush()
+
+    def create_manifest(self):
+        self.manifest = create_manifest()
+        self.manifest_dirty = True
+
+        # NOTE: switching backends imports the existing JSON index (if any)
+        if self.service.search_by_name(jsonindex.Index.INDEX_FILENAME).results():
+            logger.info(f"Importing JSON index into {self.prefix_length() * 4}-bit shards...")
+            for file in jsonindex.Index(self.service).import_files().values():
+                self.insert_file(file)
+
+        self.flush()
+
+    def download_shard(self, name):
+        """Returns the JSON of the named shard (listed in the manifest), or None if it's missing."""
+        files = self.service.search_by_name(name).results()
+        if len(files) > 1:
+            raise RuntimeError(ERROR_MULTIPLE_REMOTE_SHARDS.format(name, self.service))
+
+        if not files:
+            logger.warning(f"Index shard '{name}' is listed in the manifest, but missing!")
+            return None
+
+        logger.debug(f"loading shard '{name}'")
+        return json.loads(self.download_text(files[0], name))
+
+    def load_shard(self, prefix):
+        if prefix in self.shards:
+            return self.shards[prefix]
+
+        shard_json = self.download_shard(shard_name(prefix)) if prefix in self.manifest["shards"] else None
+        if shard_json is None:
+            shard = Shard(prefix)
+        else:
+            shard = Shard.from_json(prefix, shard_json, repair=self.repairing)
+
+        self.shards[prefix] = shard
+        return shard
+
+    def load_all_shards(self):
+        for prefix in self.manifest["shards"]:
+            self.load_shard(prefix)
+        return self.shards.values()
+
+    def load_summary(self, kind, prefix):
+        if (kind, prefix) in self.summaries:
+            return self.summaries[(kind, prefix)]
+
+        summary_json = None
+        if prefix in self.manifest["summaries"][kind]:
+            summary_json = self.download_shard(summary_name(kind, prefix))
+        if summary_json is None:
+            summary = Summary(kind, prefix)
+        else:
+            summary = Summary.from_json(kind, prefix, summary_json)
+
+        self.summaries[(kind, prefix)] = summary
+        return summary
+
+    def summary_of(self, kind, key):
+        return self.load_summary(kind, summary_prefix(key, self.prefix_length()))
+
+    def summarize(self, file, delta):
+        """Counts the file in (or, with a negative delta, out of) its summaries."""
+        self.summary_of(NAMES, file["name"]).count_name(file, delta)
+        self.summary_of(SIZES, file["size"]).count_size(file, delta)
+
+    def flush(self):
+        """Uploads the shards touched since the last flush (and the manifest, if a shard was added)."""
+        for shard in self.shards.values():
+            if not shard.dirty:
+                continue
+
+            self.upload_text(shard_name(shard.prefix), json.dumps(shard.to_json()))
+            shard.dirty = False
+
+            if shard.prefix not in self.manifest["shards"]:
+                self.manifest["shards"] = sorted(self.manifest["shards"] + [shard.prefix])
+                self.manifest_dirty = True
+
+        for summary in self.summaries.values():
+            if not summary.dirty:
+                continue
+
+            self.upload_text(summary_name(summary.kind, summary.prefix), json.dumps(summary.to_json()))
+            summary.dirty = False
+
+            prefixes = self.manifest["summaries"][summary.kind]
+            if summary.prefix not in prefixes:
+                self.manifest["summaries"][summary.kind] = sorted(prefixes + [summary.prefix])
+                self.manifest_dirty = True
+
+        if self.manifest_dirty:
+            self.upload_text(ShardedIndex.MANIFEST_FILENAME, json.dumps(self.manifest))
+            self.manifest_dirty = False
+
+    def commit(self):
+        if not self.batching:
+            self.flush()
+
+    def reset(self):
+        """Discards all in-memory state, forcing a reload on next use."""
+        self.manifest = None
+        self.manifest_dirty = False
+        self.shards = {}
+        self.summaries = {}
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups index mutations, uploading each touched shard once when the
+        batch exits cleanly.
+        """
+        if self.batching:
+            yield self
+            return
+
+        self.batching = True
+        try:
+            with self.service.batch():
+                yield self
+            if self.manifest is not None:
+                self.flush()
+        except BaseException:
+            logger.warning(f"Rolling back index batch for {self.service}")
+            self.reset()
+            raise
+        finally:
+            self.batching = False
+
+    def locate_hash(self, hash):
+        """Returns (shard, id) of the file with the given hash, or (None, None)."""
+        shard = self.load_shard(hash_prefix(hash, self.prefix_length()))
+        id = shard.hash_to_id_map.get(hash)
+        if id is not None:
+            return (shard, id)
+
+        primary_hash = shard.hash_aliases.get(hash)
+        if primary_hash is None:
+            return (None, None)
+
+        shard = self.load_shard(hash_prefix(primary_hash, self.prefix_length()))
+        return (shard, shard.hash_to_id_map[primary_hash])
+
+    def locate_uuid(self, uuid):
+        shard = self.load_shard(id_prefix(uuid, self.prefix_length()))
+        if uuid in shard.files:
+            return (shard, uuid)
+
+        primary_hash = shard.id_aliases.get(uuid)
+        if primary_hash is None:
+            return (None, None)
+
+        return (self.load_shard(hash_prefix(primary_hash, self.prefix_length())), uuid)
+
+    def aliases_of(self, file):
+        """Yields (shard, aliases, alias) for each alias of the file stored outside its own shard."""
+        length = self.prefix_length()
+        (primary_hash, *other_hashes) = file["hashes"]
+        primary_prefix = hash_prefix(primary_hash, length)
+
+        for hash in other_hashes + file["merged_hashes"]:
+            if hash_prefix(hash, length) != primary_prefix:
+                shard = self.load_shard(hash_prefix(hash, length))
+                yield (shard, shard.hash_aliases, hash)
+
+        if id_prefix(file["id"], length) != primary_prefix:
+            shard = self.load_shard(id_prefix(file["id"], length))
+            yield (shard, shard.id_aliases, file["id"])
+
+    def insert_file(self, file):
+        primary_hash = file["hashes"][0]
+        self.load_shard(hash_prefix(primary_hash, self.prefix_length())).add_file(file)
+        for (shard, aliases, alias) in self.aliases_of(file):
+            shard.add_alias(aliases, alias, primary_hash)
+        self.summarize(file, 1)
+
+    def delete_file(self, shard, id):
+        file = shard.remove_file(id)
+        for (alias_shard, aliases, alias) in self.aliases_of(file):
+            alias_shard.remove_alias(aliases, alias)
+        self.summarize(file, -1)
+        return file
+
+    def files_named(self, names):
+        """Yields the files with the given names, through the name summaries."""
+        for name in names:
+            ids = self.summary_of(NAMES, name).entries.get(name, {})
+            for (id, primary_hash) in ids.items():
+                (shard, _) = self.locate_hash(primary_hash)
+                yield shard.files[id]
+
+    @init
+    def new_id(self):
+        id = str(uuid.uuid4())
+        while self.has_uuid(id):
+            id = str(uuid.uuid4())
+        return id
+
+    @init
+    def get_metadata_by_hash(self, hash):
+        (shard, id) = self.locate_hash(hash)
+        if shard is None:
+            raise KeyError(hash)
+        return shard.files[id]
+
+    @init
+    def get_metadata_by_uuid(self, uuid):
+        (shard, id) = self.locate_uuid(uuid)
+        if shard is None:
+            raise KeyError(uuid)
+        return shard.files[id]
+
+    @init
+    def list_files(self):
+        return iter([file for shard in self.load_all_shards() for file in shard.files.values()])
+
+    @init
+    def search_by_name(self, file_name):
+        return list(self.files_named([file_name]))
+
+    @init
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        query = file_name.lower()
+        matches = []  # [(name, id)]
+        for prefix in self.manifest["summaries"][NAMES]:
+            for (name, ids) in self.load_summary(NAMES, prefix).entries.items():
+                if query in name.lower():
+                    matches.extend((name, id) for id in ids)
+
+        # NOTE: only the files ranked within the limit are loaded
+        ranked = trigrams.top(file_name, matches, key=lambda match: match[0], limit=limit)
+        files = {file["id"]: file for file in self.files_named(dict.fromkeys(name for (name, _) in ranked))}
+        return [files[id] for (_, id) in ranked]
+
+    @init
+    def search_by_hash(self, hash):
+        return self.search_by_hashes([hash])[hash]
+
+    @init
+    def search_by_hashes(self, hashes):
+        """Resolve many hashes at once, returning {hash: [file, ...]}."""
+        results = {}
+        for hash in sorted(set(hashes), key=lambda hash: hash_prefix(hash, self.prefix_length())):
+            (shard, id) = self.locate_hash(hash)
+            results[hash] = [] if shard is None else [shard.files[id]]
+        return {hash: results[hash] for hash in hashes}
+
+    @init
+    def has_hash(self, hash):
+        return self.locate_hash(hash)[0] is not None
+
+    @init
+    def has_uuid(self, uuid):
+        return self.locate_uuid(uuid)[0] is not None
+
+    @init
+    def has_size(self, size):
+        return str(size) in self.summary_of(SIZES, size).entries
+
+    @init
+    def has_fingerprint(self, fingerprint):
+        size = hashing.fingerprint_size(fingerprint)
+        entry = self.summary_of(SIZES, size).entries.get(str(size))
+        if entry is None:
+            return False
+        return entry["unfingerprinted"] > 0 or fingerprint in entry["fingerprints"]
+
+    @init
+    def has_name(self, name):
+        return name in self.summary_of(NAMES, name).entries
+
+    @init
+    def track_file(self, file):
+        logger.debug(file)
+        self.insert_file(file)
+        self.commit()
+
+    @init
+    def remove(self, request):
+        hash = request.hash
+        (shard, id) = self.locate_hash(hash)
+        if shard is None:
+            logger.error(f"[-] No such file exists with that hash!")
+            return None
+
+        result = self.service.remove(shard.files[id]["sid"])
+        logger.info(result)
+        self.remove_merkle(shard.files[id])
+
+        self.delete_file(shard, id)
+        self.commit()
+
+        return result
+
+    @init
+    def add_hashes(self, file, hashes):
+        """Adds hashes to a tracked file, updating its aliases."""
+        (shard, id) = self.locate_hash(file["hashes"][0])
+        self.delete_file(shard, id)
+        file["hashes"] = file["hashes"] + [hash for hash in hashes if hash not in file["hashes"]]
+        self.insert_file(file)
+
+    @init
+    def add_file_hashes(self, file, hashes):
+        self.add_hashes(file, hashes)
+        self.commit()
+
+    @init
+    def add_file_fingerprint(self, file, fingerprint):
+        (shard, id) = self.locate_hash(file["hashes"][0])
+        self.summarize(shard.files[id], -1)
+        shard.files[id]["fingerprint"] = fingerprint
+        self.summarize(shard.files[id], 1)
+        shard.dirty = True
+        self.commit()
+
+    @init
+    def add_file_merkle(self, file, merkle_root, merkle_sid):
+        (shard, id) = self.locate_hash(file["hashes"][0])
+        shard.files[id]["merkle_root"] = merkle_root
+        shard.files[id]["merkle_sid"] = merkle_sid
+        shard.dirty = True
+        self.commit()
+
+    @init
+    def add_file_crypt(self, file, crypt):
+        (shard, id) = self.locate_hash(file["hashes"][0])
+        shard.files[id]["crypt"] = crypt
+        shard.dirty = True
+        self.commit()
+
+    @init
+    def add_file_size(self, file, size):
+        (shard, id) = self.locate_hash(file["hashes"][0])
+        self.summarize(shard.files[id], -1)
+        shard.files[id]["size"] = size
+        self.summarize(shard.files[id], 1)
+        shard.dirty = True
+        self.commit()
+
+    def refresh(self):
+        self.init_metadata(repair=True)
+        self.refresh_ciphers()
+
+        inp = input("Would you like to refresh the file hashes?  This may take a long time, but is useful when you have changed the preferred hash function. [Y/n]  ")
+        if inp in 'yY':
+            self.refresh_hashes()
+
+    @init
+    def refresh_global_hashes(self, hashes_by_hash):
+        for (hash, hashes) in hashes_by_hash.items():
+            if self.has_hash(hash):
+                file = self.get_metadata_by_hash(hash)
+                self.add_hashes(file, sorted(hashes - set(file["hashes"])))
+
+        # TODO: there's no context here, user doesn't
+        # know which service they're approving changes for...
+        print(f"Repaired hashes: {list(self.list_files())}")
+        inp = input("Does everything look good? [Y/n] ")
+        if inp not in 'yY':
+            print("Cancelled.")
+            self.reset()
+            return
+
+        self.flush()
@@ -0,0 +1,566 @@
+"""
+An Index backed by a SQLite database, stored with the service in place of
+the JSON "index" file.
+
+Files, hashes and merged hashes live in separate indexed tables, so
+lookups by name, hash, uuid and size are answered by the database rather
+than by in-memory dicts rebuilt on every load.
+
+Like the JSON index, mutations are journaled: each flush uploads the
+records made since the last one as a journal segment
+("index.sqlite.journal.<last seq>", in the JSON index's record format),
+and the database itself is only uploaded when the journal is compacted.
+Loading replays the journal into the downloaded database.
+"""
+
+import contextlib
+import functools
+import itertools
+import json
+import shutil
+import sqlite3
+import tempfile
+import uuid
+
+from mediaman.core import hashing
+from mediaman.core import logtools
+from mediaman.core import models
+from mediaman.core import settings
+from mediaman.core.index import base
+from mediaman.core.index import cache
+from mediaman.core.index import index as jsonindex
+from mediaman.core.index import migration
+from mediaman.core.utils import trigrams
+
+logger = logtools.new_logger("mediaman.core.index.sqlite")
+
+
+ERROR_MULTIPLE_REMOTE_DATABASES = "\
+[!] Multiple index databases found for service ({})!  \
+This must be resolved manually.  Exiting..."
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS files (
+    key INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    sid TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fingerprint TEXT,
+    merkle_root TEXT,
+    merkle_sid TEXT,
+    crypt TEXT
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+CREATE INDEX IF NOT EXISTS files_fingerprint ON files (fingerprint);
+CREATE TABLE IF NOT EXISTS hashes (
+    hash TEXT PRIMARY KEY,
+    key INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hashes_key ON hashes (key);
+CREATE TABLE IF NOT EXISTS merged_hashes (
+    hash TEXT PRIMARY KEY,
+    key INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS merged_hashes_key ON merged_hashes (key);
+"""
+
+FILE_COLUMNS = "key, id, name, sid, size, fingerprint, merkle_root, merkle_sid, crypt"
+
+# Every file row, with one row per (merged) hash, in order (see `query_files`)
+FILES_WITH_HASHES = f"""
+SELECT {", ".join(f"files.{column}" for column in FILE_COLUMNS.split(", "))}, all_hashes.merged, all_hashes.hash
+FROM files LEFT JOIN (
+    SELECT key, 0 AS merged, position, hash FROM hashes
+    UNION ALL SELECT key, 1 AS merged, position, hash FROM merged_hashes
+) AS all_hashes ON all_hashes.key = files.key
+"""
+
+# Schema changes to bring a database from each version to the next
+# (see `migration.repair_metadata` for the JSON index equivalents).
+MIGRATIONS = {
+    2: """
+ALTER TABLE files ADD COLUMN fingerprint TEXT;
+CREATE INDEX IF NOT EXISTS files_fingerprint ON files (fingerprint);
+""",
+    3: """
+ALTER TABLE files ADD COLUMN merkle_root TEXT;
+ALTER TABLE files ADD COLUMN merkle_sid TEXT;
+""",
+    4: """
+ALTER TABLE files ADD COLUMN crypt TEXT;
+""",
+}
+
+# Stays well under SQLite's bound-parameter limit
+QUERY_CHUNK_SIZE = 500
+
+
+def encode_crypt(crypt):
+    # NOTE: cipher params are stored as JSON, NULL if unknown
+    return None if crypt is None else json.dumps(crypt)
+
+
+def decode_crypt(text):
+    return None if text is None else json.loads(text)
+
+
+def init(func):
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        self.init_metadata()
+        return func(self, *args, **kwargs)
+    return wrapped
+
+
+class SqliteIndex(base.BaseIndex):
+
+    DATABASE_FILENAME = "index.sqlite"
+    JOURNAL_FILENAME = "index.sqlite.journal"
+
+    def __init__(self, service):
+        super().__init__(service)
+        logger.debug(f"SqliteIndex init for {service}")
+
+        self.database_id = None
+        self.connection = None
+        self.snapshot_sequence = 0
+        self.sequence = 0
+        self.segments = []
+        self.journal_length = 0
+        self.unflushed = []
+        self.journal_damaged = False
+        self.batching = False
+        self.cache = cache.IndexCache(service)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database_path = f"{self.temp_dir.name}/{SqliteIndex.DATABASE_FILENAME}"
+
+    def force_init(self):
+        self.init_metadata()
+
+    def init_metadata(self, repair=False):
+        if self.connection is not None:
+            return
+
+        file_list = self.service.search_by_name(SqliteIndex.DATABASE_FILENAME)
+        files = file_list.results()
+
+        if len(files) > 1:
+            raise RuntimeError(ERROR_MULTIPLE_REMOTE_DATABASES.format(self.service))
+
+        if not files:
+            logger.debug(f"creating database")
+            self.connect()
+            self.create_database()
+        else:
+            logger.debug(f"loading database")
+            self.load_database(files[0], repair=repair)
+
+    def connect(self):
+        self.connection = sqlite3.connect(self.database_path)
+        self.connection.row_factory = sqlite3.Row
+
+    def create_database(self):
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            self.connection.execute("INSERT INTO meta VALUES ('version', ?)", (settings.VERSION,))
+
+        # NOTE: switching backends imports the existing JSON index (if any)
+        if self.service.search_by_name(jsonindex.Index.INDEX_FILENAME).results():
+            logger.info(f"Importing JSON index into {SqliteIndex.DATABASE_FILENAME}...")
+            self.import_metadata(jsonindex.Index(self.service))
+
+        self.update_database()
+
+    def import_metadata(self, json_index):
+        # NOTE: older JSON indexes are repaired as they're imported
+        with self.connection:
+            for (key, file) in json_index.import_files().items():
+                self.insert_file(int(key), file)
+
+    def load_database(self, database, repair=False):
+        self.database_id = database.id()
+
+        validator = database.validator()
+        cached_path = self.cache.load(SqliteIndex.DATABASE_FILENAME, validator)
+        if cached_path is not None:
+            shutil.copyfile(cached_path, self.database_path)
+        else:
+            request = models.Request(
+                id=self.database_id,
+                path=self.database_path,
+            )
+            self.service.download(request)
+            self.cache.store(SqliteIndex.DATABASE_FILENAME, validator, self.database_path)
+        self.connect()
+
+        version = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        if version > settings.VERSION:
+            logger.critical(f"Metadata version ({version}) exceeds software version ({settings.VERSION}).  You need to update your software to parse this index database.")
+            raise RuntimeError("Outdated software")
+
+        if version < settings.VERSION and not repair:
+            logger.critical(f"Metadata version ({version}) is below software version ({settings.VERSION}).  You need to update it by running `mm <service> refresh`.")
+            raise RuntimeError("Outdated metadata")
+
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'sequence'").fetchone()
+        self.snapshot_sequence = row[0] if row else 0
+        self.sequence = self.snapshot_sequence
+
+        if version < settings.VERSION:
+            self.repair_database(version)
+        self.load_journal(self.find_segments(SqliteIndex.JOURNAL_FILENAME))
+
+        if version < settings.VERSION:
+            self.update_database()
+
+    def load_journal(self, segments):
+        """Replays the journal segments into the database (see `read_journal`)."""
+        self.segments = [(segment.name(), segment.id()) for segment in segments]
+        self.journal_length = 0
+        self.unflushed = []
+
+        with self.connection:
+            for (version, record) in self.read_journal(segments, SqliteIndex.JOURNAL_FILENAME, self.sequence):
+                if version < settings.VERSION and record["op"] == jsonindex.JOURNAL_ADD:
+                    record["file"] = migration.repair_file(record["file"], version)
+                self.apply_record(record)
+                self.journal_length += 1
+                self.sequence = record["seq"]
+
+        logger.debug(f"Replayed {self.journal_length} journal records from {len(segments)} segments")
+
+    def repair_database(self, version):
+        logger.info(f"Migrating index database from version {version} to {settings.VERSION}...")
+        with self.connection:
+            for from_version in range(version, settings.VERSION):
+                self.connection.executescript(MIGRATIONS[from_version])
+            self.connection.execute("UPDATE meta SET value = ? WHERE key = 'version'", (settings.VERSION,))
+
+    def update_database(self):
+        """Uploads the whole database, folding in (and then deleting) the journal segments."""
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('sequence', ?)", (self.sequence,))
+
+        request = models.Request(
+            id=SqliteIndex.DATABASE_FILENAME,
+            path=self.database_path,
+        )
+        receipt = self.service.upload(request)
+
+        logger.debug(f"update_database receipt: {receipt}")
+        self.database_id = receipt.id()
+
+        validator = self.service.list_file(self.database_id).validator()
+        self.cache.store(SqliteIndex.DATABASE_FILENAME, validator, self.database_path)
+
+        self.remove_segments(self.segments)
+        self.snapshot_sequence = self.sequence
+        self.segments = []
+        self.journal_length = 0
+        self.unflushed = []
+        self.journal_damaged = False
+
+    def flush(self):
+        self.connection.commit()
+        if not self.unflushed:
+            return
+
+        if self.journal_damaged:
+            # NOTE: later segments may reuse the damaged ones' names
+            logger.info(f"Compacting damaged index journal...")
+            self.update_database()
+        elif self.journal_length >= base.JOURNAL_COMPACTION_THRESHOLD or len(self.segments) >= base.JOURNAL_SEGMENT_LIMIT:
+            logger.info(f"Compacting index journal ({self.journal_length} records, {len(self.segments)} segments)...")
+            self.update_database()
+        else:
+            self.segments.append(self.upload_segment(
+                SqliteIndex.JOURNAL_FILENAME, self.snapshot_sequence, self.sequence, self.unflushed))
+            self.unflushed = []
+
+    def reset(self):
+        """Discards all in-memory state, forcing a reload on next use."""
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.database_id = None
+        self.snapshot_sequence = 0
+        self.sequence = 0
+        self.segments = []
+        self.journal_length = 0
+        self.unflushed = []
+        self.journal_damaged = False
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups index mutations into a single database transaction,
+        journaled once when the batch exits cleanly.
+        """
+        if self.batching:
+            yield self
+            return
+
+        self.batching = True
+        try:
+            with self.service.batch():
+                yield self
+            if self.connection is not None:
+                self.flush()
+        except BaseException:
+            logger.warning(f"Rolling back index batch for {self.service}")
+            if self.connection is not None:
+                self.connection.rollback()
+            self.reset()
+            raise
+        finally:
+            self.batching = False
+
+    def commit(self):
+        if not self.batching:
+            self.flush()
+
+    def append_journal(self, op, key, **fields):
+        """
+        Applies a single mutation to the database and records it in the
+        journal, which is uploaded on commit (see `flush`).
+        """
+        self.sequence += 1
+        record = base.create_journal_record(self.sequence, op, key, **fields)
+        self.apply_record(record)
+        self.unflushed.append(json.dumps(record))
+        self.journal_length += 1
+        self.commit()
+
+    def apply_record(self, record):
+        op = record["op"]
+        key = record["key"]
+        if op == jsonindex.JOURNAL_ADD:
+            self.insert_file(key, record["file"])
+        elif op == jsonindex.JOURNAL_REMOVE:
+            for table in ("files", "hashes", "merged_hashes"):
+                self.connection.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+        elif op == jsonindex.JOURNAL_HASHES:
+            known = set(self.hashes_of(key))
+            for hash in record["hashes"]:
+                if hash not in known:
+                    self.add_hash(key, hash)
+                    known.add(hash)
+        elif op == jsonindex.JOURNAL_FINGERPRINT:
+            self.connection.execute("UPDATE files SET fingerprint = ? WHERE key = ?", (record["fingerprint"], key))
+        elif op == jsonindex.JOURNAL_MERKLE:
+            self.connection.execute("UPDATE files SET merkle_root = ?, merkle_sid = ? WHERE key = ?", (record["merkle_root"], record["merkle_sid"], key))
+        elif op == jsonindex.JOURNAL_CRYPT:
+            self.connection.execute("UPDATE files SET crypt = ? WHERE key = ?", (encode_crypt(record["crypt"]), key))
+        elif op == jsonindex.JOURNAL_SIZE:
+            self.connection.execute("UPDATE files SET size = ? WHERE key = ?", (record["size"], key))
+        else:
+            raise RuntimeError(f"Unknown journal record: {record}")
+
+    def insert_file(self, key, file):
+        self.connection.execute(
+            f"INSERT INTO files ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, file["id"], file["name"], file["sid"], file["size"], file["fingerprint"], file["merkle_root"], file["merkle_sid"], encode_crypt(file["crypt"])))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+            ((hash, key, position) for (position, hash) in enumerate(file["hashes"])))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO merged_hashes VALUES (?, ?, ?)",
+            ((hash, key, position) for (position, hash) in enumerate(file["merged_hashes"])))
+
+    def rows_to_file(self, rows):
+        """A file from its rows of `FILES_WITH_HASHES`."""
+        row = rows[0]
+        hashes = [r["hash"] for r in rows if r["merged"] == 0]
+        merged_hashes = [r["hash"] for r in rows if r["merged"] == 1]
+        return base.create_file(row["id"], row["name"], row["sid"], row["size"], hashes, merged_hashes, row["fingerprint"], row["merkle_root"], row["merkle_sid"], decode_crypt(row["crypt"]))
+
+    def query_keyed_files(self, where="", params=()):
+        """The (key, file) of files matching the given clause (on `files.` columns), with their hashes, in one query."""
+        rows = self.connection.execute(
+            f"{FILES_WITH_HASHES} {where} ORDER BY files.key, all_hashes.merged, all_hashes.position", params)
+        return [(key, self.rows_to_file(list(file_rows))) for (key, file_rows) in itertools.groupby(rows, key=lambda row: row["key"])]
+
+    def query_files(self, where="", params=()):
+        return [file for (_, file) in self.query_keyed_files(where, params)]
+
+    def query_files_by_keys(self, keys):
+        """The files with the given keys, in the same order."""
+        files = {}
+        for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+            chunk = keys[start:start + QUERY_CHUNK_SIZE]
+            files.update(self.query_keyed_files(f"WHERE files.key IN ({', '.join('?' * len(chunk))})", chunk))
+        return [files[key] for key in keys]
+
+    def key_by_id(self, id):
+        return self.connection.execute("SELECT key FROM files WHERE id = ?", (id,)).fetchone()["key"]
+
+    def hashes_of(self, key):
+        return [row["hash"] for row in self.connection.execute("SELECT hash FROM hashes WHERE key = ? ORDER BY position", (key,))]
+
+    def key_by_hash(self, hash):
+        row = self.connection.execute(
+            "SELECT key FROM hashes WHERE hash = ? UNION ALL SELECT key FROM merged_hashes WHERE hash = ?",
+            (hash, hash)).fetchone()
+        return row["key"] if row else None
+
+    @init
+    def new_id(self):
+        id = str(uuid.uuid4())
+        while self.has_uuid(id):
+            id = str(uuid.uuid4())
+        return id
+
+    @init
+    def get_metadata_by_hash(self, hash):
+        return self.query_files("WHERE files.key = ?", (self.key_by_hash(hash),))[0]
+
+    @init
+    def get_metadata_by_uuid(self, uuid):
+        return self.query_files("WHERE files.id = ?", (uuid,))[0]
+
+    @init
+    def list_files(self):
+        return iter(self.query_files())
+
+    @init
+    def search_by_name(self, file_name):
+        return self.query_files("WHERE files.name = ?", (file_name,))
+
+    @init
+    def search_by_size(self, size):
+        return self.query_files("WHERE files.size = ?", (size,))
+
+    @init
+    def fuzzy_search_by_name(self, file_name, limit=None):
+        pattern = "%" + file_name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = self.connection.execute(f"SELECT key, name FROM files WHERE name LIKE ? ESCAPE '\\'", (pattern,))
+        ranked = trigrams.top(file_name, rows.fetchall(), key=lambda row: row["name"], limit=limit)
+        return self.query_files_by_keys([row["key"] for row in ranked])
+
+    @init
+    def search_by_hash(self, hash):
+        return self.search_by_hashes([hash])[hash]
+
+    @init
+    def search_by_hashes(self, hashes):
+        """Resolve many hashes at once, returning {hash: [file, ...]}."""
+        hashes = list(hashes)
+        keys = {}
+        for start in range(0, len(hashes), QUERY_CHUNK_SIZE):
+            chunk = hashes[start:start + QUERY_CHUNK_SIZE]
+            marks = ", ".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT hash, key FROM hashes WHERE hash IN ({marks}) "
+                f"UNION ALL SELECT hash, key FROM merged_hashes WHERE hash IN ({marks})",
+                chunk + chunk)
+            for row in rows:
+                keys.setdefault(row["hash"], row["key"])
+
+        unique_keys = list(set(keys.values()))
+        files = dict(zip(unique_keys, self.query_files_by_keys(unique_keys)))
+        return {hash: ([files[keys[hash]]] if hash in keys else []) for hash in hashes}
+
+    @init
+    def has_hash(self, hash):
+        return self.key_by_hash(hash) is not None
+
+    @init
+    def has_uuid(self, uuid):
+        return self.connection.execute("SELECT 1 FROM files WHERE id = ?", (uuid,)).fetchone() is not None
+
+    @init
+    def has_size(self, size):
+        return self.connection.execute("SELECT 1 FROM files WHERE size = ?", (size,)).fetchone() is not None
+
+    @init
+    def has_fingerprint(self, fingerprint):
+        return self.connection.execute(
+            "SELECT 1 FROM files WHERE fingerprint = ? OR (fingerprint IS NULL AND size = ?)",
+            (fingerprint, hashing.fingerprint_size(fingerprint))).fetchone() is not None
+
+    @init
+    def has_name(self, name):
+        return self.connection.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is not None
+
+    @init
+    def track_file(self, file):
+        key = self.connection.execute("SELECT COALESCE(MAX(key), -1) + 1 FROM files").fetchone()[0]
+        logger.debug(file)
+        self.append_journal(jsonindex.JOURNAL_ADD, key, file=file)
+
+    @init
+    def remove(self, request):
+        hash = request.hash
+        key = self.key_by_hash(hash)
+        if key is None:
+            logger.error(f"[-] No such file exists with that hash!")
+            return None
+
+        file = self.query_files("WHERE files.key = ?", (key,))[0]
+
+        result = self.service.remove(file["sid"])
+        logger.info(result)
+        self.remove_merkle(file)
+
+        self.append_journal(jsonindex.JOURNAL_REMOVE, key)
+
+        return result
+
+    def add_hash(self, key, hash):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM hashes WHERE key = ?))",
+            (hash, key, key))
+
+    @init
+    def add_file_hashes(self, file, hashes):
+        self.append_journal(jsonindex.JOURNAL_HASHES, self.key_by_id(file["id"]), hashes=hashes)
+
+    @init
+    def add_file_fingerprint(self, file, fingerprint):
+        self.append_journal(jsonindex.JOURNAL_FINGERPRINT, self.key_by_id(file["id"]), fingerprint=fingerprint)
+
+    @init
+    def add_file_merkle(self, file, merkle_root, merkle_sid):
+        self.append_journal(jsonindex.JOURNAL_MERKLE, self.key_by_id(file["id"]), merkle_root=merkle_root, merkle_sid=merkle_sid)
+
+    @init
+    def add_file_crypt(self, file, crypt):
+        self.append_journal(jsonindex.JOURNAL_CRYPT, self.key_by_id(file["id"]), crypt=crypt)
+
+    @init
+    def add_file_size(self, file, size):
+        self.append_journal(jsonindex.JOURNAL_SIZE, self.key_by_id(file["id"]), size=size)
+
+    def refresh(self):
+        self.init_metadata(repair=True)
+        self.refresh_ciphers()
+
+        inp = input("Would you like to refresh the file hashes?  This may take a long time, but is useful when you have changed the preferred hash function. [Y/n]  ")
+        if inp in 'yY':
+            self.refresh_hashes()
+
+    @init
+    def refresh_global_hashes(self, hashes_by_hash):
+        with self.batch():
+            for (hash, hashes) in hashes_by_hash.items():
+                key = self.key_by_hash(hash)
+                if key is None:
+                    continue
+                new_hashes = sorted(hashes - set(self.hashes_of(key)))
+                if new_hashes:
+                    self.append_journal(jsonindex.JOURNAL_HASHES, key, hashes=new_hashes)
+
+            print(f"Repaired hashes: {self.query_files()}")
+            inp = input("Does everything look good? [Y/n] ")
+            if inp not in 'yY':
+                print("Cancelled.")
+                self.connection.rollback()
+                self.reset()
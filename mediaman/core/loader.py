@@ -2,14 +2,53 @@
 
 def load_middleware_applicator():
     from mediaman.middleware import crypto
-    return crypto.EncryptionMiddlewareService
+    from mediaman.services.chunkstore import service as chunkstoreservice
 
+    def apply(service):
+        # NOTE: chunk stores encrypt each chunk after deduping it
+        if isinstance(service, chunkstoreservice.ChunkStoreService):
+            return service
+        return crypto.EncryptionMiddlewareService(service)
 
-def load_index_class():
+    return apply
+
+
+INDEX_BACKEND_KEY = "index-backend"
+DEFAULT_INDEX_BACKEND = "json"
+
+
+def load_json_index_class():
     from mediaman.core.index.index import Index
     return Index
 
 
+def load_sqlite_index_class():
+    from mediaman.core.index.sqlite import SqliteIndex
+    return SqliteIndex
+
+
+def load_sharded_index_class():
+    from mediaman.core.index.sharded import ShardedIndex
+    return ShardedIndex
+
+
+INDEX_BACKEND_TO_LOADER = {
+    "json": load_json_index_class,
+    "sqlite": load_sqlite_index_class,
+    "sharded": load_sharded_index_class,
+}
+
+
+def load_index_class():
+    from mediaman import config
+    backend = config.load(INDEX_BACKEND_KEY, default=DEFAULT_INDEX_BACKEND)
+    try:
+        return INDEX_BACKEND_TO_LOADER[backend]()
+    except KeyError:
+        print(f"No index backend named '{backend}'!  Choose one of: {', '.join(INDEX_BACKEND_TO_LOADER)}")
+        raise
+
+
 def load_multiindex_class():
     from mediaman.core.multiindex.base import BaseMultiIndex
     return BaseMultiIndex
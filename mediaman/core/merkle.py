@@ -0,0 +1,143 @@
+"""
+Merkle trees of fixed-size block digests, to verify a file piece by piece.
+
+A file is split into BLOCK_SIZE blocks (the last one may be shorter), and
+each block's sha256 is a leaf of a binary tree whose root is recorded in
+the index.  The leaves themselves are stored alongside the file, as a
+sidecar (see `encode`), which is checked against the root before it's
+trusted.  A range of the file can then be verified by hashing only the
+blocks it covers, rather than the whole file.
+
+Leaves and nodes are hashed with different prefixes, so a node can't pass
+for a block (or vice versa).  A node without a sibling is carried up as-is.
+"""
+
+import hashlib
+import struct
+
+from mediaman.core import logtools
+
+logger = logtools.new_logger("mediaman.core.merkle")
+
+
+BLOCK_SIZE = 1024**2
+
+MAGIC = b"MMMT"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHIQ")  # magic, format version, block size, file size
+
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+def leaf_hash(data):
+    hasher = hashlib.sha256(LEAF_PREFIX)
+    hasher.update(data)
+    return hasher.digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def block_count(size, block_size=BLOCK_SIZE):
+    # NOTE: an empty file still has one (empty) block
+    return max(1, -(-size // block_size))
+
+
+def root(leaves):
+    """Returns the hex root of the tree over the given leaf digests."""
+    level = list(leaves) or [leaf_hash(b"")]
+    while len(level) > 1:
+        pairs = [level[i:i + 2] for i in range(0, len(level), 2)]
+        level = [node_hash(*pair) if len(pair) == 2 else pair[0] for pair in pairs]
+    return level[0].hex()
+
+
+class BlockHasher:
+    """Hashes a file's blocks from its bytes, fed in order."""
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.pending = bytearray()
+        self.leaves = []
+
+    def update(self, data):
+        self.pending.extend(data)
+        if len(self.pending) < self.block_size:
+            return
+
+        view = memoryview(self.pending)
+        end = len(self.pending) - len(self.pending) % self.block_size
+        for start in range(0, end, self.block_size):
+            self.leaves.append(leaf_hash(view[start:start + self.block_size]))
+        view.release()
+        del self.pending[:end]
+
+    def digests(self):
+        """The leaf digests of everything fed so far (as a complete file)."""
+        if self.pending or not self.leaves:
+            return self.leaves + [leaf_hash(self.pending)]
+        return list(self.leaves)
+
+
+def block_digests(path):
+    hasher = BlockHasher()
+    with open(path, "rb", buffering=0) as infile:
+        data = bytearray(BLOCK_SIZE)
+        view = memoryview(data)
+        while True:
+            count = infile.readinto(data)
+            if not count:
+                break
+            hasher.update(view[:count])
+    return hasher.digests()
+
+
+def encode(size, leaves, block_size=BLOCK_SIZE):
+    """Encodes the leaves of a file as a sidecar."""
+    return HEADER.pack(MAGIC, FORMAT_VERSION, block_size, size) + b"".join(leaves)
+
+
+def decode(data, expected_root):
+    """
+    Decodes a sidecar into (block size, file size, leaves), verifying the
+    leaves against the root recorded in the index.
+    """
+    (magic, format_version, block_size, size) = HEADER.unpack_from(data)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError(f"Not a version {FORMAT_VERSION} Merkle sidecar")
+
+    body = data[HEADER.size:]
+    leaves = [bytes(body[i:i + DIGEST_SIZE]) for i in range(0, len(body), DIGEST_SIZE)]
+    if len(leaves) != block_count(size, block_size) or root(leaves) != expected_root:
+        logger.critical(f"Merkle sidecar doesn't match its root ({expected_root})!")
+        raise RuntimeError("Corrupt Merkle sidecar")
+
+    return (block_size, size, leaves)
+
+
+def block_span(size, offset, length, block_size=BLOCK_SIZE):
+    """Returns the (first, last + 1) block numbers covering the given range."""
+    end = min(offset + length, size)
+    first = offset // block_size
+    last = max(first + 1, -(-end // block_size))
+    return (first, last)
+
+
+def blocks(chunks, block_size=BLOCK_SIZE):
+    """Regroups an iterable of byte chunks into blocks (the last may be shorter)."""
+    pending = bytearray()
+    for chunk in chunks:
+        pending.extend(chunk)
+        while len(pending) >= block_size:
+            yield bytes(pending[:block_size])
+            del pending[:block_size]
+    if pending:
+        yield bytes(pending)
+
+
+def verify_block(leaves, number, data):
+    """Whether the given bytes are block `number` of the file."""
+    return number < len(leaves) and leaf_hash(data) == leaves[number]
@@ -1,5 +1,6 @@
 
 from mediaman.core import hashing
+from mediaman.core import merkle
 
 
 def human_bytes(n):
@@ -21,10 +22,27 @@ def human_bytes(n):
 
 class Request:
 
-    def __init__(self, id=None, path=None, hash=None):
+    def __init__(self, id=None, path=None, hash=None, tee_hashes=False, tee_block_digests=True, crypt=None):
+        """
+        With `tee_hashes`, the file is hashed as it's read through `open()`
+        (e.g. while uploading), and `hashes` (along with `fingerprint` and,
+        unless `tee_block_digests` is false, `block_digests`) come from that
+        read.
+
+        `crypt` holds the file's cipher params (see `middleware.crypto`):
+        None if unknown, or {} if the file isn't encrypted.  Uploading
+        through the encryption middleware sets them.
+        """
         self._id = id
         self._path = path
         self._hash = hash
+        self.crypt = crypt
+        self._hashes = None
+        self._fingerprint = None
+        self._block_digests = None
+        self._tee_hashes = tee_hashes
+        self._tee_block_digests = tee_block_digests
+        self._tee = None
 
     @property
     def id(self):
@@ -45,13 +63,66 @@ class Request:
     @property
     def hash(self):
         if self._hash is None:
-            self._hash = hashing.hash(self._path)
+            self._hash = self.hashes[0]
         return self._hash
 
     @hash.setter
     def hash(self, value):
         self._hash = value
 
+    @property
+    def hashes(self):
+        """All recorded hashes of the file, preferred first, from a single read."""
+        if self._hashes is None and self._tee is not None:
+            self._hashes = self._tee.hashes()
+
+        if self._hashes is None:
+            if self._path is None:
+                self._hashes = [self._hash]
+            else:
+                self._hashes = hashing.hashes(self._path)
+        return self._hashes
+
+    @hashes.setter
+    def hashes(self, value):
+        self._hashes = value
+        if self._hash is None:
+            self._hash = value[0]
+
+    @property
+    def fingerprint(self):
+        """The file's fingerprint (see `hashing.fingerprint`), far cheaper than its hashes."""
+        if self._fingerprint is None and self._tee is not None:
+            self._fingerprint = self._tee.fingerprint()
+
+        if self._fingerprint is None:
+            self._fingerprint = hashing.fingerprint(self._path)
+        return self._fingerprint
+
+    @property
+    def block_digests(self):
+        """The file's Merkle leaves (see `merkle`)."""
+        if self._block_digests is None and self._tee is not None:
+            self._block_digests = self._tee.block_digests()
+
+        if self._block_digests is None:
+            self._block_digests = merkle.block_digests(self._path)
+        return self._block_digests
+
+    def open(self):
+        """Opens the file for reading (services should upload through this)."""
+        if not self._tee_hashes:
+            return open(self._path, "rb")
+
+        # NOTE: known hashes aren't recomputed, but the rest still is
+        preferences = [] if self._hashes is not None else hashing.recorded_hashes()
+        self._tee = hashing.HashingFile(self._path, preferences, block_digests=self._tee_block_digests)
+        return self._tee
+
+    @property
+    def is_hashed(self):
+        return self._hash is not None
+
     def __repr__(self):
         # logging should not trigger a call to hash
         return f"Request({self.id}, {self.path}, {self._hash})"
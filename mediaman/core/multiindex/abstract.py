@@ -22,7 +22,7 @@ class AbstractMultiIndex(abc.ABC):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def fuzzy_search_by_name(self, *file_names) -> List[models.AbstractResultFileList]:
+    def fuzzy_search_by_name(self, *file_names, limit=None) -> List[models.AbstractResultFileList]:
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -41,6 +41,10 @@ class AbstractMultiIndex(abc.ABC):
     def stream_range(self, request, offset, length) -> Generator[bytes, None, None]:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def scrub(self, identifier, offset, length):
+        raise NotImplementedError()
+
     def stats(self) -> models.AbstractResultQuota:
         return self.client.stats()
 
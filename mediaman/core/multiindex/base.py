@@ -3,6 +3,7 @@ from functools import partial
 from typing import List, Generator
 
 from mediaman.core import hashing
+from mediaman.core import hashpool
 from mediaman.core import logtools
 from mediaman.core import models
 from mediaman.core import validation
@@ -17,23 +18,29 @@ class BaseMultiIndex(abstract.AbstractMultiIndex):
 
     def has(self, root, *file_paths) -> List[abstractmodels.AbstractResultFile]:
         abs_paths = list(paths.resolve_abs_paths(root, file_paths))
-        requests = (
-            models.Request(id=None, path=path)
-            for path in abs_paths)
-        yield from zip(abs_paths, map(self.client.has, requests))
+        # NOTE: files that can't be indexed yet are never hashed
+        requests = hashpool.hash_requests(
+            (models.Request(id=None, path=path)
+             for path in abs_paths),
+            skip=lambda request: not self.client.might_have(request))
+        yield from ((request.path, self.client.has(request)) for request in requests)
 
     def search_by_name(self, *file_names) -> List[abstractmodels.AbstractResultFileList]:
         yield from zip(file_names, map(self.client.search_by_name, file_names))
 
-    def fuzzy_search_by_name(self, *file_names) -> List[abstractmodels.AbstractResultFileList]:
-        yield from zip(file_names, map(self.client.fuzzy_search_by_name, file_names))
+    def fuzzy_search_by_name(self, *file_names, limit=None) -> List[abstractmodels.AbstractResultFileList]:
+        local_fuzzy_search_by_name = partial(self.client.fuzzy_search_by_name, limit=limit)
+        yield from zip(file_names, map(local_fuzzy_search_by_name, file_names))
 
     def upload(self, root, *file_paths) -> List[abstractmodels.AbstractReceiptFile]:
         abs_paths = list(paths.resolve_abs_paths(root, file_paths))
-        requests = (
-            models.Request(id=None, path=path)
-            for path in abs_paths)
-        yield from zip(abs_paths, map(self.client.upload, requests))
+        # NOTE: files that can't be stored yet are hashed while uploading
+        requests = hashpool.hash_requests(
+            (models.Request(id=None, path=path)
+             for path in abs_paths),
+            skip=lambda request: not self.client.might_have(request))
+        with self.client.batch():
+            yield from ((request.path, self.client.upload(request)) for request in requests)
 
     def download(self, root, *identifiers) -> List[abstractmodels.AbstractReceiptFile]:
         local_download = partial(self.client.download, root)
@@ -45,6 +52,9 @@ class BaseMultiIndex(abstract.AbstractMultiIndex):
     def stream_range(self, root, identifier, offset, length) -> Generator[bytes, None, None]:
         return self.client.stream_range(root, identifier, offset, length)
 
+    def scrub(self, identifier, offset, length):
+        return self.client.scrub(identifier, offset, length)
+
     def remove(self, *identifiers) -> List[abstractmodels.AbstractReceiptFile]:
         for identifier in identifiers:
             # TODO: this should allow any valid hash, or ID
@@ -64,4 +74,5 @@ class BaseMultiIndex(abstract.AbstractMultiIndex):
                 logger.error(f"May only pass hashes to `search-by-hash` method, got '{identifier}'.")
                 return
 
-        yield from zip(identifiers, map(self.client.search_by_hash, identifiers))
+        results = self.client.search_by_hashes(identifiers)
+        yield from ((identifier, results[identifier]) for identifier in identifiers)
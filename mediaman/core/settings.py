@@ -9,4 +9,4 @@ BASE_LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 LOG_LEVELS = [e[0] for e in EXTRA_LOG_LEVELS] + BASE_LOG_LEVELS
 DEFAULT_LOG_LEVEL = "WARNING"
 
-VERSION = 2
+VERSION = 5
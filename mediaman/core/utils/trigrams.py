@@ -0,0 +1,68 @@
+"""
+Lowercase trigram posting lists, for fast substring search over filenames.
+"""
+
+import heapq
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def rank(query, name):
+    """
+    Sort key for a name matching the (lowercase) query; lower is better.
+    Exact matches come first, then prefix matches, then earlier and
+    shorter matches.
+    """
+    lowered = name.lower()
+    position = lowered.find(query)
+    return (lowered != query, position != 0, position, len(name), name)
+
+
+def top(query, items, key=lambda item: item, limit=None):
+    """Return the items ranked against the query, truncated to `limit`."""
+    query = query.lower()
+    sort_key = (lambda item: rank(query, key(item)))
+    if limit is None:
+        return sorted(items, key=sort_key)
+    return heapq.nsmallest(limit, items, key=sort_key)
+
+
+class TrigramIndex:
+
+    def __init__(self):
+        self.postings = {}  # trigram: set(key)
+        self.names = {}  # key: lowercase name
+
+    def add(self, key, name):
+        lowered = name.lower()
+        self.names[key] = lowered
+        for trigram in trigrams(lowered):
+            self.postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        lowered = self.names.pop(key, None)
+        if lowered is None:
+            return
+
+        for trigram in trigrams(lowered):
+            keys = self.postings[trigram]
+            keys.discard(key)
+            if not keys:
+                del self.postings[trigram]
+
+    def candidates(self, query):
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            # NOTE: queries shorter than a trigram can't use the postings
+            return self.names.keys()
+
+        postings = sorted((self.postings.get(t, set()) for t in query_trigrams), key=len)
+        return set.intersection(*postings)
+
+    def search(self, query, limit=None):
+        """Return the keys whose names contain the query, best matches first."""
+        query = query.lower()
+        matches = [key for key in self.candidates(query) if query in self.names[key]]
+        return top(query, matches, key=self.names.__getitem__, limit=limit)
@@ -29,8 +29,15 @@ def is_valid_xxh64(string):
     return (len(string) == 16) and (set(string) <= BASE16_CHARS)
 
 
+def is_valid_xxh3_128(string):
+    string = str(string)
+    if string.startswith("xxh3_128:"):
+        string = string[9:]
+    return (len(string) == 32) and (set(string) <= BASE16_CHARS)
+
+
 def is_valid_hash(string):
-    return is_valid_xxh64(string) or is_valid_sha256(string)
+    return is_valid_xxh64(string) or is_valid_sha256(string) or is_valid_xxh3_128(string)
 
 
 def parse_human_bytes(human_bytes):
@@ -27,6 +27,7 @@ HAS_TEXT = "Check whether MediaMan has the given file(s)"
 GET_TEXT = "Retrieve the given file(s) from MediaMan"
 STREAM_TEXT = "Stream the given file from MediaMan"
 STREAMRANGE_TEXT = "Stream the given file from MediaMan, from offset up to length"
+SCRUB_TEXT = "Verify the given file in MediaMan, from offset up to length"
 PUT_TEXT = "Save the given file(s) to MediaMan"
 SEARCH_TEXT = "Search MediaMan for the given filename(s)"
 FUZZY_TEXT = "Search MediaMan for similar filename(s)"
@@ -41,6 +42,7 @@ HAS_TEXT_SERVICE = "Check whether this service has the given file(s)"
 GET_TEXT_SERVICE = "Retrieve the given file(s) from this service"
 STREAM_TEXT_SERVICE = "Stream the given file from this service"
 STREAMRANGE_TEXT_SERVICE = "Stream the given file from this service, from offset up to length"
+SCRUB_TEXT_SERVICE = "Verify the given file in this service, from offset up to length"
 PUT_TEXT_SERVICE = "Save the given file(s) to this service"
 SEARCH_TEXT_SERVICE = "Search this service for the given filename(s)"
 FUZZY_TEXT_SERVICE = "Search this service for similar filename(s)"
@@ -61,6 +63,7 @@ class Action(enum.Enum):
     GET = "get"
     STREAM = "stream"
     STREAMRANGE = "streamrange"
+    SCRUB = "scrub"
     PUT = "put"
     SEARCH = "search"
     FUZZY = "fuzzy"
@@ -172,6 +175,7 @@ def add_commands(subparsers, service=None):
     p_get = add_parser(Action.GET.value, description=f"[{service}] -- {GET_TEXT_SERVICE}" if service else GET_TEXT)
     p_stream = add_parser(Action.STREAM.value, description=f"[{service}] -- {STREAM_TEXT_SERVICE}" if service else STREAM_TEXT)
     p_streamrange = add_parser(Action.STREAMRANGE.value, description=f"[{service}] -- {STREAMRANGE_TEXT_SERVICE}" if service else STREAMRANGE_TEXT)
+    p_scrub = add_parser(Action.SCRUB.value, description=f"[{service}] -- {SCRUB_TEXT_SERVICE}" if service else SCRUB_TEXT)
     p_put = add_parser(Action.PUT.value, description=f"[{service}] -- {PUT_TEXT_SERVICE}" if service else PUT_TEXT)
     p_search = add_parser(Action.SEARCH.value, description=f"[{service}] -- {SEARCH_TEXT_SERVICE}" if service else SEARCH_TEXT)
     p_fuzzy = add_parser(Action.FUZZY.value, description=f"[{service}] -- {FUZZY_TEXT_SERVICE}" if service else FUZZY_TEXT)
@@ -181,10 +185,10 @@ def add_commands(subparsers, service=None):
     add_parser(Action.REFRESH.value, description=f"[{service}] -- {REFRESH_TEXT_SERVICE}" if service else REFRESH_TEXT)
     p_search_by_hash = add_parser(Action.SEARCH_BY_HASH.value, description=f"[{service}] -- {SEARCH_BY_HASH_TEXT_SERVICE}" if service else SEARCH_BY_HASH_TEXT)
 
-    for parser in [p_stream, p_streamrange]:
+    for parser in [p_stream, p_streamrange, p_scrub]:
         parser.add_argument("file")
 
-    for parser in [p_streamrange]:
+    for parser in [p_streamrange, p_scrub]:
         parser.add_argument("offset", type=int, nargs="?", default=0)
         parser.add_argument("length", type=int, nargs="?", default=-1)
 
@@ -194,6 +198,9 @@ def add_commands(subparsers, service=None):
     for parser in [p_search_by_hash]:
         parser.add_argument("hashes", nargs="+")
 
+    for parser in [p_fuzzy]:
+        parser.add_argument("--limit", type=int, default=None, help="Show only the best N matches per filename")
+
 
 def run_services():
     return api.get_service_names()
@@ -265,7 +272,7 @@ def main():
         elif args.action == "search":
             results = api.run_search(*args.files, service_selector=service_selector)
         elif args.action == "fuzzy":
-            results = api.run_fuzzy(*args.files, service_selector=service_selector)
+            results = api.run_fuzzy(*args.files, limit=args.limit, service_selector=service_selector)
         elif args.action == Action.SEARCH_BY_HASH.value:
             results = api.run_search_by_hash(*args.hashes, service_selector=service_selector)
         else:
@@ -335,6 +342,11 @@ def main():
         for bytez in stream:
             sys.stdout.buffer.write(bytez)
             sys.stdout.buffer.flush()
+    elif args.action == Action.SCRUB.value:
+        result = api.run_scrub(args.file, args.offset, args.length, service_selector=service_selector)
+        print(repr(result))
+        if not result or result["corrupt"]:
+            exit(1)
     elif args.action == "put":
         all_results = api.run_put(root, *args.files, service_selector=service_selector)
         if all_mode:
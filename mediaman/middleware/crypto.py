@@ -1,15 +1,21 @@
 
+import contextlib
 import functools
+import itertools
 import json
 import os
+import shutil
 import subprocess
+import sys
 import tempfile
 
 from mediaman import config
 from mediaman.core import logtools
 from mediaman.core import models
-from mediaman.core import settings
+from mediaman.middleware import enc
+from mediaman.middleware import gcm
 from mediaman.middleware import simple
+from mediaman.services.abstract import models as servicemodels
 
 logger = logtools.new_logger("mediaman.middleware.crypto")
 
@@ -22,11 +28,22 @@ def init(func):
     return wrapped
 
 
+# NOTE: new files are encrypted in the segmented format (see `gcm`); files
+#       tracked with any other cipher are `openssl enc` blobs (see `enc`):
 # <openssl> enc -<e/d> -<cipher> -kfile <keypath> -md <digest> -in <inpath> -out <outpath>
-DEFAULT_CIPHER = "aes-256-cbc"
-DEFAULT_DIGEST = "sha256"
+DEFAULT_CIPHER = gcm.CIPHER
+DEFAULT_DIGEST = gcm.KDF_DIGEST
 CRYPTO_KEY_ENV_VAR = "MM_CRYPTO_KEY"
 DEFAULT_KEY_PATH = os.path.expanduser("~/.mediaman/key")
+ENCRYPT_BUFFER = 1024**2
+DECRYPT_BUFFER = 1024**2
+
+# NOTE: the (legacy) crypt file is versioned separately from the index
+METADATA_VERSION = 3
+
+# NOTE: openssl-format files were all encrypted with these, before any
+#       params were recorded alongside them
+LEGACY_PARAMS = {"cipher": "aes-256-cbc", "digest": "sha256"}
 
 KEYPATH = config.load(CRYPTO_KEY_ENV_VAR, default=DEFAULT_KEY_PATH)
 
@@ -41,9 +58,6 @@ ERROR_MULTIPLE_REMOTE_FILES = "\
 This must be resolved manually.  Exiting..."
 
 
-TEST_SESH = {}  # name: salt
-
-
 def form_path_prepend():
     global OPENSSL_PREFERRED_BINS
     return ":".join(OPENSSL_PREFERRED_BINS + [config.load_safe("PATH")])
@@ -55,120 +69,279 @@ def form_subprocess_environ():
     return new_env
 
 
-def encrypt(request, keypath, cipher, digest):
+class EncryptedRequest(models.Request):
+    """A request for the ciphertext of another request's file, encrypted in-process as it's read."""
+
+    def __init__(self, request, keypath, params):
+        super().__init__(id=request.id, path=request.path)
+        self.plaintext_request = request
+        self.keypath = keypath
+        self.params = params
+
+    def open(self):
+        # NOTE: the plaintext is read through `request.open()`, so that it
+        #       can be hashed as it's read (see `models.Request`)
+        infile = self.plaintext_request.open()
+        if gcm.supports(self.params["cipher"]):
+            return gcm.EncryptingFile(infile, self.keypath, self.params)
+
+        size = os.stat(self.plaintext_request.path).st_size
+        salt = bytes.fromhex(self.params["salt"])
+        return enc.EncryptingFile(infile, size, self.keypath, self.params["cipher"], self.params["digest"], ENCRYPT_BUFFER, salt=salt)
+
+
+class DecryptedDownloadReceiptFile(servicemodels.AbstractDownloadReceiptFile):
+
+    def __init__(self, data):
+        self._id = data["id"]
+        self._path = data["path"]
+
+    def id(self):
+        return self._id
+
+    def path(self):
+        return self._path
+
+
+def new_params(path, cipher, digest):
+    """The crypt metadata of a file about to be encrypted."""
+    if gcm.supports(cipher):
+        return gcm.new_params(os.stat(path).st_size)
+
+    # NOTE: the salt is chosen upfront, so range reads needn't fetch the header
+    return {"cipher": cipher, "digest": digest, "salt": os.urandom(enc.SALT_SIZE).hex()}
+
+
+@contextlib.contextmanager
+def encrypt(request, keypath, params):
+    """
+    Yields a request for the ciphertext of the given request's file.
+
+    Ciphers `gcm` and `enc` implement are encrypted as the service reads
+    them, with no temporary copy; any others go through openssl, into a
+    tempfile.
+    """
+    (cipher, digest) = (params["cipher"], params["digest"])
+    if gcm.supports(cipher) or enc.supports(cipher, digest):
+        yield EncryptedRequest(request, keypath, params)
+        return
+
+    with encrypt_with_openssl(request, keypath, cipher, digest) as encrypted_tempfile:
+        # NOTE: openssl only writes the salted header if it picks the salt itself
+        params["salt"] = encrypted_tempfile.read(enc.HEADER_SIZE)[len(enc.MAGIC):].hex()
+        encrypted_tempfile.seek(0)
+        yield models.Request(
+            id=request.id,
+            path=encrypted_tempfile.name,
+        )
+
+
+def encrypt_with_openssl(request, keypath, cipher, digest):
     tempfile_ref = tempfile.NamedTemporaryFile(mode="wb+", delete=True)
 
     args = [
         "openssl", "enc", "-e",
-        "-in", str(request.path),
         "-out", str(tempfile_ref.name),
         "-kfile", keypath, f"-{cipher}", "-md", digest,
     ]
     logger.info(f"encrypting: {args}")
 
+    # NOTE: the plaintext is piped through `request.open()`, so that it can
+    #       be hashed as it's read (see `models.Request`)
     logger.info(f"Encrypting file...")
-    subprocess.check_output(args, stderr=subprocess.PIPE, env=form_subprocess_environ())
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.PIPE, env=form_subprocess_environ())
+    with request.open() as infile:
+        try:
+            shutil.copyfileobj(infile, process.stdin, ENCRYPT_BUFFER)
+        finally:
+            process.stdin.close()
+    stderr = process.stderr.read()
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
 
     tempfile_ref.seek(0)
     return tempfile_ref
 
 
-def decrypt(source, destination, keypath, cipher, digest):
-    args = [
-        "openssl", "enc", "-d",
-        "-in", str(source),
-        "-out", str(destination),
-        "-kfile", keypath, f"-{cipher}", "-md", digest,
-    ]
-    logger.info(f"decrypting: {args}")
+def decrypt(source, destination, keypath, params):
+    """
+    Decrypts the ciphertext chunks from `source` straight into `destination`.
+
+    The plaintext is written beside it, then synced and renamed into place
+    once it's complete, so a failed decrypt never leaves a partial file.
+    """
+    temp_path = f"{destination}.tmp"
 
     logger.info(f"Decrypting file...")
     try:
-        subprocess.check_output(args, stderr=subprocess.PIPE, env=form_subprocess_environ())
-    except subprocess.CalledProcessError as exc:
-        err_text = exc.stderr.decode("utf-8")
-
-        logger.debug(exc)
-        if err_text.startswith("bad decrypt"):
-            logger.fatal(f"Decryption failed -- encryption key is incorrect.")
-        else:
-            logger.fatal(f"Decryption failed -- generic error: {err_text}")
-
+        with open(temp_path, "wb") as outfile:
+            for data in decrypt_stream(source, keypath, params):
+                outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temp_path, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
         raise
 
 
-def decrypt_stream(source, keypath, cipher, digest):
+def decrypt_stream(source, keypath, params, final=True):
+    """
+    Yields the plaintext of the ciphertext chunks from `source`.
+    With `final=False`, the ciphertext may end early (see `enc.decrypt_chunks`).
+    Unknown (None) params are judged by the header (see `sniff_params`).
+    """
+    source = split_chunks(source, DECRYPT_BUFFER)
+    if params is None:
+        (header, source) = peek(source, enc.HEADER_SIZE)
+        params = sniff_params(header)
+        if params is None:
+            return gcm.decrypt_chunks(source, keypath)
+    if not params:
+        return source
+
+    (cipher, digest) = (params["cipher"], params["digest"])
+    if gcm.supports(cipher):
+        return gcm.decrypt_chunks(source, keypath, params)
+    if enc.supports(cipher, digest):
+        return enc.decrypt_chunks(source, keypath, cipher, digest, final=final)
+    return decrypt_stream_with_openssl(source, keypath, cipher, digest, final=final)
+
+
+def split_chunks(chunks, size):
+    """Yields the given byte chunks in pieces of at most `size` bytes, without copying them."""
+    for chunk in chunks:
+        view = memoryview(chunk)
+        for start in range(0, len(view), size):
+            yield view[start:start + size]
+
+
+def decrypt_stream_with_openssl(source, keypath, cipher, digest, final=True):
+    """
+    Yields the plaintext of the ciphertext chunks from `source`, decrypted
+    by an openssl subprocess, DECRYPT_BUFFER bytes at most at a time.
+
+    A thread feeds the ciphertext in, blocking whenever openssl's pipes
+    are full, so it never gets far ahead of the consumer.  If the consumer
+    stops early (e.g. a range read), openssl is killed and the thread stops.
+    """
     import threading
 
-    def pump_input(pipe, source):
-        # https://stackoverflow.com/questions/32322034/writing-large-amount-of-data-to-stdin
-        with pipe:
-            for bytez in source:
-                pipe.write(bytez)
-                pipe.flush()
+    stopped = threading.Event()
+    errors = []
 
-    def deal_with_stdout(process, sink):
-        for bytez in process.stdout:
-            sink.write(bytez)
-            sink.flush()
+    def pump_input(pipe):
+        try:
+            with pipe:
+                for data in source:
+                    if stopped.is_set():
+                        return
+                    view = memoryview(data)
+                    while view:
+                        view = view[pipe.write(view):]
+        except BrokenPipeError:
+            pass  # openssl exited (or was killed)
+        except BaseException as exc:
+            errors.append(exc)
 
     args = [
         "openssl", "enc", "-d",
         "-kfile", keypath, f"-{cipher}", "-md", digest,
-        "-bufsize", "1048576",
+        "-bufsize", str(DECRYPT_BUFFER),
     ]
     logger.info(f"decrypting: {args}")
 
     logger.info(f"Decrypting stream...")
+    process = subprocess.Popen(
+        args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=form_subprocess_environ())
+    feeder = threading.Thread(target=pump_input, args=[process.stdin], daemon=True)
+    feeder.start()
+
     try:
-        process = subprocess.Popen(
-            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, env=form_subprocess_environ())
-
-        # threading.Thread(target=deal_with_stdout, args=[process, sink]).start()
-        # for bytez in source:
-        #     process.stdin.write(bytez)
-        #     process.stdin.flush()
-
-        threading.Thread(target=pump_input, args=[process.stdin, source]).start()
-        # import sys
-        # sink = sys.stdout.buffer
-        # for bytez in process.stdout:
-        #    # sink.write(bytez)
-        #    # sink.flush()
+        buffer = bytearray(DECRYPT_BUFFER)
+        view = memoryview(buffer)
         while True:
-            bytez = process.stdout.read()
-            # logger.debug(bytez)
-            if not bytez:
-                return
-            yield bytez
-        # for bytez in process.stdout:
-        #     logger.debug(bytez)
-        #     yield bytez
-        # yield from process.stdout
-    except subprocess.CalledProcessError as exc:
-        err_text = exc.stderr.decode("utf-8")
-
-        logger.debug(exc)
-        if err_text.startswith("bad decrypt"):
-            logger.fatal(f"Decryption failed -- encryption key is incorrect.")
-        else:
-            logger.fatal(f"Decryption failed -- generic error: {err_text}")
-
+            count = process.stdout.readinto(buffer)
+            if not count:
+                break
+            yield bytes(view[:count])
+    except BaseException:
+        # NOTE: including GeneratorExit, when the consumer stops early
+        stopped.set()
+        process.kill()
         raise
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+
+    feeder.join()
+    if errors:
+        raise errors[0]
+
+    # NOTE: a range read's ciphertext is cut short, so its padding can't be checked
+    if process.returncode and final:
+        err_text = stderr.decode("utf-8", errors="replace")
+        if "bad decrypt" in err_text:
+            logger.critical(f"Decryption failed -- encryption key is incorrect.")
+        else:
+            logger.critical(f"Decryption failed -- generic error: {err_text}")
+        raise RuntimeError("Bad decrypt")
 
 
-def create_metadata(data=None):
-    if data is None:
-        data = {}
+def take(chunks, skip, length):
+    """Yields `length` bytes of the given chunks, after the first `skip` bytes."""
+    for chunk in chunks:
+        if length <= 0:
+            return
 
-    return {
-        "version": settings.VERSION,
-        "data": data,
-    }
+        dropped = min(skip, len(chunk))
+        chunk = chunk[dropped:]
+        skip -= dropped
+        if chunk:
+            yield chunk[:length]
+            length -= len(chunk)
+
+
+def peek(chunks, size):
+    """Returns (the first `size` bytes, or fewer, of the given chunks, and all of them)."""
+    chunks = iter(chunks)
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        if sum(map(len, head)) >= size:
+            break
+    return (b"".join(head)[:size], itertools.chain(head, chunks))
+
+
+def sniff_params(header):
+    """
+    The params of a ciphertext whose params weren't recorded, judging by its
+    header: {} if it isn't encrypted, or None if it's in the segmented format
+    (whose params are read from the header as it's decrypted).
+    """
+    if header.startswith(gcm.MAGIC):
+        return None
+    if header.startswith(enc.MAGIC):
+        return dict(LEGACY_PARAMS, salt=header[len(enc.MAGIC):enc.HEADER_SIZE].hex())
+    return {}
 
 
 class EncryptionMiddlewareService(simple.SimpleMiddleware):
+    """
+    Encrypts every file as it's uploaded, and decrypts it as it's read.
+
+    Each file's cipher params are recorded by the index, with the rest of
+    its metadata: `upload` sets them as `request.crypt`, and reads take them
+    from `request.crypt` (see `models.Request`).  Files without recorded
+    params (e.g. the index itself) are recognized by their headers.
+
+    Params used to be tracked here, in a "crypt" file keyed by sid; the
+    index folds it in when it's migrated (see `legacy_ciphers`).
+    """
 
     MIDDLEWARE_FILENAME = "crypt"
 
@@ -176,49 +349,15 @@ class EncryptionMiddlewareService(simple.SimpleMiddleware):
         super().__init__(service)
         logger.info(f"EncryptionMiddlewareService init for {service}")
 
-        self.metadata_id = None
-        self.metadata = None
-
     def init_metadata(self):
-        if self.metadata is not None:
-            return
-
-        # TODO: implement
-        file_list = self.service.search_by_name(EncryptionMiddlewareService.MIDDLEWARE_FILENAME)
-        files = file_list.results()
-
-        if len(files) > 1:
-            raise RuntimeError(ERROR_MULTIPLE_REMOTE_FILES.format(self.service))
-
-        if not files:
-            logger.debug(f"creating metadata")
-            self.metadata = create_metadata()
-            self.update_metadata()
-        else:
-            logger.debug(f"loading metadata")
-            self.load_metadata(files[0])
-
-    def update_metadata(self):
-        with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
-            tempfile_ref.write(json.dumps(self.metadata))
-            tempfile_ref.seek(0)
-
-            request = models.Request(
-                id=EncryptionMiddlewareService.MIDDLEWARE_FILENAME,
-                path=tempfile_ref.name,
-            )
-            receipt = self.service.upload(request)
-
-        logger.info(f"update_metadata receipt: {receipt}")
-        self.metadata_id = receipt.id()
+        pass
 
     def load_metadata_json(self, metadata_file):
         logger.info(f"load_metadata_json file: {metadata_file}")
-        self.metadata_id = metadata_file.id()
 
         with tempfile.NamedTemporaryFile("w+", delete=True) as tempfile_ref:
             request = models.Request(
-                id=self.metadata_id,
+                id=metadata_file.id(),
                 path=tempfile_ref.name,
             )
 
@@ -227,80 +366,92 @@ class EncryptionMiddlewareService(simple.SimpleMiddleware):
 
             return json.loads(tempfile_ref.read())
 
-    def load_metadata(self, metadata_file):
-        self.metadata = self.load_metadata_json(metadata_file)
-        logger.debug(f"Loaded metadata: {self.metadata}")
-
-        if "version" not in self.metadata:
-            logger.critical(f"'version' field missing from metadata!  This is an outdated or unversioned meta file.  You will need to fix it by running `mm <service> refresh`.")
+    def find_legacy_ciphers(self):
+        files = self.service.search_by_name(EncryptionMiddlewareService.MIDDLEWARE_FILENAME).results()
+        if len(files) > 1:
+            raise RuntimeError(ERROR_MULTIPLE_REMOTE_FILES.format(self.service))
+        return files[0] if files else None
+
+    def legacy_ciphers(self, sids):
+        """
+        Returns the given files' cipher params ({sid: params}) from the old
+        "crypt" file, if there is one.  Salts missing from openssl-format
+        files' params are read from their headers, so range reads needn't
+        fetch them.
+        """
+        file = self.find_legacy_ciphers()
+        if file is None:
+            return {}
+
+        metadata = self.load_metadata_json(file)
+        logger.debug(f"Loaded metadata: {metadata}")
+
+        if "version" not in metadata:
+            logger.critical(f"'version' field missing from metadata!  This is an outdated or unversioned meta file.")
             raise RuntimeError("Unversioned metadata")
 
-        version = self.metadata["version"]
-        if version > settings.VERSION:
-            logger.critical(f"Metadata version ({version}) exceeds software version ({settings.VERSION}).  You need to update your software to parse this metadata file.")
+        version = metadata["version"]
+        if version > METADATA_VERSION:
+            logger.critical(f"Metadata version ({version}) exceeds software version ({METADATA_VERSION}).  You need to update your software to parse this metadata file.")
             raise RuntimeError("Outdated software")
 
-        if version < settings.VERSION:
-            logger.critical(f"Metadata version ({version}) is below software version ({settings.VERSION}).  You need to update it by running `mm <service> refresh`.")
+        if version < 2:
+            logger.critical(f"Metadata version ({version}) is below software version ({METADATA_VERSION}).  It can't be migrated.")
             raise RuntimeError("Outdated metadata")
 
-    def track_cipher(self, key, cipher, digest):
-        global CIPHER
-        self.metadata["data"][key] = {"cipher": cipher, "digest": digest}
-        self.update_metadata()
+        ciphers = {sid: params for (sid, params) in metadata["data"].items() if sid in sids}
+        for (sid, params) in ciphers.items():
+            if not gcm.supports(params["cipher"]) and "salt" not in params:
+                header = self.cipher_header(models.Request(id=sid), params)
+                if header.startswith(enc.MAGIC):
+                    params["salt"] = header[len(enc.MAGIC):].hex()
+        return ciphers
+
+    def remove_legacy_ciphers(self):
+        """Deletes the old "crypt" file, once the index holds all its params."""
+        file = self.find_legacy_ciphers()
+        if file is not None:
+            logger.info(f"Removing legacy crypt file from {self.service}")
+            self.service.remove(file.id())
 
     def upload(self, request):
-        # TODO: remove metadata when file is deleted
         keypath = KEYPATH
-        cipher = DEFAULT_CIPHER
-        digest = DEFAULT_DIGEST
+        params = new_params(request.path, DEFAULT_CIPHER, DEFAULT_DIGEST)
 
-        with encrypt(request, keypath, cipher, digest) as encrypted_tempfile:
-            request.path = encrypted_tempfile.name
-            receipt = self.service.upload(request)
+        with encrypt(request, keypath, params) as encrypted_request:
+            receipt = self.service.upload(encrypted_request)
 
-        self.track_cipher(receipt.id(), cipher, digest)  # IMPORTANT -- must track by sid!
+        # NOTE: recorded by the caller (i.e. the index), with the file
+        request.crypt = params
         return receipt
 
     def download(self, request):
-        if request.id not in self.metadata["data"]:
+        if request.crypt == {}:
             logger.info(f"Downloading unencrypted file: {request}")
             return self.service.download(request)
 
-        params = self.metadata["data"][request.id]
-
         keypath = KEYPATH
-        cipher = params["cipher"]
-        digest = params["digest"]
 
         logger.info(f"Downloading encrypted file: {request}")
-        with tempfile.NamedTemporaryFile("wb+", delete=True) as tempfile_ref:
-            temp_request = models.Request(
-                id=request.id,
-                path=tempfile_ref.name,
-            )
-
-            receipt = self.service.download(temp_request)
-            tempfile_ref.seek(0)
+        temp_request = models.Request(
+            id=request.id,
+        )
 
-            decrypt(tempfile_ref.name, request.path, keypath, cipher, digest)
+        # NOTE: streamed, so the ciphertext never touches the disk
+        stream = self.service.stream(temp_request)
+        decrypt(stream, request.path, keypath, request.crypt)
 
-        return receipt
+        return DecryptedDownloadReceiptFile({
+            "id": request.id,
+            "path": request.path,
+        })
 
     def stream(self, request):
-        if request.id not in self.metadata["data"]:
+        if request.crypt == {}:
             logger.info(f"Streaming unencrypted file: {request}")
             return self.service.stream(request)
 
-        # global TEST_SESH
-        # if request.id not in TEST_SESH:
-        #     TEST_SESH[request.id] = {"ebuff": None, "pbuff": None}
-
-        params = self.metadata["data"][request.id]
-
         keypath = KEYPATH
-        cipher = params["cipher"]
-        digest = params["digest"]
 
         logger.info(f"Streaming encrypted file: {request}")
         temp_request = models.Request(
@@ -309,10 +460,17 @@ class EncryptionMiddlewareService(simple.SimpleMiddleware):
 
         stream = self.service.stream(temp_request)
 
-        return decrypt_stream(stream, keypath, cipher, digest)
+        return decrypt_stream(stream, keypath, request.crypt)
 
     def stream_range(self, request, offset, length):
-        if request.id not in self.metadata["data"]:
+        params = request.crypt
+        if params is None:
+            params = sniff_params(self.cipher_header(request, {}))
+            if params is None:
+                # NOTE: without its size, a segmented file is read from the start
+                return take(self.stream(request), offset, length if length >= 0 else sys.maxsize)
+
+        if params == {}:
             logger.info(f"Streaming unencrypted file: {request}")
             return self.service.stream_range(request, offset, length)
 
@@ -321,17 +479,30 @@ class EncryptionMiddlewareService(simple.SimpleMiddleware):
             id=request.id,
         )
 
+        if gcm.supports(params["cipher"]):
+            return self.stream_range_segmented(temp_request, params, offset, length)
         if offset < 16:
             # raise RuntimeError("Not supported!")
-            return self.stream_range_continuous(temp_request, offset, length)
-        return self.stream_range_discontinuous(temp_request, offset, length)
+            return self.stream_range_continuous(temp_request, params, offset, length)
+        return self.stream_range_discontinuous(temp_request, params, offset, length)
 
-    def stream_range_continuous(self, request, offset, length):
-        params = self.metadata["data"][request.id]
+    def stream_range_segmented(self, request, params, offset, length):
+        keypath = KEYPATH
+        if length < 0:
+            length = params["size"] - offset
+
+        # NOTE: one ranged fetch of just the segments covering the range
+        (first, last, skip, count) = gcm.segment_range(params, offset, length)
+        if length <= 0 or first >= last:
+            return
+
+        stream = self.service.stream_range(request, skip, count)
+        out_stream = gcm.decrypt_segments(stream, keypath, params, first, last)
 
+        yield from take(out_stream, offset - first * params["segment_size"], length)
+
+    def stream_range_continuous(self, request, params, offset, length):
         keypath = KEYPATH
-        cipher = params["cipher"]
-        digest = params["digest"]
 
         import math
         BLOCK_SIZE = 16
@@ -342,71 +513,36 @@ class EncryptionMiddlewareService(simple.SimpleMiddleware):
         count = (blocks_needed + 2) * BLOCK_SIZE
 
         stream = self.service.stream_range(request, skip, count)
-        out_stream = decrypt_stream(stream, keypath, cipher, digest)
-
-        remaining = length
-        first = True
-        for bytez in out_stream:
-            # print(f"\tremaining={remaining}")
-            if first:
-                # print(f"\ttrimming {bytez}")
-                bytez = bytez[(offset % 16):]
-                # print(f"\tto {bytez}")
-                first = False
-
-            if len(bytez) >= remaining:
-                yield bytez[:remaining]
-                remaining -= remaining
-                break
+        out_stream = decrypt_stream(stream, keypath, params, final=False)
+
+        yield from take(out_stream, offset, length)
 
-            yield bytez
-            remaining -= len(bytez)
+    def cipher_header(self, request, params):
+        """The salted header of an openssl-format file, rebuilt from its params if they include the salt."""
+        if "salt" not in params:
+            logger.debug(f"Fetching header of {request.id}...")
+            return b"".join(self.service.stream_range(request, 0, enc.HEADER_SIZE))
 
-    def stream_range_discontinuous(self, request, offset, length):
-        params = self.metadata["data"][request.id]
+        return enc.MAGIC + bytes.fromhex(params["salt"])
 
+    def stream_range_discontinuous(self, request, params, offset, length):
         keypath = KEYPATH
-        cipher = params["cipher"]
-        digest = params["digest"]
 
-        import itertools
         import math
-        logger.debug(f"Getting CBC salt...")
         BLOCK_SIZE = 16
 
         start_block = offset // BLOCK_SIZE
         blocks_needed = int(math.ceil((offset + length) / BLOCK_SIZE) - start_block)
 
-        global TEST_SESH
-        try:
-            salt = TEST_SESH[request.id]
-        except KeyError:
-            salt = [next(self.service.stream_range(request, 0, 16))]
-            TEST_SESH[request.id] = salt
+        header = self.cipher_header(request, params)
 
         skip = (start_block) * BLOCK_SIZE
         count = (blocks_needed + 2) * BLOCK_SIZE
 
         data = self.service.stream_range(request, skip, count)
 
-        stream = itertools.chain(salt, data)
-        out_stream = decrypt_stream(stream, keypath, cipher, digest)
-
-        remaining = length
-        first = True
-        for bytez in out_stream:
-            # print(f"\tremaining={remaining}")
-            if first:
-                # print(f"\ttrimming {bytez}")
-                bytez = bytez[(offset % 16) + 16:]
-                # print(f"\tto {bytez}")
-                first = False
-
-            if len(bytez) >= remaining:
-                # print(f"\tend")
-                yield bytez[:remaining]
-                remaining -= remaining
-                break
+        stream = itertools.chain([header], data)
+        out_stream = decrypt_stream(stream, keypath, params, final=False)
 
-            yield bytez
-            remaining -= len(bytez)
+        # NOTE: the first block decrypts with the wrong IV, and is dropped
+        yield from take(out_stream, (offset % 16) + 16, length)
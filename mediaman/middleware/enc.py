@@ -0,0 +1,252 @@
+"""
+In-process encryption compatible with `openssl enc` (salted format).
+
+Files are written as "Salted__", an 8-byte random salt, then the AES-CBC
+ciphertext of the PKCS#7-padded plaintext.  The key and IV are derived from
+the first line of the key file and the salt with `EVP_BytesToKey` (one
+iteration of the given digest), exactly as `openssl enc -kfile <key> -md
+<digest>` does, so blobs written here and by openssl are interchangeable.
+
+Only the CBC ciphers in CIPHERS are implemented; `supports` tells callers
+when to fall back to the openssl binary.
+"""
+
+import hashlib
+import io
+import os
+
+from mediaman.core import logtools
+
+logger = logtools.new_logger("mediaman.middleware.enc")
+
+
+MAGIC = b"Salted__"
+SALT_SIZE = 8
+HEADER_SIZE = len(MAGIC) + SALT_SIZE
+BLOCK_SIZE = 16
+
+CIPHERS = {  # name: key size
+    "aes-128-cbc": 16,
+    "aes-192-cbc": 24,
+    "aes-256-cbc": 32,
+}
+
+# NOTE: like openssl, only the first line of the key file is the password
+MAX_PASSWORD_LINE = 4096
+
+
+def supports(cipher, digest):
+    return cipher in CIPHERS and digest in hashlib.algorithms_available
+
+
+def read_password(keypath):
+    with open(keypath, "rb") as infile:
+        line = infile.readline(MAX_PASSWORD_LINE)
+
+    # NOTE: openssl strips trailing newlines, but never the first character
+    password = line[:1] + line[1:].rstrip(b"\r\n")
+    if not password or password in (b"\r", b"\n"):
+        logger.critical(f"Empty password in key file: {keypath}")
+        raise RuntimeError("Empty password")
+    return password
+
+
+def derive_key(password, salt, cipher, digest):
+    """OpenSSL's `EVP_BytesToKey`, with a single iteration: returns (key, IV)."""
+    key_size = CIPHERS[cipher]
+    derived = b""
+    block = b""
+    while len(derived) < key_size + BLOCK_SIZE:
+        block = hashlib.new(digest, block + password + salt).digest()
+        derived += block
+    return (derived[:key_size], derived[key_size:key_size + BLOCK_SIZE])
+
+
+def new_cipher(keypath, salt, cipher, digest):
+    from cryptography.hazmat.primitives.ciphers import Cipher
+    from cryptography.hazmat.primitives.ciphers import algorithms
+    from cryptography.hazmat.primitives.ciphers import modes
+
+    (key, iv) = derive_key(read_password(keypath), salt, cipher, digest)
+    return Cipher(algorithms.AES(key), modes.CBC(iv))
+
+
+def encrypted_size(size):
+    # NOTE: PKCS#7 always adds padding, a whole block if the size is aligned
+    return HEADER_SIZE + (size // BLOCK_SIZE + 1) * BLOCK_SIZE
+
+
+class EncryptingFile(io.RawIOBase):
+    """
+    A read-only binary file of the ciphertext of another (plaintext) binary
+    file, encrypted as it's read, so it can be uploaded without ever being
+    written to disk.
+
+    The ciphertext's size is known upfront, so it's seekable, as resumable
+    uploads require: seeking backwards re-encrypts from the start (CBC
+    can't resume mid-stream), which yields the same bytes, since the salt is
+    chosen once (randomly, unless given).
+    """
+
+    def __init__(self, infile, size, keypath, cipher, digest, buffer=1024**2, salt=None):
+        super().__init__()
+        self.infile = infile
+        self.keypath = keypath
+        self.cipher = cipher
+        self.digest = digest
+        self.buffer = buffer
+        self.salt = os.urandom(SALT_SIZE) if salt is None else salt
+        self.size = encrypted_size(size)
+        self.position = 0
+        self.restart()
+
+    def restart(self):
+        from cryptography.hazmat.primitives import padding
+
+        self.infile.seek(0)
+        self.encryptor = new_cipher(self.keypath, self.salt, self.cipher, self.digest).encryptor()
+        self.padder = padding.PKCS7(BLOCK_SIZE * 8).padder()
+        self.pending = bytearray(MAGIC + self.salt)
+        self.produced = 0  # bytes of ciphertext returned or discarded
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def fill(self):
+        """Encrypts the next buffer of plaintext into `pending`."""
+        data = self.infile.read(self.buffer)
+        if data:
+            self.pending += self.encryptor.update(self.padder.update(data))
+        else:
+            self.pending += self.encryptor.update(self.padder.finalize()) + self.encryptor.finalize()
+            self.finished = True
+
+    def readinto(self, buffer):
+        if self.position < self.produced:
+            logger.debug(f"Rewinding encryption to {self.position}")
+            self.restart()
+
+        # NOTE: skip ahead to the position (e.g. after a seek)
+        while self.produced + len(self.pending) < self.position + 1 and not self.finished:
+            self.fill()
+        skip = min(self.position - self.produced, len(self.pending))
+        del self.pending[:skip]
+        self.produced += skip
+
+        while len(self.pending) < len(buffer) and not self.finished:
+            self.fill()
+
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        del self.pending[:count]
+        self.produced += count
+        self.position += count
+        return count
+
+    def close(self):
+        self.infile.close()
+        super().close()
+
+
+def unpad(data):
+    """Strips PKCS#7 padding from the last block(s), or returns None if it's invalid."""
+    count = data[-1] if data else 0
+    if not 1 <= count <= BLOCK_SIZE or data[-count:] != bytes([count]) * count:
+        return None
+    return data[:-count]
+
+
+class Decryptor:
+    """
+    Decrypts a salted ciphertext fed in chunks (see `decrypt_chunks`).
+
+    The last block decrypted is held back, since it might be the padding.
+    """
+
+    def __init__(self, keypath, cipher, digest):
+        self.keypath = keypath
+        self.cipher = cipher
+        self.digest = digest
+        self.header = bytearray()
+        self.decryptor = None
+        self.held = b""
+
+    def update(self, data):
+        if self.decryptor is None:
+            self.header += data
+            if len(self.header) < HEADER_SIZE:
+                return b""
+            if self.header[:len(MAGIC)] != MAGIC:
+                logger.critical(f"Decryption failed -- not a salted ciphertext.")
+                raise RuntimeError("Bad ciphertext header")
+
+            salt = bytes(self.header[len(MAGIC):HEADER_SIZE])
+            self.decryptor = new_cipher(self.keypath, salt, self.cipher, self.digest).decryptor()
+            data = self.header[HEADER_SIZE:]
+
+        plaintext = self.held + self.decryptor.update(data)
+        cut = max(len(plaintext) - BLOCK_SIZE, 0)
+        self.held = plaintext[cut:]
+        return plaintext[:cut]
+
+    def finalize(self, strict=True):
+        """
+        Returns the rest of the plaintext.  Unless `strict`, the ciphertext
+        may have been cut short, so the last block is only unpadded if its
+        padding is valid (it's returned as-is otherwise).
+        """
+        if self.decryptor is None:
+            if not strict:
+                return b""
+            logger.critical(f"Decryption failed -- truncated ciphertext.")
+            raise RuntimeError("Bad decrypt")
+
+        if not strict:
+            data = unpad(self.held)
+            return self.held if data is None else data
+
+        try:
+            self.held += self.decryptor.finalize()
+        except ValueError as exc:
+            logger.critical(f"Decryption failed -- truncated ciphertext.")
+            raise RuntimeError("Bad decrypt") from exc
+
+        data = unpad(self.held)
+        if data is None:
+            logger.critical(f"Decryption failed -- encryption key is incorrect (or the file is corrupt).")
+            raise RuntimeError("Bad decrypt")
+        return data
+
+
+def decrypt_chunks(chunks, keypath, cipher, digest, final=True):
+    """
+    Yields the plaintext of a salted ciphertext given as byte chunks.
+
+    With `final=False`, the ciphertext may stop short of the end of the
+    file (e.g. a range read), so its padding isn't checked, and the last
+    block received might still be padded.
+    """
+    decryptor = Decryptor(keypath, cipher, digest)
+    for chunk in chunks:
+        data = decryptor.update(chunk)
+        if data:
+            yield data
+
+    data = decryptor.finalize(strict=final)
+    if data:
+        yield data
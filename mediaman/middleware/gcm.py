@@ -0,0 +1,265 @@
+"""
+Segmented AES-256-GCM encryption, for random access to encrypted files.
+
+The plaintext is split into SEGMENT_SIZE segments (the last one may be
+shorter, or empty), and each is encrypted and authenticated on its own:
+
+    header      magic, format version, segment size, salt
+    segments    per segment: AES-GCM ciphertext, then its 16-byte tag
+
+Each file gets its own key, derived from the key file's first line and the
+file's salt (HKDF).  A segment's nonce is its number, plus a flag marking
+the last segment, so segments can't be reordered, and a file can't be
+truncated at a segment boundary, without failing authentication.  Every
+segment is also bound to the header.
+
+The salt, segment size and plaintext size are recorded in the index (see
+`new_params`), so any byte range can be decrypted from a single ranged
+fetch of the segments covering it, without reading the header.  A whole
+file can be decrypted from its header alone (see `decrypt_chunks`).
+"""
+
+import io
+import itertools
+import os
+import struct
+
+from mediaman.core import logtools
+from mediaman.middleware import enc
+
+logger = logtools.new_logger("mediaman.middleware.gcm")
+
+
+CIPHER = "aes-256-gcm"
+KDF_DIGEST = "sha256"
+KEY_SIZE = 32
+TAG_SIZE = 16
+SALT_SIZE = 16
+SEGMENT_SIZE = 64 * 1024
+
+MAGIC = b"MMGC"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBI16s")  # magic, format version, segment size, salt
+NONCE = struct.Struct(">Q3xB")  # segment number, last-segment flag
+
+KDF_INFO = b"mediaman segmented aes-256-gcm"
+
+
+def supports(cipher):
+    return cipher == CIPHER
+
+
+def new_params(size):
+    """The crypt metadata of a new file of the given (plaintext) size."""
+    return {
+        "cipher": CIPHER,
+        "digest": KDF_DIGEST,
+        "segment_size": SEGMENT_SIZE,
+        "salt": os.urandom(SALT_SIZE).hex(),
+        "size": size,
+    }
+
+
+def header(params):
+    return HEADER.pack(MAGIC, FORMAT_VERSION, params["segment_size"], bytes.fromhex(params["salt"]))
+
+
+def parse_header(data):
+    """The params of a file (all but its size) from its header."""
+    (magic, format_version, segment_size, salt) = HEADER.unpack_from(data)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        logger.critical(f"Decryption failed -- not a version {FORMAT_VERSION} segmented ciphertext.")
+        raise RuntimeError("Bad ciphertext header")
+
+    return {
+        "cipher": CIPHER,
+        "digest": KDF_DIGEST,
+        "segment_size": segment_size,
+        "salt": salt.hex(),
+    }
+
+
+def new_aead(keypath, params):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    kdf = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=bytes.fromhex(params["salt"]), info=KDF_INFO)
+    return AESGCM(kdf.derive(enc.read_password(keypath)))
+
+
+def segment_count(params):
+    # NOTE: an empty file is still one (empty) segment, so it's authenticated
+    return max(1, -(-params["size"] // params["segment_size"]))
+
+
+def encrypted_size(params):
+    return HEADER.size + params["size"] + segment_count(params) * TAG_SIZE
+
+
+def segment_range(params, offset, length):
+    """
+    Returns the (first, last + 1) segments covering the given plaintext
+    range, and the (offset, length) of their ciphertext.
+    """
+    segment_size = params["segment_size"]
+    count = segment_count(params)
+    first = min(offset // segment_size, count)
+    last = min(max(first + 1, -(-(offset + length) // segment_size)), count)
+    start = HEADER.size + first * (segment_size + TAG_SIZE)
+    end = min(HEADER.size + last * (segment_size + TAG_SIZE), encrypted_size(params))
+    return (first, last, start, end - start)
+
+
+class EncryptingFile(io.RawIOBase):
+    """
+    A read-only binary file of the ciphertext of another (plaintext) binary
+    file, encrypted a segment at a time as it's read.  Segments are
+    independent, so it seeks freely (e.g. for resumable uploads).
+    """
+
+    def __init__(self, infile, keypath, params):
+        super().__init__()
+        self.infile = infile
+        self.params = params
+        self.aead = new_aead(keypath, params)
+        self.header = header(params)
+        self.size = encrypted_size(params)
+        self.position = 0
+        self.segment = (None, b"")  # (number, ciphertext)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def encrypt_segment(self, number):
+        if self.segment[0] != number:
+            segment_size = self.params["segment_size"]
+            self.infile.seek(number * segment_size)
+            data = bytearray()
+            while len(data) < segment_size:
+                chunk = self.infile.read(segment_size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            nonce = NONCE.pack(number, number == segment_count(self.params) - 1)
+            self.segment = (number, self.aead.encrypt(nonce, bytes(data), self.header))
+        return self.segment[1]
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+
+        if self.position < HEADER.size:
+            (data, start) = (self.header, self.position)
+        else:
+            (number, start) = divmod(self.position - HEADER.size, self.params["segment_size"] + TAG_SIZE)
+            data = self.encrypt_segment(number)
+
+        count = min(len(buffer), len(data) - start)
+        buffer[:count] = data[start:start + count]
+        self.position += count
+        return count
+
+    def close(self):
+        self.infile.close()
+        super().close()
+
+
+def new_decryptor(keypath, params):
+    """Returns a function(number, is last, ciphertext) of a file's segments' plaintext."""
+    from cryptography.exceptions import InvalidTag
+
+    aead = new_aead(keypath, params)
+    aad = header(params)
+
+    def decrypt(number, last, data):
+        try:
+            return aead.decrypt(NONCE.pack(number, last), bytes(data), aad)
+        except InvalidTag as exc:
+            logger.critical(f"Decryption failed -- segment {number} is corrupt (or the encryption key is incorrect).")
+            raise RuntimeError("Bad decrypt") from exc
+
+    return decrypt
+
+
+def decrypt_segments(chunks, keypath, params, first, last):
+    """
+    Yields the plaintext of segments `first` to `last - 1`, from their
+    ciphertext given as byte chunks, authenticating each one.
+    """
+    count = segment_count(params)
+    stride = params["segment_size"] + TAG_SIZE
+    decryptor = new_decryptor(keypath, params)
+
+    def decrypt(number, data):
+        return decryptor(number, number == count - 1, data)
+
+    number = first
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= stride and number < last:
+            yield decrypt(number, pending[:stride])
+            del pending[:stride]
+            number += 1
+
+    # NOTE: only the file's last segment may be shorter
+    if number < last and pending:
+        yield decrypt(number, pending)
+        number += 1
+
+    if number < last:
+        logger.critical(f"Decryption failed -- truncated ciphertext (segment {number} of {count}).")
+        raise RuntimeError("Bad decrypt")
+
+
+def decrypt_chunks(chunks, keypath, params=None):
+    """
+    Yields the plaintext of a whole file, from its ciphertext given as byte
+    chunks.  Without `params`, they're read from its header: its size isn't
+    needed, since the last segment is just the one the ciphertext ends with.
+    """
+    header_data = bytearray()
+    chunks = iter(chunks)
+    for chunk in chunks:
+        header_data += chunk
+        if len(header_data) >= HEADER.size:
+            break
+
+    if len(header_data) < HEADER.size:
+        logger.critical(f"Decryption failed -- truncated ciphertext.")
+        raise RuntimeError("Bad decrypt")
+
+    found = parse_header(header_data)
+    if params is not None and bytes(header_data[:HEADER.size]) != header(params):
+        logger.critical(f"Decryption failed -- the header doesn't match the index.")
+        raise RuntimeError("Bad ciphertext header")
+
+    stride = found["segment_size"] + TAG_SIZE
+    decrypt = new_decryptor(keypath, found)
+
+    # NOTE: a segment is held back until more ciphertext follows it, or doesn't
+    number = 0
+    pending = header_data[HEADER.size:]
+    for chunk in itertools.chain([b""], chunks):
+        pending += chunk
+        while len(pending) > stride:
+            yield decrypt(number, False, pending[:stride])
+            del pending[:stride]
+            number += 1
+
+    yield decrypt(number, True, pending)
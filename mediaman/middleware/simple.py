@@ -26,6 +26,10 @@ class SimpleMiddleware(abstract.AbstractMiddleware):
     def list_files(self):
         return self.service.list_files()
 
+    @init
+    def list_file(self, file_id):
+        return self.service.list_file(file_id)
+
     @init
     def has(self, file_id):
         return self.service.has(file_id)
@@ -34,6 +38,10 @@ class SimpleMiddleware(abstract.AbstractMiddleware):
     def search_by_name(self, file_name):
         return self.service.search_by_name(file_name)
 
+    @init
+    def search_by_prefix(self, prefix):
+        return self.service.search_by_prefix(prefix)
+
     @init
     def fuzzy_search_by_name(self, file_name):
         return self.service.fuzzy_search_by_name(file_name)
@@ -65,3 +73,12 @@ class SimpleMiddleware(abstract.AbstractMiddleware):
     @init
     def refresh_global_hashes(self, request):
         return self.service.refresh_global_hashes(request)
+
+    def batch(self):
+        return self.service.batch()
+
+    def legacy_ciphers(self, sids):
+        return self.service.legacy_ciphers(sids)
+
+    def remove_legacy_ciphers(self):
+        return self.service.remove_legacy_ciphers()
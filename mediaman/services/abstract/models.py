@@ -48,6 +48,13 @@ class AbstractResultFile(abc.ABC):
     def size(self):
         raise NotImplementedError()
 
+    def validator(self):
+        """
+        A string that changes whenever the file's contents change
+        (or None, if the service can't provide one).
+        """
+        return None
+
     def __repr__(self):
         return f"{type(self)}({self.id()}, {self.name()}, {self.size()})"
 
@@ -1,5 +1,6 @@
 
 import abc
+import contextlib
 import functools
 from typing import Generator
 
@@ -42,6 +43,11 @@ class AbstractService(abc.ABC):
         """List all files with the given name."""
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def search_by_prefix(self, prefix) -> models.AbstractResultFileList:
+        """List all files whose names start with the given prefix."""
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def exists(self, file_id) -> bool:
         """Return whether a file with that ID exists."""
@@ -77,5 +83,17 @@ class AbstractService(abc.ABC):
         """Remove a file from the service."""
         raise NotImplementedError()
 
+    def batch(self):
+        """Group metadata writes until the returned context exits (if supported)."""
+        return contextlib.nullcontext()
+
+    def legacy_ciphers(self, sids):
+        """The cipher params of the given files, from before they were kept in the index, by sid (if any)."""
+        return {}
+
+    def remove_legacy_ciphers(self):
+        """Deletes the cipher params from before they were kept in the index (if any)."""
+        pass
+
     def __repr__(self):
         return f"{self.__class__.__name__}(\"{self.nickname()}\")"
@@ -0,0 +1,86 @@
+"""
+Content-defined chunking (CDC), after FastCDC.
+
+A gear hash is rolled over the data, and a chunk ends wherever its top bits
+are zero.  Boundaries depend only on the bytes just before them, so an
+insertion or deletion only changes the chunks around it, and the rest of a
+near-identical file still dedupes.
+
+Chunks are between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE bytes, normalized
+around AVERAGE_CHUNK_SIZE (a stricter mask is used before the average size,
+and a looser one after it).
+
+NOTE: changing any of these constants (or the gear table) moves every
+      boundary, so nothing stored before would dedupe against new uploads.
+
+NOTE: the gear hash is rolled a byte at a time in pure Python, which bounds
+      chunking to roughly 5 MB/s (see config.yaml.sample).
+"""
+
+import hashlib
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVERAGE_CHUNK_SIZE = 1024**2
+MAX_CHUNK_SIZE = 4 * 1024**2
+
+READ_SIZE = 8 * 1024**2
+
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def gear_table():
+    return [int.from_bytes(hashlib.sha256(bytes([byte])).digest()[:8], "little") for byte in range(256)]
+
+
+def top_bits_mask(bits):
+    return ((1 << bits) - 1) << (HASH_BITS - bits)
+
+
+GEAR = gear_table()
+AVERAGE_BITS = AVERAGE_CHUNK_SIZE.bit_length() - 1
+MASK_SMALL = top_bits_mask(AVERAGE_BITS + 1)
+MASK_LARGE = top_bits_mask(AVERAGE_BITS - 1)
+
+
+def find_boundary(data, size):
+    """Returns the length of the first chunk of `data[:size]`."""
+    if size <= MIN_CHUNK_SIZE:
+        return size
+
+    # NOTE: locals, since global lookups dominate this loop
+    (gear, hash_mask, mask_small, mask_large) = (GEAR, HASH_MASK, MASK_SMALL, MASK_LARGE)
+    normal = min(AVERAGE_CHUNK_SIZE, size)
+    limit = min(MAX_CHUNK_SIZE, size)
+
+    h = 0
+    for (i, byte) in enumerate(data[MIN_CHUNK_SIZE:normal], MIN_CHUNK_SIZE):
+        h = ((h << 1) + gear[byte]) & hash_mask
+        if not h & mask_small:
+            return i + 1
+
+    for (i, byte) in enumerate(data[normal:limit], normal):
+        h = ((h << 1) + gear[byte]) & hash_mask
+        if not h & mask_large:
+            return i + 1
+
+    return limit
+
+
+def chunks(infile):
+    """Yields the content-defined chunks (as bytes) of a binary file object."""
+    pending = bytearray()
+    eof = False
+    while True:
+        while not eof and len(pending) < MAX_CHUNK_SIZE:
+            data = infile.read(READ_SIZE)
+            if not data:
+                eof = True
+            pending.extend(data)
+
+        if not pending:
+            return
+
+        cut = find_boundary(pending, len(pending))
+        yield bytes(pending[:cut])
+        del pending[:cut]
@@ -0,0 +1,78 @@
+
+import hashlib
+import json
+import tempfile
+import uuid
+
+from mediaman.core import logtools
+from mediaman.core import models
+
+logger = logtools.new_logger("mediaman.services.chunkstore.methods")
+
+
+CHUNK_PREFIX = "chunk."
+MANIFEST_PREFIX = "manifest."
+
+
+def chunk_name():
+    # NOTE: not named by digest, which would reveal the plaintext's hashes
+    return f"{CHUNK_PREFIX}{uuid.uuid4()}"
+
+
+def manifest_name(file_id):
+    return f"{MANIFEST_PREFIX}{file_id}"
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunks_digest(chunks):
+    """Identifies a file's contents by its chunk list (see `create_manifest`)."""
+    return hashlib.sha256("".join(digest for (digest, _sid, _size) in chunks).encode("ascii")).hexdigest()
+
+
+def create_manifest(version, chunks):
+    return {
+        "version": version,
+        "size": sum(size for (_digest, _sid, size) in chunks),
+        "chunks": chunks,  # [[digest, sid, size]]
+    }
+
+
+def upload_bytes(backing, name, data):
+    with tempfile.NamedTemporaryFile("wb", delete=True) as tempfile_ref:
+        tempfile_ref.write(data)
+        tempfile_ref.flush()
+
+        request = models.Request(
+            id=name,
+            path=tempfile_ref.name,
+        )
+        return backing.upload(request)
+
+
+def upload_json(backing, name, data):
+    return upload_bytes(backing, name, json.dumps(data).encode("utf-8"))
+
+
+def download_json(backing, sid):
+    return json.loads(b"".join(backing.stream(models.Request(id=sid))))
+
+
+def stream_range(backing, chunks, offset, length):
+    """Streams `length` bytes from `offset` of the file made of the given chunks."""
+    position = 0
+    for (_digest, sid, size) in chunks:
+        if length <= 0:
+            return
+
+        end = position + size
+        if end > offset:
+            start = max(offset - position, 0)
+            count = min(size - start, length)
+            logger.trace(f"Streaming {count} bytes from chunk {sid} at {start}")
+            yield from backing.stream_range(models.Request(id=sid), start, count)
+            offset += count
+            length -= count
+        position = end
@@ -0,0 +1,83 @@
+
+from mediaman.services.abstract import models
+
+
+BACKING_KEY = "backing"
+DEFAULT_BACKING = "folder"
+
+
+class ChunkStoreConfig(models.BaseConfig):
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.backing = (self.extra or {}).get(BACKING_KEY, DEFAULT_BACKING)
+
+    def backing_config(self, backing_type):
+        """The config of the service the chunks are stored with (same destination, quota and extra)."""
+        return {**self._config, "type": backing_type}
+
+
+class ChunkStoreReceiptFile(models.AbstractReceiptFile):
+
+    def __init__(self, data):
+        self.filename = data["id"]
+
+    def id(self):
+        return self.filename
+
+
+class ChunkStoreDownloadReceiptFile(models.AbstractDownloadReceiptFile, ChunkStoreReceiptFile):
+
+    def __init__(self, data):
+        super().__init__(data)
+        self._path = data["path"]
+
+    def path(self):
+        return self._path
+
+
+class ChunkStoreResultFile(models.AbstractResultFile):
+
+    def __init__(self, name, file_data):
+        self.filename = name
+        self._size = file_data["size"]
+        self.digest = file_data["digest"]
+
+    def id(self):
+        return self.filename
+
+    def name(self):
+        return self.filename
+
+    def size(self):
+        return self._size
+
+    def validator(self):
+        # NOTE: the digest of a file's chunk list changes iff its contents do
+        return self.digest
+
+
+class ChunkStoreResultFileList(models.AbstractResultFileList):
+
+    def __init__(self, files):
+        self.items = [ChunkStoreResultFile(name, data) for (name, data) in files]
+
+    def results(self):
+        return self.items
+
+
+class ChunkStoreResultQuota(models.AbstractResultQuota):
+
+    def __init__(self, capacity_data):
+        self._used = capacity_data["used"]
+        self._quota = capacity_data["quota"]
+        self._total = capacity_data["total"]
+
+    def used(self):
+        return self._used
+
+    def quota(self):
+        return self._quota
+
+    def total(self):
+        return self._total
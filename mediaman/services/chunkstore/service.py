@@ -0,0 +1,271 @@
+"""
+Class to manage a Service that dedupes files by content-defined chunks.
+
+Uploads are split into variable-size chunks (see `chunking`), and each
+unique chunk (by sha256) is stored once with a backing service (folder or
+Drive), as "chunk.<uuid>".  Each file is stored as a "manifest.<id>" listing its
+chunks, and a "chunks.catalog" records every file and chunk, with the
+number of manifests referencing each chunk.
+
+The backing service is wrapped in the encryption middleware, so every
+chunk (and manifest) is encrypted as it's stored.  Chunks are dedupe'd by
+their plaintext, before encryption; this is why chunk stores aren't wrapped
+in the encryption middleware themselves (see `core.loader`).
+"""
+
+import contextlib
+import functools
+
+from mediaman.core import logtools
+from mediaman.core import models as coremodels
+from mediaman.services.abstract import service
+from mediaman.services.chunkstore import chunking
+from mediaman.services.chunkstore import methods
+from mediaman.services.chunkstore import models
+
+logger = logtools.new_logger("mediaman.services.chunkstore.service")
+
+
+ERROR_MULTIPLE_REMOTE_CATALOGS = "\
+[!] Multiple chunk catalogs found for service ({})!  \
+This must be resolved manually.  Exiting..."
+
+CATALOG_VERSION = 1
+
+
+def init(func):
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        self.init_metadata()
+        return func(self, *args, **kwargs)
+    return wrapped
+
+
+def create_catalog():
+    return {
+        "version": CATALOG_VERSION,
+        "files": {},  # id: {"size", "digest", "manifest"}
+        "chunks": {},  # digest: {"sid", "size", "refs"}
+    }
+
+
+def load_backing(config):
+    from mediaman.middleware import crypto
+    from mediaman.services import loader
+
+    backing_type = loader.ServiceType(config.backing)
+    if backing_type == loader.ServiceType.CHUNK_STORE:
+        raise RuntimeError("A chunk store can't be backed by another chunk store!")
+
+    return crypto.EncryptionMiddlewareService(loader.load(backing_type, config.backing_config(backing_type)))
+
+
+class ChunkStoreService(service.AbstractService):
+
+    CATALOG_FILENAME = "chunks.catalog"
+
+    def __init__(self, config):
+        super().__init__(models.ChunkStoreConfig(config))
+        self.backing = load_backing(self._config)
+        self.catalog = None
+        self.dead_chunks = []  # sid
+        self.dirty = False
+        self.batching = False
+
+    def authenticate(self):
+        pass
+
+    def init_metadata(self):
+        if self.catalog is not None:
+            return
+
+        files = self.backing.search_by_name(ChunkStoreService.CATALOG_FILENAME).results()
+        if len(files) > 1:
+            raise RuntimeError(ERROR_MULTIPLE_REMOTE_CATALOGS.format(self))
+
+        if not files:
+            logger.debug(f"creating chunk catalog")
+            self.catalog = create_catalog()
+            self.update_catalog()
+            return
+
+        logger.debug(f"loading chunk catalog")
+        catalog = methods.download_json(self.backing, files[0].id())
+        version = catalog["version"]
+        if version > CATALOG_VERSION:
+            logger.critical(f"Chunk catalog version ({version}) exceeds software version ({CATALOG_VERSION}).  You need to update your software to parse this chunk store.")
+            raise RuntimeError("Outdated software")
+        self.catalog = catalog
+
+    def update_catalog(self):
+        methods.upload_json(self.backing, ChunkStoreService.CATALOG_FILENAME, self.catalog)
+
+    def flush(self):
+        """Writes the catalog, then removes the chunks it no longer references."""
+        if self.dirty:
+            self.update_catalog()
+            self.dirty = False
+
+        # NOTE: only once the catalog is written, so it never lists a removed chunk
+        (dead_chunks, self.dead_chunks) = (self.dead_chunks, [])
+        for sid in dead_chunks:
+            logger.debug(f"Removing unreferenced chunk {sid}")
+            self.backing.remove(sid)
+
+    def commit(self):
+        self.dirty = True
+        if not self.batching:
+            self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defers writing the catalog until the batch exits.
+
+        Unlike the index, the catalog is written even if the batch fails:
+        the chunks and manifests it describes were stored already.
+        """
+        if self.batching:
+            yield self
+            return
+
+        self.batching = True
+        try:
+            with self.backing.batch():
+                try:
+                    yield self
+                finally:
+                    if self.catalog is not None:
+                        self.flush()
+        finally:
+            self.batching = False
+
+    def file(self, file_id):
+        try:
+            return self.catalog["files"][file_id]
+        except KeyError:
+            raise FileNotFoundError()  # TODO: raise custom error
+
+    def load_manifest(self, file_id):
+        return methods.download_json(self.backing, self.file(file_id)["manifest"])
+
+    def store_chunk(self, data):
+        """Stores the chunk unless it's already stored, and returns its [digest, sid, size]."""
+        digest = methods.chunk_digest(data)
+        chunk = self.catalog["chunks"].get(digest)
+        if chunk is None:
+            receipt = methods.upload_bytes(self.backing, methods.chunk_name(), data)
+            chunk = {"sid": receipt.id(), "size": len(data), "refs": 0}
+            self.catalog["chunks"][digest] = chunk
+        else:
+            logger.debug(f"Chunk already stored: {digest}")
+
+        chunk["refs"] += 1
+        return [digest, chunk["sid"], chunk["size"]]
+
+    def release_chunks(self, chunks):
+        for (digest, _sid, _size) in chunks:
+            chunk = self.catalog["chunks"][digest]
+            chunk["refs"] -= 1
+            if not chunk["refs"]:
+                del self.catalog["chunks"][digest]
+                self.dead_chunks.append(chunk["sid"])
+
+    @init
+    def list_files(self):
+        return models.ChunkStoreResultFileList(self.catalog["files"].items())
+
+    @init
+    def list_file(self, file_id):
+        return models.ChunkStoreResultFile(file_id, self.file(file_id))
+
+    @init
+    def search_by_name(self, file_name):
+        files = self.catalog["files"]
+        return models.ChunkStoreResultFileList([(file_name, files[file_name])] if file_name in files else [])
+
+    @init
+    def search_by_prefix(self, prefix):
+        files = self.catalog["files"]
+        return models.ChunkStoreResultFileList([(name, file) for (name, file) in files.items() if name.startswith(prefix)])
+
+    @init
+    def exists(self, file_id):
+        return file_id in self.catalog["files"]
+
+    @init
+    def upload(self, request):
+        chunks = []
+        try:
+            # NOTE: the file is read once, in order (so it can be hashed as it's read)
+            with request.open() as infile:
+                for data in chunking.chunks(infile):
+                    chunks.append(self.store_chunk(data))
+
+            # NOTE: replacing a file (e.g. the index) releases its old chunks
+            previous_chunks = self.load_manifest(request.id)["chunks"] if self.exists(request.id) else []
+
+            manifest = methods.create_manifest(CATALOG_VERSION, chunks)
+            receipt = methods.upload_json(self.backing, methods.manifest_name(request.id), manifest)
+        except BaseException:
+            # NOTE: no manifest references these chunks (new ones are removed on flush)
+            logger.warning(f"Failed to store '{request.id}', releasing its {len(chunks)} chunks")
+            self.release_chunks(chunks)
+            if not self.batching:
+                self.flush()
+            raise
+
+        self.release_chunks(previous_chunks)
+
+        self.catalog["files"][request.id] = {
+            "size": manifest["size"],
+            "digest": methods.chunks_digest(chunks),
+            "manifest": receipt.id(),
+        }
+        self.commit()
+
+        logger.info(f"Stored '{request.id}' as {len(chunks)} chunks")
+        return models.ChunkStoreReceiptFile({"id": request.id})
+
+    @init
+    def download(self, request):
+        with open(request.path, "wb") as outfile:
+            for data in self.stream(request):
+                outfile.write(data)
+
+        return models.ChunkStoreDownloadReceiptFile({
+            "id": request.id,
+            "path": request.path,
+        })
+
+    @init
+    def stream(self, request):
+        chunks = self.load_manifest(request.id)["chunks"]
+        for (_digest, sid, _size) in chunks:
+            yield from self.backing.stream(coremodels.Request(id=sid))
+
+    @init
+    def stream_range(self, request, offset, length):
+        chunks = self.load_manifest(request.id)["chunks"]
+        return methods.stream_range(self.backing, chunks, offset, length)
+
+    @init
+    def capacity(self):
+        quota = self.backing.capacity()
+        return models.ChunkStoreResultQuota({
+            "used": quota.used(),
+            "quota": self._config.quota,
+            "total": quota.total(),
+        })
+
+    @init
+    def remove(self, file_id):
+        self.file(file_id)
+        chunks = self.load_manifest(file_id)["chunks"]
+        file = self.catalog["files"].pop(file_id)
+
+        self.backing.remove(file["manifest"])
+        self.release_chunks(chunks)
+        self.commit()
+
+        return models.ChunkStoreReceiptFile({"id": file_id})
@@ -54,7 +54,7 @@ def ensure_directory(drive, destination):
     return folder["id"]
 
 
-def authenticate(client_secrets, credentials_path):
+def authorize(client_secrets, credentials_path):
     assert client_secrets or credentials_path
 
     credentials = None
@@ -74,6 +74,10 @@ def authenticate(client_secrets, credentials_path):
     if credentials_path:
         storage.put(credentials)
 
+    return credentials
+
+
+def build_drive(credentials):
     # Create an authorized Drive API client.
     http = httplib2.Http()
     credentials.authorize(http)
@@ -132,14 +136,18 @@ def exists(drive, file_id, folder_id=None):
 def upload(drive, request, folder_id=None):
     # NOTE:  This method is idempotent iff no files are already duplicated.
 
-    # TODO: experiment with chunk size for huge files
-    media_body = apiclient.http.MediaFileUpload(
-        request.path,
-        mimetype="application/octet-stream",  # NOTE: this is optional
-        resumable=True,
-        # chunksize=1024 * 256
-    )
+    with request.open() as fd:
+        # TODO: experiment with chunk size for huge files
+        media_body = apiclient.http.MediaIoBaseUpload(
+            fd,
+            mimetype="application/octet-stream",  # NOTE: this is optional
+            resumable=True,
+            # chunksize=1024 * 256
+        )
+        return upload_media(drive, request, media_body, folder_id=folder_id)
+
 
+def upload_media(drive, request, media_body, folder_id=None):
     # The body contains the metadata for the file.
     body = {
         "title": request.id,
@@ -286,18 +294,34 @@ def search_by_name(drive, file_name, folder_id=None):
     if folder_id:
         request = drive.files().list(
             q=f"title='{file_name}' and '{folder_id}' in parents",
-            fields="items(id, fileSize)",
+            fields="items(id, fileSize, md5Checksum, modifiedDate, etag)",
         )
     else:
         request = drive.files().list(
             q=f"title='{file_name}'",
-            fields="items(id, fileSize)",
+            fields="items(id, fileSize, md5Checksum, modifiedDate, etag)",
         )
 
     files = request.execute()
     return files
 
 
+def search_by_prefix(drive, prefix, folder_id=None):
+    # NOTE: Drive's `contains` only matches title prefixes (at word breaks),
+    #       so the results are filtered again
+    query = f"title contains '{prefix}'"
+    if folder_id:
+        query += f" and '{folder_id}' in parents"
+    request = drive.files().list(
+        q=query,
+        fields="items(id, title, fileSize, md5Checksum, modifiedDate, etag)",
+    )
+
+    files = request.execute()
+    files["items"] = [item for item in files["items"] if item["title"].startswith(prefix)]
+    return files
+
+
 def capacity(drive, quota, folder_id=None):
     capacity_info = drive.about().get().execute()
     used = int(capacity_info.get("quotaBytesUsed"))
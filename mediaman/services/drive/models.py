@@ -43,8 +43,8 @@ class DriveResultFile(models.AbstractResultFile):
         self.labels = file_data.get("labels", "")
         self.created_date = file_data.get("createdDate", "")
         self.modified_date = file_data.get("modifiedDate", "")
+        self.etag = file_data.get("etag", "")
 
-        # self.etag = file_data["etag"]
         # self.alternate_link = file_data["alternateLink"]
         # self.embed_link = file_data["embedLink"]
         # self.icon_link = file_data["iconLink"]
@@ -59,6 +59,11 @@ class DriveResultFile(models.AbstractResultFile):
     def size(self):
         return self.file_size
 
+    def validator(self):
+        if self.md5_checksum:
+            return f"{self.md5_checksum}:{self.modified_date}"
+        return self.etag or None
+
 
 class DriveResultFileList(models.AbstractResultFileList):
 
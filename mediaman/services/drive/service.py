@@ -2,6 +2,8 @@
 Class to manage a Service connection to Google Drive.
 """
 
+import threading
+
 from mediaman.core import logtools
 from mediaman.services.abstract import service
 from mediaman.services.drive import methods
@@ -16,15 +18,25 @@ class DriveService(service.AbstractService):
         logger.debug(f"Drive init")
         super().__init__(models.DriveConfig(config))
 
-        self._drive = None
+        self._credentials = None
+        self._local = threading.local()
         self._folder_id = None
         self._authenticated = False
 
+    @property
+    def _drive(self):
+        # NOTE: httplib2 connections aren't thread-safe, so each thread
+        #       (e.g. the `refresh_hashes` workers) gets its own client.
+        drive = getattr(self._local, "drive", None)
+        if drive is None:
+            drive = self._local.drive = methods.build_drive(self._credentials)
+        return drive
+
     def authenticate(self):
         logger.debug(f"Drive authenticated: {self._authenticated}")
         if self._authenticated:
             return
-        self._drive = methods.authenticate(self._config.client_secrets, self._config.credentials)
+        self._credentials = methods.authorize(self._config.client_secrets, self._config.credentials)
         self._folder_id = methods.ensure_directory(self._drive, self._config.destination)
         self._authenticated = True
 
@@ -50,6 +62,16 @@ class DriveService(service.AbstractService):
             )
         )
 
+    @service.auth
+    def search_by_prefix(self, prefix):
+        return models.DriveResultFileList(
+            methods.search_by_prefix(
+                self._drive,
+                prefix,
+                folder_id=self._folder_id,
+            )
+        )
+
     @service.auth
     def exists(self, file_id):
         return methods.exists(self._drive, file_id, folder_id=self._folder_id)
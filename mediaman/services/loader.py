@@ -20,17 +20,24 @@ def load_drive(config):
     return driveservice.DriveService(config)
 
 
+def load_chunk_store(config):
+    from mediaman.services.chunkstore import service as chunkstoreservice
+    return chunkstoreservice.ChunkStoreService(config)
+
+
 class ServiceType(enum.Enum):
     FOLDER = "folder"
     GOOGLE_DRIVE = "google drive"
     DROPBOX = "dropbox"
     AWS_S3 = "aws s3"
     AWS_GLACIER = "aws glacier"
+    CHUNK_STORE = "chunk store"
 
 
 SERVICE_TYPE_TO_LOADER = {
     ServiceType.FOLDER: load_local,
     ServiceType.GOOGLE_DRIVE: load_drive,
+    ServiceType.CHUNK_STORE: load_chunk_store,
 }
 
 
@@ -59,8 +59,17 @@ def list_file(destination_path, file_id):
 
 def search_by_name(destination_path, file_name):
     logger.debug(f"searching for {repr(file_name)} in {repr(destination_path)}")
-    out = (data for data in list_files(destination_path) if data["name"] == file_name)
-    out = list(out)
+    # NOTE: files are stored under their names, so there's no need to list them all
+    path = pathlib.Path(destination_path / file_name)
+    out = [extractor(path)] if path.is_file() else []
+    logger.debug(f"out = {out}")
+    return out
+
+
+def search_by_prefix(destination_path, prefix):
+    logger.debug(f"searching for {repr(prefix)}* in {repr(destination_path)}")
+    paths = (pathlib.Path(path) for path in glob.glob(f"{glob.escape(str(destination_path / prefix))}*"))
+    out = [extractor(path) for path in paths if path.is_file()]
     logger.debug(f"out = {out}")
     return out
 
@@ -73,7 +82,7 @@ def upload(destination_path, request):
     # TODO: check for overwriting?
     dest = destination_path / request.id
     written = 0
-    with open(request.path, "rb") as infile:
+    with request.open() as infile:
         with open(dest, "wb") as outfile:
             data = infile.read(WRITE_BUFFER)
             while data:
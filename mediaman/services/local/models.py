@@ -37,6 +37,7 @@ class LocalResultFile(models.AbstractResultFile):
         self.accessedDate = stat.st_atime
         self.modifiedDate = stat.st_mtime
         self.createdDate = stat.st_ctime
+        self.modified_ns = stat.st_mtime_ns
 
     def id(self):
         return self.filename
@@ -47,6 +48,9 @@ class LocalResultFile(models.AbstractResultFile):
     def size(self):
         return self._size
 
+    def validator(self):
+        return f"{self._size}:{self.modified_ns}"
+
 
 class LocalResultFileList(models.AbstractResultFileList):
 
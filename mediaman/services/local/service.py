@@ -32,6 +32,11 @@ class LocalService(service.AbstractService):
             methods.search_by_name(self.destination_path, file_name)
         )
 
+    def search_by_prefix(self, prefix):
+        return models.LocalResultFileList(
+            methods.search_by_prefix(self.destination_path, prefix)
+        )
+
     def exists(self, file_id):
         return methods.exists(self.destination_path, file_id)
 
@@ -0,0 +1,84 @@
+"""
+Fixtures shared by the tests: each test gets its own config, encryption
+key, local cache and folder service, all under pytest's `tmp_path`.
+"""
+
+import os
+
+import pytest
+
+from mediaman import config
+
+# NOTE: some modules read the config as they're imported (e.g. `crypto`)
+config.CONFIGURATION = {"services": {}}
+
+
+def service_config(destination, nickname="test", service_type=None, extra=None):
+    from mediaman.services import loader
+    return {
+        "nickname": nickname,
+        "type": service_type or loader.ServiceType.FOLDER,
+        "quota": 1024**3,
+        "destination": str(destination),
+        "cost": False,
+        "extra": extra,
+    }
+
+
+@pytest.fixture
+def keypath(tmp_path):
+    path = tmp_path / "key"
+    path.write_text("correct horse battery staple\n")
+    return str(path)
+
+
+@pytest.fixture
+def configuration(tmp_path, keypath, monkeypatch):
+    from mediaman.core import hashcache
+    from mediaman.middleware import crypto
+
+    monkeypatch.setattr(crypto, "KEYPATH", keypath)
+    monkeypatch.setattr(hashcache, "CACHE", None)
+
+    values = {
+        "services": {},
+        "MM_CACHE_DIR": str(tmp_path / "cache"),
+        "MM_HASH_CACHE": "",
+    }
+    monkeypatch.setattr(config, "CONFIGURATION", values)
+    return values
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / "store"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def folder(configuration, store):
+    """A folder service, without encryption."""
+    from mediaman.services import loader
+    return loader.load_local(service_config(store))
+
+
+@pytest.fixture
+def service(folder):
+    """A folder service, through the encryption middleware (as indexes see it)."""
+    from mediaman.middleware import crypto
+    return crypto.EncryptionMiddlewareService(folder)
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    """Returns a function writing a file of random bytes, returning its path."""
+    directory = tmp_path / "files"
+    directory.mkdir()
+
+    def make(name, size=5000, data=None):
+        path = directory / name
+        path.write_bytes(os.urandom(size) if data is None else data)
+        return path
+
+    return make
@@ -0,0 +1,123 @@
+import pytest
+
+from mediaman.core import models
+from mediaman.core import settings
+from mediaman.core.index import binary
+from mediaman.core.index import index as jsonindex
+
+
+def new_file(number, name, size=1000, fingerprint=None):
+    return {
+        "id": f"id-{number}",
+        "name": name,
+        "sid": f"sid-{number}",
+        "size": size,
+        "hashes": [f"sha256:{number:064x}", f"xxh64:{number:016x}"],
+        "merged_hashes": [f"sha256:{number + 1000:064x}"],
+        "fingerprint": fingerprint,
+        "merkle_root": None,
+        "merkle_sid": None,
+        "crypt": {},
+    }
+
+
+@pytest.fixture
+def metadata():
+    files = {
+        "0": new_file(0, "b.bin", fingerprint=f"1000:{0:016x}"),
+        "1": new_file(1, "a.bin", size=2000),
+        "2": new_file(2, "b.bin", size=3000, fingerprint=f"3000:{2:016x}"),
+        "3": new_file(3, "ünïcode.bin", size=4000, fingerprint="malformed"),
+    }
+    return {**jsonindex.create_metadata(files), "sequence": 42}
+
+
+@pytest.fixture
+def reader(metadata, tmp_path):
+    path = tmp_path / "index.bin"
+    path.write_bytes(binary.encode(metadata))
+    reader = binary.BinaryIndex(path)
+    yield reader
+    reader.close()
+
+
+def test_header(reader, metadata):
+    assert reader.version == settings.VERSION
+    assert reader.sequence == 42
+    assert reader.record_count == len(metadata["files"])
+
+
+def test_records_round_trip(reader, metadata):
+    assert dict(reader.record(number) for number in range(reader.record_count)) == metadata["files"]
+
+
+def test_find_hash(reader, metadata):
+    for (key, file) in metadata["files"].items():
+        for labeled_hash in file["hashes"] + file["merged_hashes"]:
+            assert reader.record(reader.find_hash(labeled_hash)) == (key, file)
+
+    assert reader.find_hash(f"sha256:{99:064x}") is None
+    assert reader.find_hash(f"sha256:{0:016x}") is None
+    assert reader.find_hash("md5:00") is None
+    assert reader.find_hash("sha256:not hex") is None
+
+
+def test_find_name(reader):
+    assert [reader.record(number)[0] for number in reader.find_name("b.bin")] == ["0", "2"]
+    assert [reader.record(number)[0] for number in reader.find_name("ünïcode.bin")] == ["3"]
+    assert reader.find_name("c.bin") == []
+    assert reader.find_name("") == []
+
+
+def test_summary_tables(reader):
+    assert reader.has_size(2000)
+    assert not reader.has_size(2001)
+
+    assert reader.has_fingerprint(f"1000:{0:016x}")
+    assert not reader.has_fingerprint(f"1000:{1:016x}")
+    # NOTE: files without (valid) fingerprints might match any of their size
+    assert reader.has_fingerprint(f"2000:{5:016x}")
+    assert reader.has_fingerprint(f"4000:{5:016x}")
+    assert not reader.has_fingerprint(f"5000:{5:016x}")
+
+
+def test_rejects_other_formats(tmp_path):
+    path = tmp_path / "index.bin"
+    path.write_bytes(b"not an index".ljust(binary.HEADER.size, b"\0"))
+    with pytest.raises(ValueError):
+        binary.BinaryIndex(path)
+
+
+def test_empty_index(tmp_path):
+    path = tmp_path / "index.bin"
+    path.write_bytes(binary.encode(jsonindex.create_metadata()))
+    reader = binary.BinaryIndex(path)
+    try:
+        assert reader.record_count == 0
+        assert reader.find_name("a.bin") == []
+        assert reader.find_hash(f"sha256:{0:064x}") is None
+        assert not reader.has_size(0)
+    finally:
+        reader.close()
+
+
+def test_index_answers_lookups_from_binary(service, make_file):
+    path = make_file("file.bin")
+    index = jsonindex.Index(service)
+    index.upload(models.Request(id=None, path=str(path)))
+    file = index.search_by_name("file.bin")[0]
+
+    # NOTE: the first load builds the binary index, and later ones open it
+    jsonindex.Index(service).force_init()
+    index = jsonindex.Index(service)
+    index.force_init()
+    assert index.reader is not None
+
+    assert index.search_by_name("file.bin") == [file]
+    assert index.get_metadata_by_hash(file["hashes"][0]) == file
+    assert index.has_name("file.bin")
+    assert index.reader is not None
+
+    # NOTE: anything else loads the whole index
+    assert list(index.list_files()) == [file]
+    assert index.reader is None
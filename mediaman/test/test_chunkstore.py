@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+from mediaman.core import models
+from mediaman.services.chunkstore import chunking
+from mediaman.services.chunkstore import methods
+
+from mediaman.test import conftest
+
+SIZE = 200 * 1024
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """Chunks of 4-64 KiB, so that small files span many (and chunking is quick)."""
+    average = 16 * 1024
+    bits = average.bit_length() - 1
+    monkeypatch.setattr(chunking, "MIN_CHUNK_SIZE", 4 * 1024)
+    monkeypatch.setattr(chunking, "AVERAGE_CHUNK_SIZE", average)
+    monkeypatch.setattr(chunking, "MAX_CHUNK_SIZE", 64 * 1024)
+    monkeypatch.setattr(chunking, "MASK_SMALL", chunking.top_bits_mask(bits + 1))
+    monkeypatch.setattr(chunking, "MASK_LARGE", chunking.top_bits_mask(bits - 1))
+
+
+@pytest.fixture
+def chunkstore(configuration, store, small_chunks):
+    from mediaman.services import loader
+    return loader.load_chunk_store(conftest.service_config(store, service_type=loader.ServiceType.CHUNK_STORE))
+
+
+def upload(chunkstore, file_id, path):
+    return chunkstore.upload(models.Request(id=file_id, path=str(path)))
+
+
+def stored_chunks(store):
+    return sorted(path.name for path in store.iterdir() if path.name.startswith(methods.CHUNK_PREFIX))
+
+
+def refs(chunkstore):
+    return {digest: chunk["refs"] for (digest, chunk) in chunkstore.catalog["chunks"].items()}
+
+
+def test_round_trip_and_dedupe(chunkstore, make_file, store, tmp_path):
+    data = os.urandom(SIZE)
+    upload(chunkstore, "a", make_file("a.bin", data=data))
+    chunks = stored_chunks(store)
+    assert len(chunks) > 1
+
+    upload(chunkstore, "b", make_file("b.bin", data=data))
+    assert stored_chunks(store) == chunks
+    assert set(refs(chunkstore).values()) == {2}
+
+    out = tmp_path / "out"
+    chunkstore.download(models.Request(id="b", path=str(out)))
+    assert out.read_bytes() == data
+    assert b"".join(chunkstore.stream_range(models.Request(id="b"), 1000, 10)) == data[1000:1010]
+
+    chunkstore.remove("a")
+    chunkstore.remove("b")
+    assert stored_chunks(store) == []
+    assert chunkstore.catalog["chunks"] == {}
+
+
+def test_failed_manifest_upload_releases_chunks(chunkstore, make_file, store, monkeypatch):
+    data = os.urandom(SIZE)
+    upload(chunkstore, "a", make_file("a.bin", data=data))
+    (before_chunks, before_refs) = (stored_chunks(store), refs(chunkstore))
+    assert len(before_chunks) > 2
+
+    upload_json = methods.upload_json
+    failing = [True]
+
+    def upload_manifest(backing, name, data):
+        if failing[0] and name.startswith(methods.MANIFEST_PREFIX):
+            raise RuntimeError("Upload failed")
+        return upload_json(backing, name, data)
+
+    # NOTE: shares its first chunks with "a", but not the rest
+    monkeypatch.setattr(methods, "upload_json", upload_manifest)
+    with pytest.raises(RuntimeError):
+        upload(chunkstore, "b", make_file("b.bin", data=data[:SIZE // 2] + os.urandom(SIZE)))
+    failing[0] = False
+
+    assert not chunkstore.exists("b")
+    assert refs(chunkstore) == before_refs
+    assert stored_chunks(store) == before_chunks
+
+    chunkstore.remove("a")
+    assert stored_chunks(store) == []
@@ -0,0 +1,82 @@
+import builtins
+import json
+
+from mediaman.core import hashing
+from mediaman.core import models
+from mediaman.core import settings
+from mediaman.core.index import index as jsonindex
+from mediaman.middleware import crypto
+
+
+def upload_as(service, sid, path):
+    return service.upload(models.Request(id=sid, path=str(path)))
+
+
+def create_v2_store(folder, service, make_file):
+    """
+    A store as written before the index held cipher params: an openssl-format
+    file and a plaintext one, and an old "crypt" file listing (unsalted)
+    params for the first only.
+    """
+    encrypted = make_file("encrypted.bin", size=5000)
+    plain = make_file("plain.bin", size=3000)
+
+    params = crypto.new_params(encrypted, **crypto.LEGACY_PARAMS)
+    with crypto.encrypt(models.Request(id="sid-encrypted", path=str(encrypted)), crypto.KEYPATH, params) as request:
+        folder.upload(request)
+    upload_as(folder, "sid-plain", plain)
+
+    crypt = {"version": 2, "data": {"sid-encrypted": crypto.LEGACY_PARAMS}}
+    upload_as(folder, crypto.EncryptionMiddlewareService.MIDDLEWARE_FILENAME, make_file("crypt", data=json.dumps(crypt).encode()))
+
+    files = {
+        str(number): {
+            "id": f"id-{name}",
+            "name": name,
+            "sid": f"sid-{name.split('.')[0]}",
+            "size": path.stat().st_size,
+            "hashes": [hashing.to_sha256(hashing.sha256(path))],
+            "merged_hashes": [],
+        }
+        for (number, (name, path)) in enumerate([("encrypted.bin", encrypted), ("plain.bin", plain)])
+    }
+    upload_as(service, jsonindex.Index.INDEX_FILENAME, make_file("index", data=json.dumps({"version": 2, "files": files}).encode()))
+    return (params, encrypted, plain)
+
+
+def refresh(service, monkeypatch):
+    answers = iter(["y", "n", "n"])
+    monkeypatch.setattr(builtins, "input", lambda prompt="": next(answers))
+    index = jsonindex.Index(service)
+    index.refresh()
+    return index
+
+
+def count_reads(folder, monkeypatch):
+    reads = []
+    for method in ["download", "stream", "stream_range"]:
+        original = getattr(folder, method)
+        monkeypatch.setattr(folder, method, lambda *args, original=original, method=method: reads.append(method) or original(*args))
+    return reads
+
+
+def test_refresh_migrates_crypt_file_once(folder, service, make_file, store, tmp_path, monkeypatch):
+    (params, encrypted, plain) = create_v2_store(folder, service, make_file)
+
+    index = refresh(service, monkeypatch)
+    crypts = {file["name"]: file["crypt"] for file in index.list_files()}
+    assert crypts == {"encrypted.bin": params, "plain.bin": {}}
+    assert index.metadata["version"] == settings.VERSION
+    assert not (store / crypto.EncryptionMiddlewareService.MIDDLEWARE_FILENAME).exists()
+
+    index = jsonindex.Index(service)
+    for (name, path) in [("encrypted.bin", encrypted), ("plain.bin", plain)]:
+        destination = tmp_path / "out"
+        destination.mkdir(exist_ok=True)
+        index.download(destination, name)
+        assert (destination / name).read_bytes() == path.read_bytes()
+
+    reads = count_reads(folder, monkeypatch)
+    index = refresh(service, monkeypatch)
+    assert reads == []
+    assert {file["name"]: file["crypt"] for file in index.list_files()} == crypts
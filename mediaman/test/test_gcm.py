@@ -0,0 +1,154 @@
+import io
+import os
+
+import pytest
+
+from mediaman.core import models
+from mediaman.middleware import gcm
+
+# NOTE: small segments, so multi-segment files stay small
+SEGMENT_SIZE = 1024
+SIZES = [0, 100, SEGMENT_SIZE, 3 * SEGMENT_SIZE, 3 * SEGMENT_SIZE + 5]
+
+
+def new_params(size):
+    return dict(gcm.new_params(size), segment_size=SEGMENT_SIZE)
+
+
+def encrypt(data, keypath, params):
+    with gcm.EncryptingFile(io.BytesIO(data), keypath, params) as infile:
+        return infile.read()
+
+
+def chunked(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)] or [b""]
+
+
+def decrypt(ciphertext, keypath, params=None, chunk_size=7):
+    return b"".join(gcm.decrypt_chunks(chunked(ciphertext, chunk_size), keypath, params))
+
+
+def segments(ciphertext):
+    stride = SEGMENT_SIZE + gcm.TAG_SIZE
+    return (ciphertext[:gcm.HEADER.size], chunked(ciphertext[gcm.HEADER.size:], stride))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip(keypath, size):
+    data = os.urandom(size)
+    params = new_params(size)
+    ciphertext = encrypt(data, keypath, params)
+
+    assert len(ciphertext) == gcm.encrypted_size(params)
+    assert decrypt(ciphertext, keypath, params) == data
+    assert decrypt(ciphertext, keypath) == data
+    assert decrypt(ciphertext, keypath, chunk_size=len(ciphertext)) == data
+
+
+def test_encrypting_file_seeks(keypath):
+    data = os.urandom(3 * SEGMENT_SIZE)
+    params = new_params(len(data))
+    ciphertext = encrypt(data, keypath, params)
+
+    with gcm.EncryptingFile(io.BytesIO(data), keypath, params) as infile:
+        infile.seek(SEGMENT_SIZE + 50)
+        assert infile.read(100) == ciphertext[SEGMENT_SIZE + 50:SEGMENT_SIZE + 150]
+
+
+def test_rejects_tampered_segment(keypath):
+    params = new_params(3 * SEGMENT_SIZE)
+    ciphertext = bytearray(encrypt(os.urandom(3 * SEGMENT_SIZE), keypath, params))
+    ciphertext[gcm.HEADER.size + SEGMENT_SIZE + 10] ^= 1
+
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(bytes(ciphertext), keypath, params)
+
+
+def test_rejects_tampered_header(keypath):
+    params = new_params(100)
+    ciphertext = encrypt(os.urandom(100), keypath, params)
+    other = dict(params, salt=os.urandom(gcm.SALT_SIZE).hex())
+
+    with pytest.raises(RuntimeError, match="Bad ciphertext header"):
+        decrypt(ciphertext, keypath, other)
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(gcm.header(other) + ciphertext[gcm.HEADER.size:], keypath)
+
+
+@pytest.mark.parametrize("cut", [1, gcm.TAG_SIZE, SEGMENT_SIZE + gcm.TAG_SIZE])
+def test_rejects_truncation(keypath, cut):
+    # NOTE: including at a segment boundary, where every remaining segment is whole
+    params = new_params(3 * SEGMENT_SIZE)
+    ciphertext = encrypt(os.urandom(3 * SEGMENT_SIZE), keypath, params)
+
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(ciphertext[:-cut], keypath, params)
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(ciphertext[:-cut], keypath)
+
+
+def test_rejects_truncated_header(keypath):
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(encrypt(b"", keypath, new_params(0))[:gcm.HEADER.size - 1], keypath)
+
+
+def test_rejects_reordered_segments(keypath):
+    params = new_params(3 * SEGMENT_SIZE)
+    (header, (first, second, third)) = segments(encrypt(os.urandom(3 * SEGMENT_SIZE), keypath, params))
+
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(header + second + first + third, keypath, params)
+    with pytest.raises(RuntimeError, match="Bad decrypt"):
+        decrypt(header + first + third + second, keypath, params)
+
+
+def test_segment_range_at_boundaries():
+    params = new_params(3 * SEGMENT_SIZE + 5)
+    stride = SEGMENT_SIZE + gcm.TAG_SIZE
+    header = gcm.HEADER.size
+
+    assert gcm.segment_range(params, 0, SEGMENT_SIZE) == (0, 1, header, stride)
+    assert gcm.segment_range(params, SEGMENT_SIZE - 1, 2) == (0, 2, header, 2 * stride)
+    assert gcm.segment_range(params, SEGMENT_SIZE, SEGMENT_SIZE) == (1, 2, header + stride, stride)
+    assert gcm.segment_range(params, 3 * SEGMENT_SIZE, 5) == (3, 4, header + 3 * stride, 5 + gcm.TAG_SIZE)
+    # NOTE: ranges running past EOF stop at the last segment
+    assert gcm.segment_range(params, 3 * SEGMENT_SIZE, 100) == (3, 4, header + 3 * stride, 5 + gcm.TAG_SIZE)
+    assert gcm.segment_range(params, 4 * SEGMENT_SIZE, 100)[:2] == (4, 4)
+
+
+@pytest.fixture
+def stored(service, make_file, monkeypatch):
+    """Returns (request, plaintext) for a multi-segment file stored through the middleware."""
+    monkeypatch.setattr(gcm, "SEGMENT_SIZE", SEGMENT_SIZE)
+    path = make_file("file.bin", size=3 * SEGMENT_SIZE + 5)
+    request = models.Request(id="file", path=str(path))
+    service.upload(request)
+    assert request.crypt["segment_size"] == SEGMENT_SIZE
+    return (models.Request(id="file", crypt=request.crypt), path.read_bytes())
+
+
+@pytest.mark.parametrize(("offset", "length"), [
+    (0, -1),
+    (0, SEGMENT_SIZE),
+    (SEGMENT_SIZE - 1, 2),
+    (SEGMENT_SIZE, SEGMENT_SIZE),
+    (SEGMENT_SIZE, -1),
+    (3 * SEGMENT_SIZE, 5),
+    (3 * SEGMENT_SIZE + 4, 100),
+    (3 * SEGMENT_SIZE + 5, 10),
+    (4 * SEGMENT_SIZE, 10),
+])
+def test_stream_range_segmented(service, stored, offset, length):
+    (request, data) = stored
+    expected = data[offset:] if length < 0 else data[offset:offset + length]
+    assert b"".join(service.stream_range(request, offset, length)) == expected
+
+
+def test_stream_range_fetches_only_covering_segments(service, folder, stored, monkeypatch):
+    (request, data) = stored
+    ranges = []
+    stream_range = folder.stream_range
+    monkeypatch.setattr(folder, "stream_range", lambda request, offset, length: ranges.append((offset, length)) or stream_range(request, offset, length))
+
+    assert b"".join(service.stream_range(request, SEGMENT_SIZE + 1, 10)) == data[SEGMENT_SIZE + 1:SEGMENT_SIZE + 11]
+    assert ranges == [(gcm.HEADER.size + SEGMENT_SIZE + gcm.TAG_SIZE, SEGMENT_SIZE + gcm.TAG_SIZE)]
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from mediaman.core import hashing
+from mediaman.core import hashpool
+from mediaman.core import models
+
+
+def new_requests(make_file, count, taken=None):
+    for number in range(count):
+        if taken is not None:
+            taken.append(number)
+        yield models.Request(id=None, path=str(make_file(f"file{number}.bin", size=1000 + number)))
+
+
+def hashed(request):
+    # NOTE: without reading the file, as `request.hashes` would
+    return request._hashes is not None
+
+
+def test_hashes_every_request(configuration, make_file):
+    paths = [make_file(f"file{number}.bin") for number in range(10)]
+    requests = [models.Request(id=None, path=str(path)) for path in paths]
+
+    yielded = list(hashpool.hash_requests(requests, workers=3))
+    assert sorted(request.path for request in yielded) == sorted(str(path) for path in paths)
+    assert all(hashed(request) for request in yielded)
+    assert yielded[0].hashes == hashing.hashes(yielded[0].path)
+
+
+def test_skip_runs_after_fingerprint_on_calling_thread(configuration, make_file):
+    calls = []
+
+    def skip(request):
+        # NOTE: the fingerprint was read on the pool
+        calls.append((threading.current_thread(), request._fingerprint is not None))
+        return request.path.endswith(("0.bin", "2.bin", "4.bin"))
+
+    yielded = list(hashpool.hash_requests(new_requests(make_file, 6), workers=2, skip=skip))
+    assert calls == [(threading.current_thread(), True)] * 6
+    assert sorted(request.path[-5] for request in yielded if not hashed(request)) == ["0", "2", "4"]
+    assert sorted(request.path[-5] for request in yielded if hashed(request)) == ["1", "3", "5"]
+
+
+def test_takes_requests_lazily(configuration, make_file):
+    taken = []
+    requests = hashpool.hash_requests(new_requests(make_file, 100, taken), workers=2)
+    next(requests)
+    assert len(taken) <= hashpool.WINDOW_PER_WORKER * 2 + 1
+    requests.close()
+
+
+def test_limits_reads_per_device(configuration, make_file, monkeypatch):
+    lock = threading.Lock()
+    reading = []
+    most = []
+
+    def compute_hash(request):
+        with lock:
+            reading.append(request)
+            most.append(len(reading))
+        time.sleep(0.01)
+        with lock:
+            reading.remove(request)
+
+    monkeypatch.setattr(hashpool, "compute_hash", compute_hash)
+    monkeypatch.setattr(hashpool, "compute_fingerprint", compute_hash)
+
+    # NOTE: all on the same device
+    list(hashpool.hash_requests(new_requests(make_file, 12), workers=4, per_device=2, skip=lambda request: False))
+    assert max(most) == 2
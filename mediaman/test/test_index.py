@@ -0,0 +1,68 @@
+from mediaman.core import hashing
+from mediaman.core import models
+from mediaman.core.clients.multi import multiclient
+from mediaman.core.index import index as jsonindex
+
+
+def upload(index, *paths):
+    for path in paths:
+        index.upload(models.Request(id=None, path=str(path)))
+
+
+def reopen(service):
+    """A fresh index for the service, as a new `mm` invocation would load it."""
+    index = jsonindex.Index(service)
+    index.force_init()
+    return index
+
+
+def test_prefilter_is_answered_from_the_binary_index(service, make_file):
+    known = make_file("known.bin", size=5000)
+    upload(jsonindex.Index(service), known)
+
+    # NOTE: the first load builds the binary index, and later ones open it
+    reopen(service)
+    index = reopen(service)
+    assert index.reader is not None
+
+    assert index.has_size(5000)
+    assert not index.has_size(5001)
+    assert index.has_fingerprint(hashing.fingerprint(known))
+    assert not index.has_fingerprint(hashing.fingerprint(make_file("other.bin", size=5000)))
+    assert not index.might_have(models.Request(id=None, path=str(make_file("bigger.bin", size=6000))))
+    assert index.reader is not None
+
+
+def test_binary_prefilter_matches_unfingerprinted_sizes(service, make_file):
+    known = make_file("known.bin", size=5000)
+    index = jsonindex.Index(service)
+    upload(index, known)
+    index.add_file_fingerprint(index.search_by_name("known.bin")[0], None)
+
+    reopen(service)
+    index = reopen(service)
+    assert index.reader is not None
+
+    # NOTE: any file of that size might be the unfingerprinted one
+    assert index.has_fingerprint(hashing.fingerprint(make_file("other.bin", size=5000)))
+    assert not index.has_fingerprint(hashing.fingerprint(make_file("smaller.bin", size=4000)))
+
+
+class StubClient:
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def might_have(self, request):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+def test_multiclient_might_have():
+    request = models.Request(id=None, path=None)
+    assert not multiclient.Multiclient([StubClient(False), StubClient(False)]).might_have(request)
+    assert multiclient.Multiclient([StubClient(False), StubClient(True)]).might_have(request)
+
+    # NOTE: a client that fails to answer might have it
+    assert multiclient.Multiclient([StubClient(False), StubClient(RuntimeError())]).might_have(request)
@@ -0,0 +1,126 @@
+import json
+
+from mediaman.core import models
+from mediaman.core.index import base
+from mediaman.core.index import index as jsonindex
+
+
+def upload(index, *paths):
+    for path in paths:
+        index.upload(models.Request(id=None, path=str(path)))
+
+
+def reopen(service):
+    index = jsonindex.Index(service)
+    index.force_init()
+    return index
+
+
+def names(index):
+    return sorted(file["name"] for file in index.files().values())
+
+
+def journal_files(store):
+    return sorted(path.name for path in store.iterdir() if path.name.startswith(jsonindex.Index.JOURNAL_FILENAME))
+
+
+def download_snapshot(service, tmp_path):
+    path = tmp_path / "snapshot"
+    (index_file,) = service.search_by_name(jsonindex.Index.INDEX_FILENAME).results()
+    service.download(models.Request(id=index_file.id(), path=str(path)))
+    return json.loads(path.read_text())
+
+
+def test_segment_number():
+    assert base.segment_number("index.journal", "index.journal") == 0
+    assert base.segment_number("index.journal.12", "index.journal") == 12
+    assert base.segment_number("index.journal.tmp", "index.journal") is None
+    assert base.segment_number("index", "index.journal") is None
+
+
+def test_each_flush_uploads_only_new_records(service, make_file, monkeypatch):
+    index = jsonindex.Index(service)
+    upload(index, make_file("a.bin"))
+
+    uploads = []
+    upload_text = index.upload_text
+    monkeypatch.setattr(index, "upload_text", lambda name, text: uploads.append((name, text)) or upload_text(name, text))
+
+    upload(index, make_file("b.bin"))
+    with index.batch():
+        upload(index, make_file("c.bin"), make_file("d.bin"))
+
+    assert [name for (name, _) in uploads] == ["index.journal.2", "index.journal.4"]
+    assert [[json.loads(line)["seq"] for line in text.splitlines()[1:]] for (_, text) in uploads] == [[2], [3, 4]]
+    assert names(reopen(service)) == ["a.bin", "b.bin", "c.bin", "d.bin"]
+
+
+def test_replay_stops_at_partially_written_segment(service, make_file, store):
+    upload(jsonindex.Index(service), make_file("a.bin"), make_file("b.bin"), make_file("c.bin"))
+
+    segment = store / "index.journal.3"
+    segment.write_bytes(segment.read_bytes()[:-7])
+
+    index = reopen(service)
+    assert names(index) == ["a.bin", "b.bin"]
+    assert index.sequence == 2
+    assert index.journal_damaged
+
+    # NOTE: the next write compacts the journal, rather than appending to it
+    upload(index, make_file("d.bin"))
+    assert journal_files(store) == []
+    assert names(reopen(service)) == ["a.bin", "b.bin", "d.bin"]
+
+
+def test_replay_stops_at_sequence_gap(service, make_file, store):
+    upload(jsonindex.Index(service), make_file("a.bin"), make_file("b.bin"), make_file("c.bin"))
+    (store / "index.journal.2").unlink()
+
+    index = reopen(service)
+    assert names(index) == ["a.bin"]
+    assert index.sequence == 1
+    assert index.journal_damaged
+
+    upload(index, make_file("d.bin"))
+    assert journal_files(store) == []
+    assert names(reopen(service)) == ["a.bin", "d.bin"]
+
+
+def test_compaction_writes_plain_snapshot(service, make_file, store, tmp_path, monkeypatch):
+    monkeypatch.setattr(base, "JOURNAL_SEGMENT_LIMIT", 3)
+    index = jsonindex.Index(service)
+    upload(index, make_file("a.bin"), make_file("b.bin"), make_file("c.bin"))
+    assert journal_files(store) == ["index.journal.1", "index.journal.2", "index.journal.3"]
+
+    upload(index, make_file("d.bin"))
+    assert journal_files(store) == []
+
+    # NOTE: the snapshot is the pre-journal format, plus its sequence number
+    expected = reopen(service)
+    assert download_snapshot(service, tmp_path) == {**jsonindex.create_metadata(expected.files()), "sequence": 4}
+    assert names(expected) == ["a.bin", "b.bin", "c.bin", "d.bin"]
+
+
+def test_interrupted_compaction_skips_folded_segments(service, make_file, store, monkeypatch):
+    index = jsonindex.Index(service)
+    upload(index, make_file("a.bin"), make_file("b.bin"))
+
+    # NOTE: as if the snapshot was written, but the segments weren't deleted
+    monkeypatch.setattr(index, "segments", [])
+    index.update_metadata()
+    assert journal_files(store) == ["index.journal.1", "index.journal.2"]
+
+    index = reopen(service)
+    assert names(index) == ["a.bin", "b.bin"]
+    assert index.journal == []
+    assert not index.journal_damaged
+
+
+def test_legacy_journal_is_replayed_first(service, make_file, store):
+    index = jsonindex.Index(service)
+    upload(index, make_file("a.bin"), make_file("b.bin"))
+    (store / "index.journal.1").rename(store / "index.journal")
+
+    index = reopen(service)
+    assert names(index) == ["a.bin", "b.bin"]
+    assert index.sequence == 2
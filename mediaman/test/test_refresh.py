@@ -0,0 +1,145 @@
+import builtins
+
+import pytest
+
+from mediaman.core import hashing
+from mediaman.core import merkle
+from mediaman.core import models
+from mediaman.core.index import base
+from mediaman.core.index import index as jsonindex
+
+SIZES = [0, 1000, 5000, 3 * hashing.FINGERPRINT_SAMPLE + 1, 1024**2 + 7]
+
+
+@pytest.fixture
+def uploaded(configuration, service, make_file):
+    """An index of files missing all but their sha256 hashes, and their expected digests."""
+    configuration[hashing.RECORDED_HASHES_KEY] = "sha256"
+    configuration[base.REFRESH_WORKERS_KEY] = 2
+
+    index = jsonindex.Index(service)
+    expected = {}
+    for (number, size) in enumerate(SIZES):
+        path = make_file(f"file{number}.bin", size=size)
+        index.upload(models.Request(id=None, path=str(path)))
+        expected[path.name] = (sorted(hashing.hashes(path)), hashing.fingerprint(path))
+
+    roots = {}
+    for file in index.files().values():
+        roots[file["name"]] = file["merkle_root"]
+        file["hashes"] = [hash for hash in file["hashes"] if hash.startswith(hashing.Hash.SHA256.value)]
+        file["fingerprint"] = None
+        file["merkle_root"] = None
+        file["merkle_sid"] = None
+    index.update_metadata()
+
+    return (expected, roots)
+
+
+def test_refresh_hashes(service, folder, uploaded, monkeypatch):
+    (expected, roots) = uploaded
+    monkeypatch.setattr(base, "REFRESH_COMMIT_INTERVAL", 2)
+
+    index = jsonindex.Index(service)
+    index.force_init()
+    segments = []
+    upload_text = index.upload_text
+    monkeypatch.setattr(index, "upload_text", lambda name, text: segments.append(name) or upload_text(name, text))
+
+    index.refresh_hashes()
+
+    files = {file["name"]: file for file in jsonindex.Index(service).list_files()}
+    assert {name: (sorted(file["hashes"]), file["fingerprint"]) for (name, file) in files.items()} == expected
+    assert {name: file["merkle_root"] for (name, file) in files.items()} == roots
+    # NOTE: committed a batch at a time
+    assert len(segments) == 3
+
+    # NOTE: complete files are skipped, without reading them
+    reads = []
+    for method in ["stream", "stream_range"]:
+        original = getattr(folder, method)
+        monkeypatch.setattr(folder, method, lambda *args, original=original: reads.append(args) or original(*args))
+    index.refresh_hashes()
+    assert reads == []
+    assert len(segments) == 3
+
+
+def test_refresh_hashes_rolls_back_failed_batch(service, uploaded, monkeypatch):
+    monkeypatch.setattr(base, "REFRESH_COMMIT_INTERVAL", 2)
+
+    index = jsonindex.Index(service)
+    stream_digests = index.stream_digests
+    calls = []
+
+    def failing(pending_file):
+        calls.append(pending_file)
+        if len(calls) == 3:
+            raise RuntimeError("Stream failed")
+        return stream_digests(pending_file)
+
+    monkeypatch.setattr(index, "stream_digests", failing)
+    with pytest.raises(RuntimeError):
+        index.refresh_hashes()
+
+    # NOTE: the first batch was committed, and a rerun picks up from there
+    files = list(jsonindex.Index(service).list_files())
+    assert sum(file["fingerprint"] is not None for file in files) == 2
+
+
+def test_refresh_file_list_keeps_plaintext_sizes(service, make_file, monkeypatch):
+    index = jsonindex.Index(service)
+    paths = [make_file(f"file{number}.bin", size=size) for (number, size) in enumerate([10, 70000, 2 * 1024**2 + 3])]
+    for path in paths:
+        index.upload(models.Request(id=None, path=str(path)))
+
+    # NOTE: metadata looks good, refresh the file list, which looks good, but not the hashes
+    answers = iter(["y", "y", "y", "n"])
+    monkeypatch.setattr(builtins, "input", lambda prompt="": next(answers))
+    jsonindex.Index(service).refresh()
+
+    index = jsonindex.Index(service)
+    assert sorted(file["size"] for file in index.list_files()) == sorted(path.stat().st_size for path in paths)
+    for path in paths:
+        request = models.Request(id=None, path=str(path))
+        assert index.might_have(request)
+        assert index.has_hash(request.hash)
+
+
+def test_refresh_hashes_rebuilds_ciphertext_sizes(service, folder, make_file, store, tmp_path, monkeypatch):
+    index = jsonindex.Index(service)
+    paths = {}
+    for (number, size) in enumerate([10, 70000, 2 * 1024**2 + 3]):
+        path = make_file(f"file{number}.bin", size=size)
+        index.upload(models.Request(id=None, path=str(path)))
+        paths[path.name] = path
+
+    # NOTE: as an older `refresh_file_list` left them, with sizes (and so
+    #       fingerprints and sidecars) of the ciphertext
+    listed_sizes = index.listed_sizes()
+    with index.batch():
+        for file in list(index.list_files()):
+            size = listed_sizes[file["sid"]]
+            index.add_file_size(file, size)
+            index.add_file_fingerprint(file, f"{size}:{0:016x}")
+            index.remove_merkle(file)
+            leaves = [merkle.leaf_hash(b"")] * merkle.block_count(size)
+            index.add_file_merkle(file, *index.store_merkle(file["id"], size, leaves))
+
+    index = jsonindex.Index(service)
+    index.refresh_hashes()
+
+    index = jsonindex.Index(service)
+    for file in index.list_files():
+        path = paths[file["name"]]
+        assert file["size"] == path.stat().st_size
+        assert file["fingerprint"] == hashing.fingerprint(path)
+        assert b"".join(index.stream_range(tmp_path, file["id"], 0, -1)) == path.read_bytes()
+        assert index.might_have(models.Request(id=None, path=str(path)))
+    assert len(list(store.glob("*.merkle"))) == len(paths)
+
+    reads = []
+    for method in ["stream", "stream_range"]:
+        original = getattr(folder, method)
+        monkeypatch.setattr(folder, method, lambda *args, original=original: reads.append(args) or original(*args))
+    index.refresh_hashes()
+    assert reads == []
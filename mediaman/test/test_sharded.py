@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from mediaman.core import hashing
+from mediaman.core import models
+from mediaman.core.index import sharded
+
+
+def upload(index, *paths):
+    for path in paths:
+        index.upload(models.Request(id=None, path=str(path)))
+
+
+def reopen(service):
+    """A fresh index for the service, recording the shards it loads."""
+    index = sharded.ShardedIndex(service)
+    index.force_init()
+    index.loaded = []
+    download_text = index.download_text
+    index.download_text = lambda file, name: index.loaded.append(name) or download_text(file, name)
+    return index
+
+
+@pytest.fixture
+def paths(make_file):
+    return [make_file(f"file{number}.bin", size=1000 + number) for number in range(20)]
+
+
+@pytest.fixture
+def index(service, paths):
+    index = sharded.ShardedIndex(service)
+    with index.batch():
+        upload(index, *paths)
+    return index
+
+
+def test_lookups_by_name_load_one_summary(service, index, paths):
+    file = index.search_by_name("file3.bin")[0]
+    assert len(index.manifest["shards"]) > 10
+
+    index = reopen(service)
+    assert index.search_by_name("file3.bin") == [file]
+    assert index.loaded == [
+        sharded.summary_name(sharded.NAMES, sharded.summary_prefix("file3.bin", index.prefix_length())),
+        sharded.shard_name(sharded.hash_prefix(file["hashes"][0], index.prefix_length())),
+    ]
+
+    index = reopen(service)
+    assert index.has_name("file3.bin")
+    assert not index.has_name("other.bin")
+    assert index.search_by_name("other.bin") == []
+    assert all(name.startswith("index.names.") for name in index.loaded)
+
+
+def test_prefilter_loads_one_summary(service, index, paths, make_file):
+    index = reopen(service)
+    assert index.has_size(1003)
+    assert not index.has_size(999)
+    assert index.has_fingerprint(hashing.fingerprint(paths[3]))
+    assert not index.has_fingerprint(hashing.fingerprint(make_file("other.bin", size=1003)))
+    assert not index.might_have(models.Request(id=None, path=str(make_file("bigger.bin", size=999))))
+    assert all(name.startswith("index.sizes.") for name in index.loaded)
+
+
+def test_summaries_follow_changes(service, index, make_file):
+    first = index.search_by_name("file3.bin")[0]
+    upload(index, make_file("file3.bin", size=1003))
+    assert len(index.search_by_name("file3.bin")) == 2
+
+    # NOTE: an unfingerprinted file might match any fingerprint of its size
+    index.add_file_fingerprint(first, None)
+    index = reopen(service)
+    assert index.has_fingerprint(hashing.fingerprint(make_file("other.bin", size=1003)))
+
+    index.remove(models.Request(id=None, hash=first["hashes"][0]))
+    index = reopen(service)
+    (remaining,) = index.search_by_name("file3.bin")
+    assert remaining["id"] != first["id"]
+    assert not index.has_fingerprint(hashing.fingerprint(make_file("other.bin", size=1003)))
+
+    index.remove(models.Request(id=None, hash=remaining["hashes"][0]))
+    index = reopen(service)
+    assert not index.has_name("file3.bin")
+    assert not index.has_size(1003)
+
+
+def test_fuzzy_search_loads_only_matching_shards(service, index):
+    index = reopen(service)
+    files = index.fuzzy_search_by_name("FILE1", limit=3)
+    assert [file["name"] for file in files] == ["file1.bin", "file10.bin", "file11.bin"]
+
+    loaded_shards = [name for name in index.loaded if not name.startswith(("index.names.", "index.sizes."))]
+    assert len(loaded_shards) <= 3
+
+
+def test_builds_summaries_for_older_manifests(service, index, store):
+    files = sorted(index.list_files(), key=lambda file: file["name"])
+
+    manifest = dict(index.manifest)
+    del manifest["summaries"]
+    index.upload_text(sharded.ShardedIndex.MANIFEST_FILENAME, json.dumps(manifest))
+    for path in store.glob("index.names.*"):
+        path.unlink()
+
+    index = reopen(service)
+    assert index.manifest["summaries"][sharded.NAMES]
+    assert index.search_by_name("file3.bin") == [files[13]]
+    assert index.has_size(1003)
+    assert sorted(reopen(service).list_files(), key=lambda file: file["name"]) == files
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+
+from mediaman.core import models
+from mediaman.core.index import base
+from mediaman.core.index import index as jsonindex
+from mediaman.core.index import sqlite
+
+
+def upload(index, *paths):
+    for path in paths:
+        index.upload(models.Request(id=None, path=str(path)))
+
+
+def reopen(service):
+    index = sqlite.SqliteIndex(service)
+    index.force_init()
+    return index
+
+
+def names(index):
+    return sorted(file["name"] for file in index.list_files())
+
+
+def journal_files(store):
+    return sorted(path.name for path in store.iterdir() if path.name.startswith(sqlite.SqliteIndex.JOURNAL_FILENAME))
+
+
+@pytest.fixture
+def uploads(service, monkeypatch):
+    """The ids of everything uploaded through the service."""
+    uploads = []
+    upload = service.upload
+    monkeypatch.setattr(service, "upload", lambda request: uploads.append(request.id) or upload(request))
+    return uploads
+
+
+def test_writes_upload_journal_segments(service, make_file, store, uploads):
+    index = sqlite.SqliteIndex(service)
+    index.force_init()
+    uploads.clear()
+
+    upload(index, make_file("a.bin"))
+    with index.batch():
+        upload(index, make_file("b.bin"), make_file("c.bin"))
+
+    assert sqlite.SqliteIndex.DATABASE_FILENAME not in uploads
+    assert journal_files(store) == ["index.sqlite.journal.1", "index.sqlite.journal.3"]
+    assert names(reopen(service)) == ["a.bin", "b.bin", "c.bin"]
+
+
+def test_replays_every_kind_of_record(service, make_file):
+    index = sqlite.SqliteIndex(service)
+    upload(index, make_file("a.bin"), make_file("b.bin"))
+    (a, b) = sorted(index.list_files(), key=lambda file: file["name"])
+
+    index.add_file_hashes(a, ["md5:00"])
+    index.add_file_fingerprint(a, "5000:0000000000000000")
+    index.add_file_merkle(a, "root", "merkle-sid")
+    index.add_file_crypt(a, {})
+    index.remove(models.Request(id=None, hash=b["hashes"][0]))
+
+    expected = list(index.list_files())
+    assert expected[0]["hashes"][-1] == "md5:00"
+    assert list(reopen(service).list_files()) == expected
+
+
+def test_compaction_uploads_database(service, make_file, store, uploads, monkeypatch):
+    monkeypatch.setattr(base, "JOURNAL_SEGMENT_LIMIT", 2)
+    index = sqlite.SqliteIndex(service)
+    upload(index, make_file("a.bin"), make_file("b.bin"))
+    assert journal_files(store) == ["index.sqlite.journal.1", "index.sqlite.journal.2"]
+
+    uploads.clear()
+    upload(index, make_file("c.bin"))
+    assert journal_files(store) == []
+    assert sqlite.SqliteIndex.DATABASE_FILENAME in uploads
+
+    index = reopen(service)
+    assert index.sequence == 3
+    assert names(index) == ["a.bin", "b.bin", "c.bin"]
+
+    upload(index, make_file("d.bin"))
+    assert journal_files(store) == ["index.sqlite.journal.4"]
+    assert names(reopen(service)) == ["a.bin", "b.bin", "c.bin", "d.bin"]
+
+
+def test_damaged_journal_is_compacted(service, make_file, store):
+    upload(sqlite.SqliteIndex(service), make_file("a.bin"), make_file("b.bin"))
+    segment = store / "index.sqlite.journal.2"
+    segment.write_bytes(segment.read_bytes()[:-7])
+
+    index = reopen(service)
+    assert names(index) == ["a.bin"]
+    assert index.journal_damaged
+
+    upload(index, make_file("c.bin"))
+    assert journal_files(store) == []
+    assert names(reopen(service)) == ["a.bin", "c.bin"]
+
+
+def test_files_are_queried_with_their_hashes(service, make_file):
+    index = sqlite.SqliteIndex(service)
+    upload(index, make_file("a.bin"), make_file("b.bin"))
+    upload(index, make_file("a.bin", size=3000))
+    files = list(index.list_files())
+    index.add_file_hashes(files[1], ["md5:01"])
+
+    queries = []
+    index.connection.set_trace_callback(queries.append)
+    (a, b, other_a) = index.list_files()
+    assert len(queries) == 1
+
+    assert b["hashes"][-1] == "md5:01"
+    assert index.search_by_name("a.bin") == [a, other_a]
+    assert index.fuzzy_search_by_name("b.bin") == [b]
+    assert index.search_by_hashes([b["hashes"][0], "sha256:00"]) == {b["hashes"][0]: [b], "sha256:00": []}
+
+
+def test_imports_older_json_index(service, make_file):
+    files = {
+        "0": {"id": "id-a", "name": "a.bin", "sid": "sid-a", "size": 10, "hashes": ["sha256:aa"], "merged_hashes": []},
+        "3": {"id": "id-b", "name": "b.bin", "sid": "sid-b", "size": 20, "hashes": ["sha256:bb"], "merged_hashes": ["sha256:cc"]},
+    }
+    index_path = make_file("index", data=json.dumps({"version": 2, "files": files}).encode())
+    service.upload(models.Request(id=jsonindex.Index.INDEX_FILENAME, path=str(index_path)))
+
+    index = sqlite.SqliteIndex(service)
+    imported = index.search_by_hash("sha256:cc")
+    assert [file["id"] for file in imported] == ["id-b"]
+    assert imported[0]["fingerprint"] is None
+    assert index.connection.execute("SELECT key FROM files WHERE id = 'id-b'").fetchone()["key"] == 3
+    assert names(reopen(service)) == ["a.bin", "b.bin"]
+
+
+def test_failed_batch_is_rolled_back(service, make_file, store):
+    index = sqlite.SqliteIndex(service)
+    upload(index, make_file("a.bin"))
+
+    with pytest.raises(RuntimeError):
+        with index.batch():
+            upload(index, make_file("b.bin"))
+            raise RuntimeError("Upload failed")
+
+    assert journal_files(store) == ["index.sqlite.journal.1"]
+    assert names(index) == ["a.bin"]
+    assert names(reopen(service)) == ["a.bin"]